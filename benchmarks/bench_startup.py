@@ -0,0 +1,64 @@
+###################################################################################################
+### Benchmark of the command line startup time of the FriendlyFitter package. #####################
+### copyright 2019/contact margaret.eminizer@gmail.com ############################################
+###################################################################################################
+
+#imports
+import os
+import sys
+import time
+import subprocess
+import tempfile
+from optparse import OptionParser
+
+#constants
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir,'src')
+TEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir,'test')
+#target median wall time (in seconds) for a plot-free, quiet run of the unweighted example,
+#which should never need to import scipy or matplotlib
+STARTUP_TARGET_SECONDS = 0.4
+
+#returns the list of wall times of running the given run_fitter.py arguments ntrials times
+def time_run_fitter(runargs,ntrials) :
+	times = []
+	with tempfile.TemporaryDirectory() as tmpdir :
+		for i in range(ntrials) :
+			start = time.perf_counter()
+			subprocess.run([sys.executable,os.path.join(SRC_DIR,'run_fitter.py')]+runargs,
+						   cwd=tmpdir,stdout=subprocess.DEVNULL,check=True)
+			times.append(time.perf_counter()-start)
+	return times
+
+#returns the list of modules a plot-free, quiet run imports that it shouldn't need
+def get_unneeded_heavy_imports(runargs) :
+	code = ( 'import sys,runpy; sys.argv=%r; sys.path.insert(0,%r)\n'%(['run_fitter.py']+runargs,SRC_DIR)+
+			 'try : runpy.run_path(%r,run_name="__main__")\n'%(os.path.join(SRC_DIR,'run_fitter.py'))+
+			 'except SystemExit : pass\n'+
+			 'print("HEAVY:"+",".join([m for m in ["scipy","matplotlib"] if m in sys.modules]))' )
+	with tempfile.TemporaryDirectory() as tmpdir :
+		result = subprocess.run([sys.executable,'-c',code],cwd=tmpdir,capture_output=True,
+								text=True,check=True)
+	lastline = result.stdout.strip().split('\n')[-1]
+	return [m for m in lastline[len('HEAVY:'):].split(',') if m]
+
+#Main script
+if __name__=='__main__' :
+	parser = OptionParser()
+	parser.add_option('-n','--ntrials', type='int', action='store', dest='ntrials', default=5,
+					  help='Number of times to run the fitter')
+	parser.add_option('-t','--target', type='float', action='store', dest='target',
+					  default=STARTUP_TARGET_SECONDS,
+					  help='Target median wall time in seconds')
+	(options, args) = parser.parse_args()
+
+	fastargs = ['-I',os.path.join(TEST_DIR,'speed_of_light_example_input_unweighted.csv'),
+				'-O','bench_startup','--noPlot','-q']
+	fulltimes = sorted(time_run_fitter(fastargs[:-2],options.ntrials))
+	fasttimes = sorted(time_run_fitter(fastargs,options.ntrials))
+	print('Full run (with plot):     median %.3f s, min %.3f s'%(fulltimes[len(fulltimes)//2],fulltimes[0]))
+	print('Plot-free quiet run:      median %.3f s, min %.3f s'%(fasttimes[len(fasttimes)//2],fasttimes[0]))
+	heavy = get_unneeded_heavy_imports(fastargs)
+	print('Heavy modules imported:   '+(', '.join(heavy) if len(heavy)>0 else 'none'))
+	failed = fasttimes[len(fasttimes)//2]>options.target or len(heavy)>0
+	print(('FAILED' if failed else 'PASSED')+': target is %.3f s with no heavy imports'%(options.target))
+	sys.exit(1 if failed else 0)
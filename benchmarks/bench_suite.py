@@ -0,0 +1,150 @@
+###################################################################################################
+### Benchmark suite timing every stage and fit type of the FriendlyFitter package. ################
+### copyright 2019/contact margaret.eminizer@gmail.com ############################################
+###################################################################################################
+
+#imports
+import os
+import sys
+import json
+import tempfile
+import numpy as np
+from optparse import OptionParser
+from generate_inputs import get_or_write_input_file
+
+#constants
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir,'src')
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),'baseline.json')
+#numbers of datapoints in the default suite (the generator goes up to 10^7 with --sizes)
+DEFAULT_SIZES = [10,1000,100000]
+#kinds of input file in the suite: (uncertainties, blank cells, line endings)
+INPUT_VARIANTS = [('none',False,'lf'),('none',True,'cr'),
+				  ('y',True,'lf'),('y',False,'crlf'),
+				  ('xy',False,'lf'),('xy',False,'cr')]
+#fit types that can be done with each kind of input
+FIT_TYPES_FOR_UNCERTAINTIES = {'none':['linear_least_squares'],
+							   'y':['linear_least_squares','linear_least_squares_y_weighted'],
+							   'xy':['linear_least_squares','linear_least_squares_y_weighted',
+									 'linear_least_squares_weighted','linear_errors_in_variables']}
+#relative tolerance for fit results to still match the baseline
+RESULT_TOLERANCE = 1e-7
+#stages faster than this (in seconds) are never counted as slowdowns (they're all noise)
+MIN_TIMED_SECONDS = 0.005
+
+sys.path.insert(0,SRC_DIR)
+from config import Config
+from fit import Fit
+from profiling import Profiler
+
+#runs every case of the suite, returning a dictionary of case name -> results/profile
+#(input files are generated in datadir if they aren't there yet)
+def run_suite(sizes,datadir,trace_memory=False,plot=False) :
+	cases = {}
+	with tempfile.TemporaryDirectory() as outdir :
+		for npoints in sizes :
+			for uncertainties,blanks,line_ending in INPUT_VARIANTS :
+				ifp = get_or_write_input_file(datadir,npoints,uncertainties,blanks,line_ending)
+				for fit_type in FIT_TYPES_FOR_UNCERTAINTIES[uncertainties] :
+					name = '%s:%s'%(os.path.basename(ifp)[:-len('.csv')],fit_type)
+					cases[name] = run_case(ifp,fit_type,outdir,trace_memory,plot)
+					print_case(name,cases[name])
+	return cases
+
+#fits one input file with one fit type through Config and Fit with a Profiler, returning the
+#results and profile
+def run_case(ifp,fit_type,outdir,trace_memory=False,plot=False) :
+	profiler = Profiler(trace_memory=trace_memory)
+	config = Config(ifp,fit_type_override=fit_type,profiler=profiler)
+	thisfit = Fit(config,profiler=profiler)
+	thisfit.minimize()
+	thisfit.writeOutput(os.path.join(outdir,'bench_output.txt'),os.path.join(outdir,'bench_output.json'))
+	if plot :
+		thisfit.savePlot(os.path.join(outdir,'bench_plot.png'))
+	profiler.stop()
+	result = thisfit.result()
+	return {'n_points':config.n_points(),
+			'engine':result.engine(),
+			'values':result.values().tolist(),
+			'errors':result.errors().tolist(),
+			'chi2':result.chi2(),
+			'profile':profiler.toDict()}
+
+#prints one line about a case
+def print_case(name,case) :
+	stages = case['profile']['stages']
+	total = sum([stages[s]['wall_s'] for s in stages if s!='weights'])
+	print('%-58s %-8s total %8.4f s ('%(name,case['engine'],total)+
+		  ', '.join(['%s %.4f'%(s,stages[s]['wall_s']) for s in stages])+')')
+
+#compares the cases to a baseline, returning a list of problems (results that don't match, and
+#stages more than max_slowdown times slower if max_slowdown is given)
+def compare_to_baseline(cases,baseline,max_slowdown=None) :
+	problems = []
+	for name,case in cases.items() :
+		if name not in baseline :
+			continue
+		base = baseline[name]
+		for key in ['values','errors','chi2'] :
+			if not np.allclose(case[key],base[key],rtol=RESULT_TOLERANCE,atol=0.,equal_nan=True) :
+				problems.append('%s: %s %s does not match baseline %s'%(name,key,case[key],base[key]))
+		if max_slowdown==None :
+			continue
+		for stage,entry in case['profile']['stages'].items() :
+			basetime = base['profile']['stages'].get(stage,{}).get('wall_s')
+			if basetime==None or entry['wall_s']<MIN_TIMED_SECONDS :
+				continue
+			if entry['wall_s']>max_slowdown*max(basetime,MIN_TIMED_SECONDS) :
+				problems.append('%s: stage %s took %.4f s (baseline %.4f s)'%(name,stage,entry['wall_s'],basetime))
+	return problems
+
+#Main script
+if __name__=='__main__' :
+	parser = OptionParser()
+	parser.add_option('--sizes', type='string', action='store', dest='sizes',
+					  default=','.join([str(s) for s in DEFAULT_SIZES]),
+					  help='Comma-separated numbers of datapoints to benchmark (10 up to 10000000)')
+	parser.add_option('--dataDir', type='string', action='store', dest='datadir', default=None,
+					  help='Directory to keep the generated input files in (a temporary one by default)')
+	parser.add_option('--traceMemory', action='store_true', dest='tracememory', default=False,
+					  help='Also trace the peak memory of each stage (slow)')
+	parser.add_option('--plot', action='store_true', dest='plot', default=False,
+					  help='Also time making the plots')
+	parser.add_option('--baseline', type='string', action='store', dest='baseline',
+					  default=BASELINE_FILE,
+					  help='Baseline file to compare the results to')
+	parser.add_option('--maxSlowdown', type='float', action='store', dest='maxslowdown', default=None,
+					  help='Also fail if a stage is more than this many times slower than in the baseline')
+	parser.add_option('--saveBaseline', action='store_true', dest='savebaseline', default=False,
+					  help='Save the results as the new baseline instead of comparing to it')
+	parser.add_option('--output', type='string', action='store', dest='outputfilename', default=None,
+					  help='JSON file to save all the results and profiles to')
+	(options, args) = parser.parse_args()
+
+	sizes = [int(float(s)) for s in options.sizes.split(',')]
+	if options.datadir!=None :
+		if not os.path.isdir(options.datadir) :
+			os.makedirs(options.datadir)
+		cases = run_suite(sizes,options.datadir,options.tracememory,options.plot)
+	else :
+		with tempfile.TemporaryDirectory() as datadir :
+			cases = run_suite(sizes,datadir,options.tracememory,options.plot)
+	if options.outputfilename!=None :
+		with open(options.outputfilename,'w') as fp :
+			json.dump(cases,fp,indent=1)
+	if options.savebaseline :
+		with open(options.baseline,'w') as fp :
+			json.dump(cases,fp,indent=1)
+		print('Saved '+str(len(cases))+' cases as the baseline in '+options.baseline)
+		sys.exit(0)
+	if not os.path.isfile(options.baseline) :
+		print('No baseline file '+options.baseline+' to compare to')
+		sys.exit(0)
+	with open(options.baseline) as fp :
+		baseline = json.load(fp)
+	problems = compare_to_baseline(cases,baseline,options.maxslowdown)
+	ncompared = len([name for name in cases if name in baseline])
+	for problem in problems :
+		print('	'+problem)
+	print(('FAILED' if len(problems)>0 else 'PASSED')+': compared %d of %d cases to the baseline'%(
+		  ncompared,len(cases)))
+	sys.exit(1 if len(problems)>0 else 0)
@@ -0,0 +1,102 @@
+###################################################################################################
+### Generator of synthetic "friendly fit input" files for the FriendlyFitter benchmarks. ##########
+### copyright 2019/contact margaret.eminizer@gmail.com ############################################
+###################################################################################################
+
+#imports
+import os
+import numpy as np
+from optparse import OptionParser
+
+#constants
+#which uncertainty columns are filled in for each kind of input
+UNCERTAINTY_KINDS = ['none','y','xy']
+#line endings that can be written (lone '\r' is what some old spreadsheet programs write)
+LINE_ENDINGS = {'lf':'\n','crlf':'\r\n','cr':'\r'}
+#true line the datapoints scatter around, and the fractional sizes of their uncertainties
+TRUE_SLOPE = 2.5
+TRUE_INTERCEPT = 10.
+X_FRACTIONAL_UNCERTAINTY = 0.01
+Y_FRACTIONAL_UNCERTAINTY = 0.02
+#number of datapoint lines generated and written at once
+WRITE_CHUNK_SIZE = 100000
+
+#writes a synthetic input file with npoints datapoints scattered around the true line
+#uncertainties is one of UNCERTAINTY_KINDS, blanks=True leaves the cells of missing uncertainties
+#empty instead of writing zeroes, and line_ending is one of the keys of LINE_ENDINGS.
+#The same arguments and seed always give the same file.
+def write_friendly_fit_input(filepath,npoints,uncertainties='xy',blanks=False,line_ending='lf',seed=0) :
+	newline = LINE_ENDINGS[line_ending]
+	rng = np.random.default_rng(seed)
+	header = ['Synthetic benchmark data (%d points, %s uncertainties),,,'%(npoints,uncertainties),
+			  '#####,friendly fit input,#####,',
+			  '## x name ##,## x units ##,## y name ##,## y units ##',
+			  'position,m,voltage,V',
+			  '## x values ##,## x uncertainties ##,## y values ##,## y uncertainties ##']
+	#newline='' so the line endings are written exactly as given
+	with open(filepath,'w',newline='') as fp :
+		fp.write(newline.join(header)+newline)
+		for start in range(0,npoints,WRITE_CHUNK_SIZE) :
+			n = min(WRITE_CHUNK_SIZE,npoints-start)
+			x = rng.uniform(1.,100.,n)
+			x_unc = X_FRACTIONAL_UNCERTAINTY*x
+			y_true = TRUE_SLOPE*x+TRUE_INTERCEPT
+			y_unc = Y_FRACTIONAL_UNCERTAINTY*y_true
+			#scatter the points by their uncertainties (or by the y uncertainty if they don't have any)
+			y = y_true+rng.standard_normal(n)*np.sqrt(y_unc**2+(TRUE_SLOPE*x_unc)**2)
+			if uncertainties=='xy' :
+				x = x+rng.standard_normal(n)*x_unc
+			columns = [_format_column_(x),
+					   _format_column_(x_unc) if uncertainties=='xy' else _blank_column_(n,blanks),
+					   _format_column_(y),
+					   _format_column_(y_unc) if uncertainties in ['y','xy'] else _blank_column_(n,blanks)]
+			lines = [','.join(cells) for cells in zip(*columns)]
+			fp.write(newline.join(lines)+newline)
+	return filepath
+
+#returns the standard name of a generated input file
+def get_input_file_name(npoints,uncertainties,blanks,line_ending) :
+	return 'bench_%d_%s_%s_%s.csv'%(npoints,uncertainties,'blanks' if blanks else 'filled',line_ending)
+
+#writes the input file with the given settings to a directory unless it's already there,
+#returning its path
+def get_or_write_input_file(directory,npoints,uncertainties,blanks,line_ending,seed=0) :
+	filepath = os.path.join(directory,get_input_file_name(npoints,uncertainties,blanks,line_ending))
+	if not os.path.isfile(filepath) :
+		write_friendly_fit_input(filepath,npoints,uncertainties,blanks,line_ending,seed)
+	return filepath
+
+#returns a column of numbers formatted as strings for the file
+def _format_column_(values) :
+	return np.char.mod('%.9g',values)
+
+#returns a column of empty cells (or zeroes) for missing uncertainties
+def _blank_column_(n,blanks) :
+	return np.full(n,'' if blanks else '0')
+
+#Main script
+if __name__=='__main__' :
+	parser = OptionParser()
+	parser.add_option('-n','--npoints', type='int', action='store', dest='npoints', default=1000,
+					  help='Number of datapoints to generate')
+	parser.add_option('-u','--uncertainties', type='choice', action='store', dest='uncertainties',
+					  choices=UNCERTAINTY_KINDS, default='xy',
+					  help='Which uncertainties the datapoints have (none, y, or xy)')
+	parser.add_option('--blanks', action='store_true', dest='blanks', default=False,
+					  help='Leave missing uncertainty cells empty instead of writing zeroes')
+	parser.add_option('-l','--lineEnding', type='choice', action='store', dest='lineending',
+					  choices=sorted(LINE_ENDINGS), default='lf',
+					  help='Line endings to write (lf, crlf, or cr)')
+	parser.add_option('-s','--seed', type='int', action='store', dest='seed', default=0,
+					  help='Random seed')
+	parser.add_option('-O','--output', type='string', action='store', dest='outputfilename',
+					  default=None,
+					  help='Name of the file to write (a standard name in the current directory by default)')
+	(options, args) = parser.parse_args()
+	outputfilename = options.outputfilename
+	if outputfilename==None :
+		outputfilename = get_input_file_name(options.npoints,options.uncertainties,options.blanks,
+											 options.lineending)
+	write_friendly_fit_input(outputfilename,options.npoints,options.uncertainties,options.blanks,
+							 options.lineending,options.seed)
+	print('Wrote '+str(options.npoints)+' datapoints to '+outputfilename)
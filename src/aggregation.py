@@ -0,0 +1,120 @@
+###################################################################################################
+### This file contains the data aggregation stage for the FriendlyFitter package. #################
+### copyright 2019/contact margaret.eminizer@gmail.com ############################################
+###################################################################################################
+
+#imports
+import numpy as np
+from datasets import LinearData
+from diagnostics import ConfigError, get_logger
+
+#constants
+#logger for the messages from this module
+logger = get_logger('aggregation')
+#ways to aggregate the datapoints in each bin: into the weighted sufficient statistics of a line
+#(exactly, as two pseudo-points), or into their weighted mean (one pseudo-point, losing the
+#information about the slope inside each bin)
+AGGREGATION_MODES = ['moments','means']
+#number of bins along x if the input doesn't say
+DEFAULT_AGGREGATION_BINS = 1000
+#number of parameters of the line fit to the aggregated pseudo-points
+N_LINE_PARAMETERS = 2
+
+#AggregatedLinearData class: the compact summary of a LinearData dataset binned along x, as a
+#LinearData of weighted pseudo-points whose weighted residuals give the same line fit. The chi2
+#of the original datapoints is the chi2 of the pseudo-points plus the part coming from the
+#spread of the datapoints inside the bins (withinBinChi2), which is a constant in 'moments' mode
+#and depends on the slope in 'means' mode. The pseudo-points have no uncertainties of their own,
+#just weights (already normalized like the original datapoints' weights).
+class AggregatedLinearData(LinearData) :
+
+	def __init__(self,data,mode,nbins,x,y,weights,sxx,sxy,syy) :
+		LinearData.__init__(self,data._x_name,data._x_unit,data._y_name,data._y_unit,len(x),x,y,
+							data._profiler)
+		self._weights = weights
+		self._mode = mode
+		self._n_bins = nbins
+		self._n_original_points = data.n_points()
+		#weighted centered second moments of the datapoints in each bin
+		self._sxx, self._sxy, self._syy = sxx, sxy, syy
+
+	def mode(self) :
+		return self._mode
+	def nBins(self) :
+		return self._n_bins
+	def nOriginalPoints(self) :
+		return self._n_original_points
+	#weighted centered x-x, x-y, and y-y second moments of the datapoints in each bin
+	def binMoments(self) :
+		return self._sxx, self._sxy, self._syy
+	#the part of the original datapoints' chi2 that the pseudo-points don't have, for a line
+	#with the given parameter values (slope first, which can also be an array of slopes)
+	def withinBinChi2(self,pvalues) :
+		if self._mode=='moments' :
+			with np.errstate(divide='ignore',invalid='ignore') :
+				return float(np.where(self._sxx>0.,self._syy-self._sxy**2/self._sxx,self._syy).sum())
+		slope = np.asarray(pvalues[0],dtype=np.float64)
+		return self._syy.sum()-2.*slope*self._sxy.sum()+slope**2*self._sxx.sum()
+	#the fraction of the slope's precision (1/uncertainty) that the fit to the pseudo-points keeps
+	#compared to fitting every datapoint (1 in 'moments' mode)
+	def precisionKept(self) :
+		if self._mode=='moments' :
+			return 1.
+		sumw = (self._weights**2).sum()
+		xbar = (self._weights**2*self._x).sum()/sumw
+		between = (self._weights**2*(self._x-xbar)**2).sum()
+		total = between+self._sxx.sum()
+		return float(np.sqrt(between/total)) if total>0. else 1.
+	#a dictionary describing the aggregation, for the FitResult
+	def summary(self,pvalues) :
+		return {'mode':self._mode,'n_bins':self._n_bins,'n_points':self._n_original_points,
+				'chi2_offset':float(self.withinBinChi2(pvalues)),'precision_kept':self.precisionKept()}
+
+# file-scope functions
+#bins a LinearData dataset into nbins equal-width bins along x and returns the AggregatedLinearData
+#summary of the given mode (bins without datapoints are left out). The datapoints enter every sum
+#with their squared weights, like in the fit's residuals.
+def aggregate_linear_data(data,mode='moments',nbins=DEFAULT_AGGREGATION_BINS) :
+	if mode not in AGGREGATION_MODES :
+		raise ConfigError('unknown aggregation mode %s (options are %s)'%(mode,AGGREGATION_MODES))
+	if nbins<1 :
+		raise ConfigError('the number of aggregation bins has to be positive, not %s!'%(nbins))
+	x, y, wsq = data.xArray(), data.yArray(), data.weightArray()**2
+	#which bin every datapoint goes in
+	xmin, xmax = data.xMin(), data.xMax()
+	width = (xmax-xmin)/nbins if xmax>xmin else 1.
+	binindex = np.minimum(((x-xmin)/width).astype(np.int64),nbins-1)
+	#weighted sums and means in every bin (dropping the empty ones)
+	sumw = np.bincount(binindex,wsq,nbins)
+	used = sumw>0.
+	binindex = np.cumsum(used)[binindex]-1
+	sumw = sumw[used]
+	#(one pseudo-point per bin can't pin down a line unless there are more of them than parameters)
+	if mode=='means' and len(sumw)<=N_LINE_PARAMETERS :
+		raise ConfigError('aggregating in %s mode left %d nonempty bin(s), but a line fit needs more than %d '%(
+						  mode,len(sumw),N_LINE_PARAMETERS)+'(use more bins or moments mode)!')
+	xbar = np.bincount(binindex,wsq*x)/sumw
+	ybar = np.bincount(binindex,wsq*y)/sumw
+	#centered second moments (from the deviations, to keep them accurate)
+	dx, dy = x-xbar[binindex], y-ybar[binindex]
+	sxx = np.bincount(binindex,wsq*dx*dx)
+	sxy = np.bincount(binindex,wsq*dx*dy)
+	syy = np.bincount(binindex,wsq*dy*dy)
+	if mode=='moments' :
+		#two pseudo-points at xbar+/-s on the bin's own regression line, each with half the weight,
+		#have the same sum of weights, weighted means, and weighted x-x and x-y moments
+		with np.errstate(divide='ignore',invalid='ignore') :
+			s = np.sqrt(sxx/sumw)
+			localslope = np.where(sxx>0.,sxy/sxx,0.)
+		pseudox = np.concatenate((xbar-s,xbar+s))
+		pseudoy = np.concatenate((ybar-s*localslope,ybar+s*localslope))
+		pseudow = np.sqrt(np.concatenate((sumw,sumw))/2.)
+	else :
+		pseudox, pseudoy, pseudow = xbar, ybar, np.sqrt(sumw)
+	#keep the pseudo-points in order of x like a regular dataset
+	order = np.argsort(pseudox,kind='stable')
+	aggregated = AggregatedLinearData(data,mode,int(used.sum()),pseudox[order],pseudoy[order],
+									  np.ascontiguousarray(pseudow[order]),sxx,sxy,syy)
+	logger.info('		Aggregated %d datapoints into %d pseudo-points in %d bins (%s), keeping %.2f%% of the slope precision',
+				data.n_points(),aggregated.n_points(),aggregated.nBins(),mode,100.*aggregated.precisionKept())
+	return aggregated
@@ -0,0 +1,77 @@
+###################################################################################################
+### This file contains the functions to use the FriendlyFitter package from other programs. ######
+### copyright 2019/contact margaret.eminizer@gmail.com ############################################
+###################################################################################################
+
+#These functions do the same fits as run_fitter.py, but take numpy arrays (or an input file path)
+#and return FitResult objects instead of writing files. Nothing is printed: the package's messages
+#go to the 'friendlyfitter' logger (see diagnostics.configure_console_logging to show them), and
+#anything that goes wrong raises a diagnostics.FriendlyFitterError. Any of them can be given a
+#profiling.Profiler to record how long each stage of the fit takes, a robust loss function
+#(see fit.LOSS_FUNCTIONS), a number of sigma to iteratively reject outliers at, and a
+#cache.ResultCache to reuse the results of identical fits (and warm-start changed ones).
+
+#imports
+import numpy as np
+from config import Config, get_keyword_dict_from_arrays
+from fit import Fit
+
+# file-scope functions
+#returns a Fit (not minimized yet) of the given x/y values and uncertainties (None for none).
+#The fit type is chosen from the uncertainties like it is for an input file if it isn't given.
+#aggregation=(mode,number of bins) fits a compact summary of the datapoints in bins along x
+#instead (see aggregation.AGGREGATION_MODES).
+def make_fit_from_arrays(x_values,y_values,x_uncertainties=None,y_uncertainties=None,
+						 fit_type=None,model=None,engine=None,
+						 x_name='x',x_unit='',y_name='y',y_unit='',profiler=None,
+						 loss='linear',loss_scale=None,resultcache=None,aggregation=None) :
+	keywordlinesdict = get_keyword_dict_from_arrays(x_values,y_values,x_uncertainties,y_uncertainties,
+													x_name,x_unit,y_name,y_unit,model)
+	if aggregation is not None :
+		keywordlinesdict['aggregation'] = list(aggregation)
+	return Fit(Config(fit_type_override=fit_type,keywordlinesdict=keywordlinesdict),engine=engine,
+			   profiler=profiler,loss=loss,loss_scale=loss_scale,resultcache=resultcache)
+
+#fits the given x/y values and uncertainties and returns the FitResult
+#(with sigma_clip, the datapoints further than that many sigma from the fit are rejected)
+def fit_arrays(x_values,y_values,x_uncertainties=None,y_uncertainties=None,
+			   fit_type=None,model=None,engine=None,profiler=None,
+			   loss='linear',loss_scale=None,sigma_clip=None,resultcache=None,aggregation=None) :
+	thisfit = make_fit_from_arrays(x_values,y_values,x_uncertainties,y_uncertainties,
+								   fit_type,model,engine,profiler=profiler,
+								   loss=loss,loss_scale=loss_scale,resultcache=resultcache,
+								   aggregation=aggregation)
+	return _minimize_(thisfit,sigma_clip)
+
+#fits several datasets simultaneously and returns the FitResult, where datasets is a dictionary
+#of dataset label -> (x values, y values, x uncertainties, y uncertainties) (the uncertainties
+#can be None or left off) and shared_parameters lists the short names of the model parameters
+#shared by all the datasets (the rest are fit separately for each one, like 'b_run1')
+def fit_datasets(datasets,shared_parameters=(),fit_type=None,model=None,engine=None,profiler=None,
+				 loss='linear',loss_scale=None,sigma_clip=None,resultcache=None) :
+	columns = [[],[],[],[]]
+	for values in datasets.values() :
+		values = list(values)+[None]*(4-len(values))
+		n = len(values[0])
+		for i in range(4) :
+			columns[i].append(np.zeros(n) if values[i] is None else np.asarray(values[i],dtype=np.float64).ravel())
+	keywordlinesdict = get_keyword_dict_from_arrays(*[np.concatenate(c) for c in columns],fit_model=model)
+	keywordlinesdict['datasets'] = [[str(label),len(c)] for label,c in zip(datasets,columns[0])]
+	keywordlinesdict['shared_parameters'] = list(shared_parameters)
+	thisfit = Fit(Config(fit_type_override=fit_type,keywordlinesdict=keywordlinesdict),engine=engine,
+				  profiler=profiler,loss=loss,loss_scale=loss_scale,resultcache=resultcache)
+	return _minimize_(thisfit,sigma_clip)
+
+#fits the data in an input file (optionally using a ConfigCache) and returns the FitResult
+def fit_file(inputfilepath,fit_type=None,engine=None,cache=None,profiler=None,
+			 loss='linear',loss_scale=None,sigma_clip=None,resultcache=None) :
+	thisfit = Fit(Config(inputfilepath,fit_type_override=fit_type,cache=cache,profiler=profiler),
+				  engine=engine,profiler=profiler,loss=loss,loss_scale=loss_scale,resultcache=resultcache)
+	return _minimize_(thisfit,sigma_clip)
+
+#minimizes a fit (sigma clipping it if sigma_clip is given) and returns the FitResult
+def _minimize_(thisfit,sigma_clip) :
+	thisfit.minimize()
+	if sigma_clip!=None :
+		thisfit.sigmaClip(sigma_clip)
+	return thisfit.result()
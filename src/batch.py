@@ -0,0 +1,82 @@
+###################################################################################################
+### This file contains the batch fitting functions for the FriendlyFitter package. ################
+### copyright 2019/contact margaret.eminizer@gmail.com ############################################
+###################################################################################################
+
+#imports
+import numpy as np
+from datasets import get_unnormalized_weights
+from fit import solve_weighted_line
+from diagnostics import DataError
+
+#constants
+#one record per dataset in the array returned by fit_linear_batch
+BATCH_RESULT_DTYPE = np.dtype([('fit_type','U31'),
+							   ('n_points',np.int64),
+							   ('slope',np.float64),
+							   ('slope_err',np.float64),
+							   ('intercept',np.float64),
+							   ('intercept_err',np.float64),
+							   ('success',np.bool_)])
+
+# file-scope functions
+#fits a line to every one of a stack of independent x-y datasets at once
+#the inputs are either 2D arrays with one dataset per row (padded, with an optional boolean mask
+#that's True for the real datapoints) or lists of 1D arrays of different lengths (ragged).
+#The fit type of each dataset is picked the same way the Config class does it: uncertainties
+#are only used if every datapoint in the dataset has a nonzero one, x uncertainties are only
+#used along with y uncertainties, and the datapoints are weighted like in the LinearData classes.
+#Returns a structured array of BATCH_RESULT_DTYPE with one entry per dataset.
+def fit_linear_batch(x_values,y_values,x_uncertainties=None,y_uncertainties=None,mask=None) :
+	#stack everything up into padded 2D arrays with a mask
+	x, stackmask = _stack_datasets_(x_values)
+	y, _ = _stack_datasets_(y_values)
+	x_unc = np.zeros(x.shape) if x_uncertainties is None else _stack_datasets_(x_uncertainties)[0]
+	y_unc = np.zeros(y.shape) if y_uncertainties is None else _stack_datasets_(y_uncertainties)[0]
+	if not (x.shape==y.shape==x_unc.shape==y_unc.shape) :
+		raise DataError("shapes of x,y values/uncertainties in the batch don't match!")
+	if mask is not None :
+		stackmask = stackmask & np.broadcast_to(np.asarray(mask,dtype=bool),x.shape)
+	#zero out the padding so it can't spoil any of the sums
+	x = np.where(stackmask,x,0.); y = np.where(stackmask,y,0.)
+	x_unc = np.where(stackmask,x_unc,0.); y_unc = np.where(stackmask,y_unc,0.)
+	n_points = stackmask.sum(axis=-1)
+	#figure out which uncertainties each dataset will use
+	use_y_unc = (n_points>0) & np.all((y_unc!=0.) | ~stackmask,axis=-1)
+	use_x_unc = use_y_unc & np.all((x_unc!=0.) | ~stackmask,axis=-1)
+	#weight the datapoints like the LinearData classes do and normalize within each dataset
+	unnormalized_weights = get_unnormalized_weights(x,y,np.where(use_x_unc[:,np.newaxis],x_unc,0.),
+													np.where(use_y_unc[:,np.newaxis],y_unc,0.))
+	unnormalized_weights = np.where(stackmask,unnormalized_weights,0.)
+	with np.errstate(divide='ignore',invalid='ignore') :
+		weights = unnormalized_weights/unnormalized_weights.sum(axis=-1)[:,np.newaxis]
+	weights = np.where(stackmask,weights,0.)
+	#solve all of the fits and rescale the covariance matrices like Fit.minimize does
+	slope, intercept, pcov, fvec = solve_weighted_line(x,y,weights)
+	with np.errstate(divide='ignore',invalid='ignore') :
+		s_sq = (fvec**2).sum(axis=-1)/(n_points-2)
+		slope_err = np.sqrt(np.absolute(pcov[:,0,0]*s_sq))
+		intercept_err = np.sqrt(np.absolute(pcov[:,1,1]*s_sq))
+	#fill the results
+	results = np.zeros(len(n_points),dtype=BATCH_RESULT_DTYPE)
+	results['fit_type'] = np.where(use_x_unc,'linear_least_squares_weighted',
+								   np.where(use_y_unc,'linear_least_squares_y_weighted',
+											'linear_least_squares'))
+	results['n_points'] = n_points
+	results['slope'], results['slope_err'] = slope, slope_err
+	results['intercept'], results['intercept_err'] = intercept, intercept_err
+	results['success'] = np.isfinite(slope) & np.isfinite(intercept)
+	return results
+
+#returns a padded 2D float64 array and a mask of the real entries given a 2D array or ragged list
+def _stack_datasets_(datasets) :
+	if isinstance(datasets,np.ndarray) and datasets.dtype!=object :
+		stack = np.atleast_2d(np.asarray(datasets,dtype=np.float64))
+		return stack, np.ones(stack.shape,dtype=bool)
+	rows = [np.asarray(ds,dtype=np.float64).ravel() for ds in datasets]
+	lengths = np.array([len(r) for r in rows],dtype=np.int64)
+	stack = np.zeros((len(rows),lengths.max() if len(rows)>0 else 0))
+	stackmask = np.arange(stack.shape[1])[np.newaxis,:]<lengths[:,np.newaxis]
+	if len(rows)>0 :
+		stack[stackmask] = np.concatenate(rows)
+	return stack, stackmask
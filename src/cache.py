@@ -0,0 +1,224 @@
+###################################################################################################
+### This file contains the ConfigCache and ResultCache classes for the FriendlyFitter package. ####
+### copyright 2019/contact margaret.eminizer@gmail.com ############################################
+###################################################################################################
+
+#imports
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+from result import FitResult
+from diagnostics import get_logger
+
+#constants
+#logger for the messages from this module
+logger = get_logger('cache')
+#default maximum total size of a cache directory (in bytes)
+DEFAULT_MAX_CACHE_BYTES = 1024**3
+#version of the way fit results are computed and stored (changing it invalidates every cached result)
+RESULT_CACHE_VERSION = 1
+
+#ConfigCache class: on-disk cache of the parsed keyword dictionaries of input files
+#each entry is a .npy file with the x/y data block stored column-by-column (so the columns can be
+#memory-mapped back) and a .json file with the other keyword lines and the input file it came from.
+#Entries are keyed by the input file's path, modification time and size, so editing an input file
+#invalidates its entry automatically; the least recently used entries are evicted once the
+#directory holds more than max_bytes.
+class ConfigCache(object) :
+
+	def __init__(self,cachedir,max_bytes=DEFAULT_MAX_CACHE_BYTES) :
+		self._cachedir = cachedir
+		self._max_bytes = max_bytes
+		#(several workers can make the same new cache directory at once)
+		os.makedirs(self._cachedir,exist_ok=True)
+
+	#public functions
+	#return the cached keyword dictionary for the given input file, or None if it's not cached
+	def load(self,ifp) :
+		key, stat = self._get_key_and_stat_(ifp)
+		metapath, datapath = self._get_entry_paths_(key)
+		try :
+			with open(metapath,'r') as fp :
+				meta = json.load(fp)
+		except (IOError,ValueError) :
+			return None
+		#double-check that the entry really belongs to this version of the input file
+		if ( 'keywords' not in meta or meta['path']!=os.path.abspath(ifp) or
+			 meta['mtime_ns']!=stat.st_mtime_ns or meta['size']!=stat.st_size ) :
+			return None
+		kwlinesdict = dict(meta['keywords'])
+		if meta['has_x_y_data_block'] :
+			try :
+				kwlinesdict['x_y_data_block'] = np.load(datapath,mmap_mode='r').T
+			except (IOError,ValueError) :
+				return None
+		#mark the entry as recently used
+		_mark_used_([metapath]+([datapath] if meta['has_x_y_data_block'] else []))
+		logger.info('		Loaded parsed input from cache entry %s',key)
+		return kwlinesdict
+
+	#add the keyword dictionary for the given input file to the cache
+	def store(self,ifp,kwlinesdict) :
+		key, stat = self._get_key_and_stat_(ifp)
+		metapath, datapath = self._get_entry_paths_(key)
+		meta = {'path':os.path.abspath(ifp),
+				'mtime_ns':stat.st_mtime_ns,
+				'size':stat.st_size,
+				'keywords':dict([(k,v) for k,v in kwlinesdict.items() if k!='x_y_data_block']),
+				'has_x_y_data_block':'x_y_data_block' in kwlinesdict}
+		#write to temporary files first so a half-written entry is never picked up
+		if meta['has_x_y_data_block'] :
+			columns = np.ascontiguousarray(kwlinesdict['x_y_data_block'].T)
+			write_through_temporary_file(datapath,lambda fp : np.save(fp,columns),'wb')
+		write_through_temporary_file(metapath,lambda fp : json.dump(meta,fp))
+		self._evict_()
+
+	#private functions
+	#get the cache key and os.stat result for an input file path
+	def _get_key_and_stat_(self,ifp) :
+		stat = os.stat(ifp)
+		keystring = '%s|%d|%d'%(os.path.abspath(ifp),stat.st_mtime_ns,stat.st_size)
+		return hashlib.sha1(keystring.encode('utf-8')).hexdigest(), stat
+
+	#get the metadata and data file paths for a cache key
+	def _get_entry_paths_(self,key) :
+		return ( os.path.join(self._cachedir,key+'.json'),
+				 os.path.join(self._cachedir,key+'.npy') )
+
+	#remove the least recently used entries until the cache is small enough
+	def _evict_(self) :
+		evict_least_recently_used(self._cachedir,self._max_bytes,['.json','.npy'])
+
+#ResultCache class: on-disk cache of fit results keyed by a hash of the content of the fit (the
+#data columns, which datapoints are used, and every setting that changes the result), so fitting
+#the exact same thing again just loads the result. Each entry is a .npz file of the result's
+#arrays and a .json file of the rest. It also keeps the latest best fit values for each kind of
+#fit of each input (in small .warm.json files), which a changed input's fit can start the
+#minimizer from. Least recently used entries are evicted like in the ConfigCache.
+class ResultCache(object) :
+
+	def __init__(self,cachedir,max_bytes=DEFAULT_MAX_CACHE_BYTES) :
+		self._cachedir = cachedir
+		self._max_bytes = max_bytes
+		os.makedirs(self._cachedir,exist_ok=True)
+
+	#public functions
+	#return the cached FitResult with the given key, or None if it's not cached
+	def load(self,key) :
+		metapath, datapath = self._get_entry_paths_(key)
+		try :
+			with open(metapath,'r') as fp :
+				meta = json.load(fp)
+			with np.load(datapath) as npz :
+				arrays = dict(npz)
+		except (IOError,ValueError,KeyError) :
+			return None
+		_mark_used_([metapath,datapath])
+		logger.info('		Loaded fit result from cache entry %s',key)
+		return FitResult(meta['names'],arrays['values'],arrays['covariance'],
+						 arrays['weighted_residuals'],arrays['residuals'],
+						 meta['fit_type'],meta['model'],meta['engine'],meta['loss'],
+						 arrays['mask'] if 'mask' in arrays else None,meta.get('aggregation'))
+
+	#add a FitResult to the cache with the given key, and remember its values for warm starts
+	def store(self,key,result,warmkey=None) :
+		metapath, datapath = self._get_entry_paths_(key)
+		meta = {'names':list(result.names()),'fit_type':result.fit_type(),'model':result.model_name(),
+				'engine':result.engine(),'loss':result.loss(),'aggregation':result.aggregation()}
+		arrays = {'values':result.values(),'covariance':result.covariance(),
+				  'weighted_residuals':result.weightedResiduals(),'residuals':result.residuals()}
+		if result.mask() is not None :
+			arrays['mask'] = result.mask()
+		#write to temporary files first so a half-written entry is never picked up
+		write_through_temporary_file(datapath,lambda fp : np.savez(fp,**arrays),'wb')
+		_write_json_(metapath,meta)
+		if warmkey!=None :
+			_write_json_(self._get_warm_start_path_(warmkey),{'names':meta['names'],
+															   'values':result.values().tolist()})
+		evict_least_recently_used(self._cachedir,self._max_bytes,['.json','.npz'])
+
+	#return the latest best fit values stored with the given warm start key (None if there aren't
+	#any, or they're for different parameters)
+	def loadWarmStart(self,warmkey,names) :
+		try :
+			with open(self._get_warm_start_path_(warmkey),'r') as fp :
+				warm = json.load(fp)
+		except (IOError,ValueError) :
+			return None
+		if warm.get('names')!=list(names) :
+			return None
+		return warm['values']
+
+	#private functions
+	#get the metadata and data file paths for a cache key
+	def _get_entry_paths_(self,key) :
+		return ( os.path.join(self._cachedir,key+'.json'),
+				 os.path.join(self._cachedir,key+'.npz') )
+	def _get_warm_start_path_(self,warmkey) :
+		return os.path.join(self._cachedir,warmkey+'.warm.json')
+
+# file-scope functions
+#returns a hex digest of the contents of the given arrays (None for a missing one) and a
+#dictionary of settings, to use as a cache key
+def get_content_hash(arrays,settings) :
+	h = hashlib.blake2b(digest_size=20)
+	h.update(json.dumps(dict(settings,cache_version=RESULT_CACHE_VERSION),sort_keys=True).encode('utf-8'))
+	for a in arrays :
+		if a is None :
+			h.update(b'None')
+			continue
+		a = np.ascontiguousarray(a)
+		h.update(('%s%s'%(a.dtype.str,a.shape)).encode('utf-8'))
+		h.update(a.view(np.uint8).ravel())
+	return h.hexdigest()
+
+#removes the least recently used entries (files with the same name and one of the given
+#extensions) from a cache directory until it holds no more than max_bytes
+def evict_least_recently_used(cachedir,max_bytes,extensions) :
+	entries = {}
+	for fn in os.listdir(cachedir) :
+		key, ext = os.path.splitext(fn)
+		if ext not in extensions :
+			continue
+		st = os.stat(os.path.join(cachedir,fn))
+		lastused, size, names = entries.get(key,(0.,0,[]))
+		entries[key] = (max(lastused,st.st_mtime),size+st.st_size,names+[fn])
+	totalsize = sum([size for lastused,size,names in entries.values()])
+	for key in sorted(entries,key=lambda k : entries[k][0]) :
+		if totalsize<=max_bytes :
+			break
+		for fn in entries[key][2] :
+			p = os.path.join(cachedir,fn)
+			if os.path.isfile(p) :
+				os.remove(p)
+		totalsize-=entries[key][1]
+
+#writes a file by calling write with a uniquely named temporary file in the same directory, then
+#moves it into place, so concurrent writers of the same file never clobber each other's
+#half-written temporary files (the last one to finish wins)
+def write_through_temporary_file(path,write,mode='w') :
+	fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+								   prefix=os.path.basename(path)+'.',suffix='.tmp')
+	try :
+		with os.fdopen(fd,mode) as fp :
+			write(fp)
+		os.replace(tmppath,path)
+	except BaseException :
+		if os.path.isfile(tmppath) :
+			os.remove(tmppath)
+		raise
+
+#marks the files of a cache entry as recently used (the entry is already loaded, so it doesn't
+#matter if another worker evicted them in the meantime)
+def _mark_used_(paths) :
+	for p in paths :
+		try :
+			os.utime(p,None)
+		except OSError :
+			pass
+
+#writes a dictionary to a JSON file through a temporary file
+def _write_json_(path,contents) :
+	write_through_temporary_file(path,lambda fp : json.dump(contents,fp))
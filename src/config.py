@@ -4,34 +4,76 @@
 ###################################################################################################
 
 #imports
+import io
+import numpy as np
+from diagnostics import ConfigError, DataError, get_logger
+from profiling import NULL_PROFILER
+from aggregation import AGGREGATION_MODES, DEFAULT_AGGREGATION_BINS
+from readers import is_binary_input, get_keyword_dict_from_binary_file
 
 #constants
+#logger for the messages from this module
+logger = get_logger('config')
 KW_FORMATS = {}
 KW_FORMATS['x_y_defs'] = ['## x name ##','## x units ##','## y name ##','## y units ##']
 KW_FORMATS['x_y_data_block'] = ['## x values ##','## x uncertainties ##',
 								'## y values ##','## y uncertainties ##']
+KW_FORMATS['fit_model'] = ['## fit model ##']
+KW_FORMATS['dataset'] = ['## dataset ##']
+KW_FORMATS['shared_parameters'] = ['## shared parameters ##']
+KW_FORMATS['aggregation'] = ['## aggregation ##']
+#types of fit that can be done
+FIT_TYPES = ['linear_least_squares','linear_least_squares_y_weighted',
+			 'linear_least_squares_weighted','linear_errors_in_variables']
+#number of data block lines to bulk-convert at once
+DATA_CHUNK_SIZE = 65536
 
 #Config class
 class Config(object) :
 
-	#initialize from path to input file
-	def __init__(self,inputfilepath,fit_type_override=None) :
+	#initialize from path to input file (and optionally a ConfigCache of previously parsed files;
+	#.npy/.npz/.ffc input files are memory-mapped instead, see readers.py), or straight from a
+	#dictionary of keyword lines (like get_keyword_dict_from_arrays returns)
+	#(reading the input file is timed as the 'parsing' stage if a Profiler is given)
+	def __init__(self,inputfilepath=None,fit_type_override=None,cache=None,keywordlinesdict=None,
+				 profiler=None) :
 		#set all configuration possibilities to None to start
+		self._inputfilepath=inputfilepath
 		self._x_name,self._x_unit,self._y_name,self._y_unit = None,None,None,None
 		self._x_values,self._x_uncertainties=None,None
 		self._y_values,self._y_uncertainties=None,None
 		self._n_points=None
+		self._fit_model=None
+		self._datasets,self._shared_parameters=None,[]
+		self._aggregation=None
 		self._fit_type=fit_type_override
-		#get the lines relevant to the fit stuff from the input file
-		fitterlines = get_fitter_lines_from_filepath(inputfilepath)
-		#make the dictionary of keyword lines
-		keywordlinesdict = get_keyword_dict_from_fitter_lines(fitterlines)
+		if keywordlinesdict is None and inputfilepath is None :
+			raise ConfigError('a fit configuration needs an input file or a dictionary of keyword lines!')
+		with (profiler if profiler is not None else NULL_PROFILER).stage('parsing') :
+			#binary input files are memory-mapped instead of parsed (so they skip the cache too)
+			if keywordlinesdict is None and is_binary_input(inputfilepath) :
+				keywordlinesdict = get_keyword_dict_from_binary_file(inputfilepath)
+			#reuse the dictionary of keyword lines from the cache if it's there
+			if keywordlinesdict is None and cache is not None :
+				keywordlinesdict = cache.load(inputfilepath)
+			if keywordlinesdict is None :
+				#get the lines relevant to the fit stuff from the input file
+				fitterlines = get_fitter_lines_from_filepath(inputfilepath)
+				#make the dictionary of keyword lines
+				keywordlinesdict = get_keyword_dict_from_fitter_lines(fitterlines)
+				if cache is not None :
+					cache.store(inputfilepath,keywordlinesdict)
 		#set configuration from the keywordlines dictionary
 		self._set_configuration_from_keyword_lines_dict_(keywordlinesdict)
 		if self._fit_type==None : #set fit type automatically if not already done
 			self._set_fit_type_automatically_()
+		elif self._fit_type not in FIT_TYPES :
+			raise ConfigError('unknown fit type %s (options are %s)'%(self._fit_type,FIT_TYPES))
 
 	#public functions
+	#path of the input file (None if the configuration came straight from keyword lines)
+	def input_file_path(self) :
+		return self._inputfilepath
 	def x_name(self) :
 		return self._x_name
 	def x_unit(self) :
@@ -52,25 +94,38 @@ class Config(object) :
 		return self._n_points
 	def fit_type(self) :
 		return self._fit_type
+	def fit_model(self) :
+		return self._fit_model if self._fit_model!=None else 'linear'
+	#labels and numbers of points of the datasets fit simultaneously (None if there's just the one
+	#unlabeled dataset); their points come one dataset after the other in the value arrays
+	def dataset_labels(self) :
+		return [ds[0] for ds in self._datasets] if self._datasets!=None else None
+	def dataset_sizes(self) :
+		return [ds[1] for ds in self._datasets] if self._datasets!=None else None
+	#short names of the parameters shared by all the datasets (the rest are fit for each one)
+	def shared_parameters(self) :
+		return self._shared_parameters
+	#[mode,number of bins] to aggregate the datapoints into before fitting (None to fit them all)
+	def aggregation(self) :
+		return self._aggregation
 
 	#private functions
 	#to set the type of fit that will be done automatically
 	def _set_fit_type_automatically_(self) :
 		#first check if there's a linear regression possible (need x/y dataset)
 		if self._n_points==None :
-			print('ERROR: did not find any datapoints to fit in input file!')
-			exit()
-		if ( self._y_values!=None and self._x_values!=None and 
+			raise DataError('did not find any datapoints to fit in input file!')
+		if ( self._y_values is not None and self._x_values is not None and 
 			 len(self._x_values)==self._n_points and len(self._y_values)==self._n_points ) :
 			#if there are the same number of x and y datapoints, check which errors we have
-			if self._x_uncertainties==None and self._y_uncertainties==None :
+			if self._x_uncertainties is None and self._y_uncertainties is None :
 				#if there are no errors it's just linear least squares
 				self._fit_type='linear_least_squares'
-			if self._y_uncertainties!=None and len(self._y_uncertainties)==self._n_points :
+			if self._y_uncertainties is not None and len(self._y_uncertainties)==self._n_points :
 				#if every datapoint has a y uncertainty, it's y-weighted linear least squares
 				self._fit_type='linear_least_squares_y_weighted'
-			if ( self._x_uncertainties!=None and len(self._x_uncertainties)==self._n_points and 
-				 self._y_uncertainties!=None and len(self._y_uncertainties)==self._n_points ) :
+			if ( self._x_uncertainties is not None and len(self._x_uncertainties)==self._n_points and 
+				 self._y_uncertainties is not None and len(self._y_uncertainties)==self._n_points ) :
 				#if every datapoint has x and y uncertainties, it's weighted linear least squares
 				self._fit_type='linear_least_squares_weighted'
 
@@ -79,92 +134,219 @@ class Config(object) :
 		#set x and y variable names and units
 		if 'x_y_defs' in keywordlinesdict :
 			[self._x_name,self._x_unit,self._y_name,self._y_unit] = keywordlinesdict['x_y_defs']
+		#set the name of the model to fit
+		if 'fit_model' in keywordlinesdict :
+			self._fit_model = keywordlinesdict['fit_model']
+		#set the labeled datasets and the parameters they share
+		if 'datasets' in keywordlinesdict :
+			self._datasets = [(str(label),int(size)) for label,size in keywordlinesdict['datasets']]
+		if 'shared_parameters' in keywordlinesdict :
+			self._shared_parameters = list(keywordlinesdict['shared_parameters'])
+		#set how the datapoints are aggregated
+		if 'aggregation' in keywordlinesdict :
+			mode,nbins = keywordlinesdict['aggregation']
+			self._aggregation = [str(mode),int(nbins)]
 		#set x and y value/uncertainty arrays and number of points
-		if 'x_y_data_block' in keywordlinesdict :
-			self._x_values = [e[0] for e in keywordlinesdict['x_y_data_block']]
-			self._x_uncertainties = [e[1] for e in keywordlinesdict['x_y_data_block']]
-			if self._x_uncertainties.count(0.)==len(self._x_uncertainties) :
-				print('INFO: all x uncertainties set to 0; will ignore x uncertainties.')
+		if 'x_y_data_block' in keywordlinesdict or 'x_y_columns' in keywordlinesdict :
+			#one contiguous column each for x values/uncertainties and y values/uncertainties
+			#(binary input files give them already in columns, which stay memory-mapped if they're
+			#contiguous float64 already, and leave out missing uncertainties)
+			if 'x_y_columns' in keywordlinesdict :
+				columns = [None if c is None else np.ascontiguousarray(c,dtype=np.float64)
+						   for c in keywordlinesdict['x_y_columns']]
+			else :
+				columns = list(np.ascontiguousarray(keywordlinesdict['x_y_data_block'].T))
+			self._x_values = columns[0]
+			self._x_uncertainties = columns[1]
+			if self._x_uncertainties is not None and np.all(self._x_uncertainties==0.) :
+				logger.info('INFO: all x uncertainties set to 0; will ignore x uncertainties.')
 				self._x_uncertainties=None
-			self._y_values = [e[2] for e in keywordlinesdict['x_y_data_block']]
-			self._y_uncertainties = [e[3] for e in keywordlinesdict['x_y_data_block']]
-			if self._y_uncertainties.count(0.)==len(self._y_uncertainties) :
-				print('INFO: all y uncertainties set to 0; will ignore y uncertainties.')
+			self._y_values = columns[2]
+			self._y_uncertainties = columns[3]
+			if self._y_uncertainties is not None and np.all(self._y_uncertainties==0.) :
+				logger.info('INFO: all y uncertainties set to 0; will ignore y uncertainties.')
 				self._y_uncertainties=None
-			if self._x_uncertainties!=None and self._x_uncertainties.count(0.)>0 :
-				print('WARNING: missing x uncertainties for one or more datapoints')
-				print('         will ignore x errors.')
+			if self._x_uncertainties is not None and np.any(self._x_uncertainties==0.) :
+				logger.warning('missing x uncertainties for one or more datapoints\n'+
+							   '         will ignore x errors.')
 				self._x_uncertainties=None
-			if self._y_uncertainties!=None and self._y_uncertainties.count(0.)>0 :
-				print('WARNING: missing y uncertainties for one or more datapoints')
-				print('         will ignore y errors.')
+			if self._y_uncertainties is not None and np.any(self._y_uncertainties==0.) :
+				logger.warning('missing y uncertainties for one or more datapoints\n'+
+							   '         will ignore y errors.')
 				self._y_uncertainties=None
 			self._n_points = len(self._x_values)
-			if ( (self._x_uncertainties!=None and len(self._x_uncertainties)!=self._n_points) or
+			if self._datasets!=None and sum(self.dataset_sizes())!=self._n_points :
+				raise DataError("numbers of points in the datasets don't add up to the number of x/y points!")
+			if ( (self._x_uncertainties is not None and len(self._x_uncertainties)!=self._n_points) or
 				 len(self._y_values)!=self._n_points or
-				 (self._y_uncertainties!=None and len(self._y_uncertainties)!=self._n_points) ) :
-				print("ERROR: numbers of x,y points/uncertainties don't match!")
-				print("       Does every line in the list of points have an x and y value?")
-				exit()		
+				 (self._y_uncertainties is not None and len(self._y_uncertainties)!=self._n_points) ) :
+				raise DataError("numbers of x,y points/uncertainties don't match!\n"+
+								"       Does every line in the list of points have an x and y value?")
 
 # file-scope functions
-#returns dictionary of information from file indexed by keyword given list of fit-related lines
+#returns dictionary of information from file indexed by keyword given (an iterable of) fit-related lines
+#the x/y data block is returned as a 2D array with one [x,x unc.,y,y unc.] row per datapoint.
+#Several datasets can be fit simultaneously by giving each one its own x/y data block after a
+#dataset line with its label; their data blocks are joined into one in order, and their labels
+#and numbers of points are returned as a list of [label,size] pairs under 'datasets'.
 def get_keyword_dict_from_fitter_lines(fls) :
 	#dictionary to return
 	kwlinesdict = {}
 	#loop over the fitterlines looking for keyword lines and populate the dictionary
-	i=0; current_kw = ''
-	while i < len(fls) :
-		flsplit = fls[i].split(',')
+	current_kw = ''; found_kws = set()
+	#labeled datasets so far, and whether the last one still needs its data block
+	datasets = []; awaiting_block = False
+	#data block lines waiting to be converted, and the chunks of converted values
+	datalines = []; datachunks = []
+	for fl in fls :
 		#if this line is a special keyword line
-		if flsplit[0].startswith('##') :
+		if fl.startswith('##') :
+			flsplit = fl.split(',')
 			for kw,patternlist in KW_FORMATS.items() :
 				if ( len(flsplit)>=len(patternlist) and 
 					 [f.lower() for f in flsplit][:len(patternlist)]==patternlist ) :
 					current_kw=kw
-					if current_kw in kwlinesdict.keys() :
-						print('ERROR: more than one %s line in input file!'%(kw))
-						exit()
+					#(every dataset gets its own data block)
+					if current_kw=='dataset' :
+						if 'x_y_data_block' in found_kws and len(datasets)==0 :
+							raise ConfigError('every x/y data block needs a dataset line before it if there is more than one!')
+						break
+					if current_kw in found_kws and not (current_kw=='x_y_data_block' and awaiting_block) :
+						raise ConfigError('more than one %s line in input file!'%(kw))
+					found_kws.add(current_kw)
+					awaiting_block = False
 					break
 		#x_y_defs just has the one line after it to copy verbatim
 		elif current_kw=='x_y_defs' :
-			kwlinesdict[current_kw]=flsplit[:len(KW_FORMATS[current_kw])]
+			kwlinesdict[current_kw]=fl.split(',')[:len(KW_FORMATS[current_kw])]
 			if ( len(kwlinesdict[current_kw])!=len(KW_FORMATS[current_kw]) or
 				 kwlinesdict[current_kw].count('')!=0 or
 				 [kwl.startswith('##') for kwl in kwlinesdict[current_kw]].count(True)!=0 ) :
-				print('ERROR: x/y def keyword line %s is invalid!'%(kwlinesdict[current_kw]))
-				exit()
+				raise ConfigError('x/y def keyword line %s is invalid!'%(kwlinesdict[current_kw]))
 			current_kw=''
-		#x_y_data_block should have four floats added to it on each line
+		#fit_model has the name of the model in the first cell of the line after it
+		elif current_kw=='fit_model' :
+			kwlinesdict[current_kw]=fl.split(',')[0].strip()
+			if kwlinesdict[current_kw]=='' :
+				raise ConfigError('fit model line %s is invalid!'%(fl))
+			current_kw=''
+		#dataset has the label of the next dataset in the first cell of the line after it
+		elif current_kw=='dataset' :
+			label = fl.split(',')[0].strip()
+			if label=='' or label.startswith('##') :
+				raise ConfigError('dataset line %s is invalid!'%(fl))
+			if label in [ds[0] for ds in datasets] :
+				raise ConfigError('more than one dataset labeled %s in input file!'%(label))
+			if awaiting_block :
+				raise ConfigError('dataset %s has no x/y data block!'%(datasets[-1][0]))
+			datasets.append([label,0]); awaiting_block = True
+			current_kw=''
+		#shared_parameters has the short names of the shared parameters in the cells of the line after it
+		elif current_kw=='shared_parameters' :
+			kwlinesdict[current_kw]=[f.strip() for f in fl.split(',') if f.strip()!='']
+			current_kw=''
+		#aggregation has the mode in the first cell of the line after it and (optionally) the
+		#number of bins in the second
+		elif current_kw=='aggregation' :
+			kwlinesdict[current_kw]=get_aggregation_from_line(fl)
+			current_kw=''
+		#x_y_data_block should have four floats added to it on each line, converted in chunks
 		elif current_kw=='x_y_data_block' :
-			if current_kw not in kwlinesdict :
-				kwlinesdict[current_kw]=[]
-			newvalues = []
-			for k in range(len(KW_FORMATS[current_kw])) :
-				if flsplit[k]=='' : flsplit[k]=0.
-				try :
-					newvalues.append(float(flsplit[k]))
-				except ValueError :
-					print('ERROR: x/y data block line %s contains non-float value(s)!!'%(flsplit))
-			kwlinesdict[current_kw].append(newvalues)
-		i+=1
+			datalines.append(fl)
+			if len(datasets)>0 :
+				datasets[-1][1]+=1
+			if len(datalines)>=DATA_CHUNK_SIZE :
+				datachunks.append(get_values_from_data_block_lines(datalines))
+				datalines = []
+	if len(datalines)>0 :
+		datachunks.append(get_values_from_data_block_lines(datalines))
+	if len(datachunks)>0 :
+		kwlinesdict['x_y_data_block'] = np.concatenate(datachunks)
+	if len(datasets)>0 :
+		for label,size in datasets :
+			if size==0 :
+				raise ConfigError('dataset %s has no x/y datapoints!'%(label))
+		kwlinesdict['datasets'] = datasets
 	return kwlinesdict
 
-#returns list of fit-related lines in input csv file
+#returns the same dictionary get_keyword_dict_from_fitter_lines would for an input file with the
+#given x/y values and uncertainties (arrays, or None for no uncertainties), names, and fit model
+def get_keyword_dict_from_arrays(x_values,y_values,x_uncertainties=None,y_uncertainties=None,
+								 x_name='x',x_unit='',y_name='y',y_unit='',fit_model=None) :
+	x_values = np.asarray(x_values,dtype=np.float64).ravel()
+	y_values = np.asarray(y_values,dtype=np.float64).ravel()
+	columns = [x_values,x_uncertainties,y_values,y_uncertainties]
+	for i in [1,3] :
+		columns[i] = ( np.zeros(len(x_values)) if columns[i] is None else
+					   np.asarray(columns[i],dtype=np.float64).ravel() )
+	if len(set([len(c) for c in columns]))!=1 :
+		raise DataError("numbers of x,y points/uncertainties don't match!")
+	kwlinesdict = {'x_y_defs':[x_name,x_unit,y_name,y_unit],
+				   'x_y_data_block':np.column_stack(columns)}
+	if fit_model is not None :
+		kwlinesdict['fit_model'] = fit_model
+	return kwlinesdict
+
+#returns [mode,number of bins] from the line after an aggregation line
+def get_aggregation_from_line(fl) :
+	cells = [f.strip() for f in fl.split(',')]+['']
+	mode = cells[0].lower()
+	if mode not in AGGREGATION_MODES :
+		raise ConfigError('aggregation line %s is invalid (modes are %s)!'%(fl,AGGREGATION_MODES))
+	try :
+		nbins = int(cells[1]) if cells[1]!='' else DEFAULT_AGGREGATION_BINS
+	except ValueError :
+		raise ConfigError('aggregation line %s has an invalid number of bins!'%(fl))
+	if nbins<1 :
+		raise ConfigError('aggregation line %s has an invalid number of bins!'%(fl))
+	return [mode,nbins]
+
+#returns a 2D array of the four floats on each given x/y data block line (blank cells are zero)
+def get_values_from_data_block_lines(datalines) :
+	ncols = len(KW_FORMATS['x_y_data_block'])
+	#bulk-convert the whole chunk at once after filling in the blank cells with zeroes
+	text = '\n'+'\n'.join(datalines)+'\n'
+	text = text.replace(',,',',0,').replace(',,',',0,').replace('\n,','\n0,').replace(',\n',',0\n')
+	try :
+		return np.loadtxt(io.StringIO(text),delimiter=',',usecols=range(ncols),
+						  comments=None,ndmin=2)
+	except ValueError :
+		pass
+	#if that didn't work go line by line to find the bad one(s)
+	values = np.zeros((len(datalines),ncols))
+	for i,dl in enumerate(datalines) :
+		flsplit = dl.split(',')
+		#missing cells at the end of a line are blank
+		flsplit += ['']*(ncols-len(flsplit))
+		for k in range(ncols) :
+			if flsplit[k]=='' : flsplit[k]=0.
+			try :
+				values[i][k] = float(flsplit[k])
+			except ValueError :
+				raise DataError('x/y data block line %s contains non-float value(s)!!'%(flsplit))
+	return values
+
+#yields the fit-related lines in input csv file one at a time
 def get_fitter_lines_from_filepath(ifp) :
-	#open the input file and get its lines
-	rawinputfilelines = [line.rstrip() for line in open(ifp,'r').readlines()]
-	if len(rawinputfilelines)==1 and rawinputfilelines[0].count('\r')>0 :
-		rawinputfilelines = rawinputfilelines[0].split('\r')
-	#slice off the input lines up to the indicator line
-	fitterlines = []; i=0
-	for rifl in rawinputfilelines :
-		riflsplit = rifl.split(',')
-		if ( len(riflsplit)>=3 and 
+	#universal newlines mode also splits lines on lone '\r' characters
+	with open(ifp,'r') as fp :
+		#skip the input lines up to the indicator line
+		for line in fp :
+			if is_indicator_line(line) :
+				break
+		#then hand back every nonempty line after it
+		#(a second indicator line is an error, since the lines after the first one are already used)
+		for line in fp :
+			line = line.rstrip()
+			if is_indicator_line(line) :
+				raise ConfigError('input file %s has more than one friendly fit input indicator line!'%(ifp))
+			if line :
+				yield line
+
+#returns True if the given input file line is the friendly fit input indicator line
+def is_indicator_line(line) :
+	riflsplit = line.rstrip().split(',')
+	return ( len(riflsplit)>=3 and 
 			 len(riflsplit[0])==riflsplit[0].count('#') and 
 			 riflsplit[1].lower()=='friendly fit input' and
-			 len(riflsplit[2])==riflsplit[2].count('#') ) :
-			fitterlines = [l for l in rawinputfilelines[i+1:] if l]
-		else :
-			i+=1
-	return fitterlines
\ No newline at end of file
+			 len(riflsplit[2])==riflsplit[2].count('#') )
@@ -0,0 +1,370 @@
+###################################################################################################
+### This file contains the fitter daemon and its client functions for the FriendlyFitter package. #
+### copyright 2019/contact margaret.eminizer@gmail.com ############################################
+###################################################################################################
+
+#The daemon is a long-running process that keeps the package's modules imported and its caches
+#warm in a pool of worker processes, so small fits don't pay for starting python every time.
+#It listens on a Unix socket (or a localhost TCP port) for requests, one JSON object per line,
+#and answers each one with a JSON object on its own line with the same "id":
+#	{"id":1,"command":"fit","input":"/some/dir/data.csv"}
+#	{"id":2,"command":"fit","x":[...],"y":[...],"y_uncertainties":[...],"model":"linear"}
+#	{"id":3,"command":"run","input":"/some/dir/data.csv","output":"","tag":"","options":{...}}
+#	{"id":4,"command":"ping"}  /  {"id":5,"command":"shutdown"}
+#"fit" requests can also have "fit_type", "engine", "loss", "loss_scale", "sigma_clip", and
+#"aggregation" entries and answer with {"id":...,"ok":true,"result":{...FitResult dictionary...}};
+#"run" requests do everything run_fitter.py does for one input file (writing the output files
+#with default names in the "outputdir" of the options) and answer with whether it succeeded, the
+#output file name, the result, and the printout; their paths all have to be absolute, since the
+#daemon's workers don't know the client's directory. Anyone who can connect to the daemon can have
+#it read files, so it only listens on loopback addresses, its Unix socket is only open to the user
+#running it, and it only takes "run" requests (which write files) over its Unix socket.
+#Anything that goes wrong answers with {"id":...,"ok":false,"error":"..."}. Requests on the same
+#connection are worked on at the same time, so their answers can come back in any order.
+#The client functions at the bottom only need the standard library, so they start up quickly.
+
+#imports
+#(asyncio is only imported to serve, so a client doesn't have to import it)
+import os
+import sys
+import json
+import stat
+import socket
+import logging
+import tempfile
+from diagnostics import FriendlyFitterError, ConfigError, LOGGER_NAME, get_logger
+
+#constants
+#logger for the messages from this module
+logger = get_logger('daemon')
+#TCP port the daemon listens on by default where there are no Unix sockets
+DEFAULT_DAEMON_PORT = 47653
+#number of seconds a client waits to connect before deciding the daemon isn't running
+DAEMON_CONNECT_TIMEOUT = 0.5
+#longest request line the daemon reads (big enough for a few million inline datapoints)
+DAEMON_MAX_MESSAGE_BYTES = 2**28
+#commands the daemon understands
+DAEMON_COMMANDS = ['fit','run','ping','shutdown']
+#the array entries of a fit request, in the order fit_arrays takes them
+FIT_REQUEST_ARRAYS = ['x','y','x_uncertainties','y_uncertainties']
+#the other entries of a fit request, and the fit_arrays/fit_file arguments they go to
+FIT_REQUEST_OPTIONS = {'fit_type':'fit_type','model':'model','engine':'engine','loss':'loss',
+					   'loss_scale':'loss_scale','sigma_clip':'sigma_clip','aggregation':'aggregation'}
+
+#each worker process's caches (made the first time a worker needs them)
+_worker_caches = {}
+
+#Daemon functions
+#serve fit requests at the given address (a Unix socket path, or host:port) until a shutdown
+#request comes in, fitting in a pool of the given number of worker processes that cache parsed
+#input files and fit results in cachedir (if it's given)
+def serve(address=None,workers=1,cachedir=None) :
+	import asyncio
+	asyncio.run(_serve_(address if address!=None else get_default_address(),workers,cachedir))
+
+async def _serve_(address,workers,cachedir) :
+	import asyncio
+	from concurrent.futures import ProcessPoolExecutor
+	host, port = parse_address(address)
+	if host==None :
+		_prepare_socket_path_(address)
+	executor = ProcessPoolExecutor(max_workers=workers)
+	loop = asyncio.get_running_loop()
+	#import everything in every worker right away so the first fits are fast too
+	await asyncio.gather(*[loop.run_in_executor(executor,_warm_up_worker_,cachedir) for i in range(workers)])
+	stopping = asyncio.Event()
+	#("run" requests write files, so they're only taken over the Unix socket, which only the user
+	# running the daemon can connect to)
+	handler = lambda reader, writer : _handle_connection_(reader,writer,executor,cachedir,stopping,host==None)
+	if host==None :
+		#(the socket is made with no permissions for anyone else from the start)
+		oldumask = os.umask(0o177)
+		try :
+			server = await asyncio.start_unix_server(handler,path=address,limit=DAEMON_MAX_MESSAGE_BYTES)
+		finally :
+			os.umask(oldumask)
+	else :
+		server = await asyncio.start_server(handler,host=host,port=port,limit=DAEMON_MAX_MESSAGE_BYTES)
+	logger.info('Fitter daemon (process %d) listening at %s with %d worker(s)',os.getpid(),address,workers)
+	try :
+		async with server :
+			await stopping.wait()
+	finally :
+		executor.shutdown(wait=True)
+		if host==None and _is_socket_(address) :
+			os.unlink(address)
+	logger.info('Fitter daemon at %s shut down',address)
+
+#read request lines from one connection and answer each one when it's done
+async def _handle_connection_(reader,writer,executor,cachedir,stopping,allowrun) :
+	import asyncio
+	tasks = set()
+	try :
+		while not stopping.is_set() :
+			line = await reader.readline()
+			if not line :
+				break
+			task = asyncio.ensure_future(_answer_request_(line,writer,executor,cachedir,stopping,allowrun))
+			tasks.add(task)
+			task.add_done_callback(tasks.discard)
+		if len(tasks)>0 :
+			await asyncio.gather(*tasks)
+	except (ConnectionError,ValueError) as e :
+		#(a connection dropped partway, or a request line that's too long)
+		logger.warning('dropped a daemon connection: %s',e)
+	except asyncio.CancelledError :
+		#(the daemon is shutting down while this connection is still open)
+		pass
+	finally :
+		writer.close()
+
+#work out the answer to one request line and write it back
+async def _answer_request_(line,writer,executor,cachedir,stopping,allowrun) :
+	import asyncio
+	request = {}
+	try :
+		request = json.loads(line)
+		if not isinstance(request,dict) or request.get('command') not in DAEMON_COMMANDS :
+			raise ConfigError('daemon requests need a command out of %s!'%(DAEMON_COMMANDS))
+		if request['command']=='ping' :
+			response = {'ok':True,'pid':os.getpid()}
+		elif request['command']=='run' and not allowrun :
+			raise ConfigError('"run" requests write files, so the daemon only takes them over its Unix socket!')
+		elif request['command']=='shutdown' :
+			response = {'ok':True}
+			stopping.set()
+		else :
+			function = run_fit_request if request['command']=='fit' else run_fitter_request
+			response = await asyncio.get_running_loop().run_in_executor(executor,function,request,cachedir)
+	except Exception as e :
+		response = {'ok':False,'error':_describe_error_(e)}
+	response['id'] = request.get('id') if isinstance(request,dict) else None
+	writer.write((json.dumps(response)+'\n').encode('utf-8'))
+	await writer.drain()
+
+#do a "fit" request in a worker process, returning the answer
+def run_fit_request(request,cachedir=None) :
+	import api
+	configcache, resultcache = _get_worker_caches_(cachedir)
+	kwargs = dict([(arg,request[key]) for key,arg in FIT_REQUEST_OPTIONS.items() if request.get(key)!=None])
+	try :
+		if request.get('input')!=None :
+			if 'aggregation' in kwargs :
+				raise ConfigError('aggregate the datapoints of an input file with its aggregation line instead!')
+			if 'model' in kwargs :
+				raise ConfigError('choose the model of an input file with its fit model line instead!')
+			result = api.fit_file(request['input'],cache=configcache,resultcache=resultcache,**kwargs)
+		elif request.get('x')!=None and request.get('y')!=None :
+			result = api.fit_arrays(*[request.get(key) for key in FIT_REQUEST_ARRAYS],
+									resultcache=resultcache,**kwargs)
+		else :
+			raise ConfigError('fit requests need an input file path or x and y arrays!')
+	except Exception as e :
+		return {'ok':False,'error':_describe_error_(e)}
+	return {'ok':True,'result':result.toDict()}
+
+#do a "run" request in a worker process like run_fitter.py would, returning the answer
+def run_fitter_request(request,cachedir=None) :
+	from run_fitter import run_fit_safely
+	try :
+		options = request.get('options',{})
+		#(the workers don't know the client's directory, so every path has to be absolute)
+		required = [request.get('input'),options.get('outputdir')]
+		optional = [p for p in [request.get('output'),options.get('cachedir')] if p]
+		if not all([isinstance(p,str) and os.path.isabs(p) for p in required+optional]) :
+			raise ConfigError('run requests need absolute input, output, outputdir, and cachedir paths!')
+		inputfilepath, success, outfilename, resultdict, printout = run_fit_safely(request['input'],
+																				  request.get('output',''),
+																				  request.get('tag',''),
+																				  options)
+	except Exception as e :
+		return {'ok':False,'error':_describe_error_(e)}
+	finally :
+		_quiet_worker_logging_()
+	return {'ok':True,'success':success,'output_file':outfilename,'result':resultdict,'printout':printout}
+
+#import the slow modules (and make the caches) in a worker process ahead of time
+def _warm_up_worker_(cachedir) :
+	import api, run_fitter, plotting
+	import scipy.optimize
+	import matplotlib.figure, matplotlib.backends.backend_agg
+	_get_worker_caches_(cachedir)
+	_quiet_worker_logging_()
+	return os.getpid()
+
+#only let warnings from the fits in a worker process through to the daemon's console (the
+#messages of "run" requests are captured in their printouts instead)
+def _quiet_worker_logging_() :
+	logging.getLogger(LOGGER_NAME).setLevel(logging.WARNING)
+
+#returns the ConfigCache and ResultCache of this worker process (None if there's no cachedir)
+def _get_worker_caches_(cachedir) :
+	if cachedir==None :
+		return None, None
+	if cachedir not in _worker_caches :
+		from cache import ConfigCache, ResultCache
+		_worker_caches[cachedir] = (ConfigCache(cachedir),ResultCache(os.path.join(cachedir,'results')))
+	return _worker_caches[cachedir]
+
+#returns the message sent back for an error
+def _describe_error_(e) :
+	return str(e) if isinstance(e,FriendlyFitterError) else '%s: %s'%(type(e).__name__,e)
+
+#makes sure the daemon can listen on a Unix socket at the given path: the default socket's
+#directory has to be private to the user (it's made that way if it isn't there yet), and
+#anything already at the path has to be a socket left behind by a daemon that died
+def _prepare_socket_path_(address) :
+	directory = os.path.dirname(os.path.abspath(address))
+	if not os.path.isdir(directory) :
+		os.makedirs(directory,mode=0o700,exist_ok=True)
+	if address==get_default_address() and hasattr(os,'getuid') :
+		st = os.stat(directory)
+		if st.st_uid!=os.getuid() or st.st_mode&0o077 :
+			raise ConfigError('directory %s of the daemon socket has to belong to you alone!'%(directory))
+	if not os.path.lexists(address) :
+		return
+	if not _is_socket_(address) :
+		raise ConfigError('%s already exists and is not a socket, so the daemon will not listen there!'%(address))
+	if is_daemon_running(address) :
+		raise ConfigError('a fitter daemon is already running at '+address+'!')
+	os.unlink(address)
+
+#returns True if there's a Unix socket (not any other kind of file) at the given path
+def _is_socket_(path) :
+	try :
+		return stat.S_ISSOCK(os.lstat(path).st_mode)
+	except OSError :
+		return False
+
+# file-scope functions
+#returns the address the daemon listens at by default: a Unix socket in the user's private
+#runtime directory (or in a directory of their own in the temporary directory), or a localhost
+#port where there are no Unix sockets
+def get_default_address() :
+	if hasattr(socket,'AF_UNIX') :
+		if os.environ.get('XDG_RUNTIME_DIR') :
+			return os.path.join(os.environ['XDG_RUNTIME_DIR'],'friendlyfitter.sock')
+		user = os.getuid() if hasattr(os,'getuid') else os.environ.get('USERNAME','user')
+		return os.path.join(tempfile.gettempdir(),'friendlyfitter-%s'%(user),'daemon.sock')
+	return '127.0.0.1:%d'%(DEFAULT_DAEMON_PORT)
+
+#returns (host,port) for a host:port address, or (None,None) for a Unix socket path
+#(the host has to be a loopback address like localhost, 127.0.0.1, or [::1])
+def parse_address(address) :
+	host, sep, port = address.rpartition(':')
+	if sep!='' and port.isdigit() and os.sep not in port :
+		host = host.strip('[]') if host!='' else '127.0.0.1'
+		if not is_loopback_host(host) :
+			raise ConfigError('the fitter daemon only listens on this machine, so the host of %s '%(address)+
+							  'has to be a loopback address like 127.0.0.1!')
+		return host, int(port)
+	return None, None
+
+#returns True if the given host name or IP address is this machine's loopback interface
+def is_loopback_host(host) :
+	import ipaddress
+	if host.lower()=='localhost' :
+		return True
+	try :
+		return ipaddress.ip_address(host).is_loopback
+	except ValueError :
+		return False
+
+#returns a socket connected to the daemon at the given address (raising an OSError like
+#ConnectionRefusedError or FileNotFoundError if nothing is listening there, or PermissionError
+#if the Unix socket there belongs to somebody else)
+def connect_to_daemon(address=None,timeout=DAEMON_CONNECT_TIMEOUT) :
+	address = address if address!=None else get_default_address()
+	host, port = parse_address(address)
+	if host==None :
+		if hasattr(os,'getuid') and os.stat(address).st_uid!=os.getuid() :
+			raise PermissionError('the socket at %s belongs to another user'%(address))
+		sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+		sock.settimeout(timeout)
+		try :
+			sock.connect(address)
+		except OSError :
+			sock.close()
+			raise
+	else :
+		sock = socket.create_connection((host,port),timeout=timeout)
+	#(fits can take as long as they take once connected)
+	sock.settimeout(None)
+	return sock
+
+#returns True if a daemon answers at the given address
+def is_daemon_running(address=None) :
+	try :
+		return send_requests([{'command':'ping'}],address)[0].get('ok',False)
+	except (OSError,ValueError) :
+		return False
+
+#sends a list of request dictionaries to the daemon over one connection and returns the list of
+#answers in the same order (the ids are set here)
+def send_requests(requests,address=None) :
+	requests = [dict(r,id=i) for i,r in enumerate(requests)]
+	with connect_to_daemon(address) as sock, sock.makefile('rwb') as fp :
+		for request in requests :
+			fp.write((json.dumps(request)+'\n').encode('utf-8'))
+		fp.flush()
+		answers = {}
+		while len(answers)<len(requests) :
+			line = fp.readline()
+			if not line :
+				raise ConnectionError('the fitter daemon closed the connection before answering')
+			answer = json.loads(line)
+			answers[answer.get('id')] = answer
+	return [answers[r['id']] for r in requests]
+
+#asks the daemon to fit the given x/y values and uncertainties (lists or arrays, None for none)
+#and returns the dictionary of the FitResult, raising a FitError with the daemon's message if it
+#didn't work (options are the other entries of a fit request, like model='exponential')
+def request_fit(x_values,y_values,x_uncertainties=None,y_uncertainties=None,address=None,**options) :
+	request = {'command':'fit'}
+	for key,values in zip(FIT_REQUEST_ARRAYS,[x_values,y_values,x_uncertainties,y_uncertainties]) :
+		if values is not None :
+			request[key] = values.tolist() if hasattr(values,'tolist') else list(values)
+	request.update(options)
+	return _get_result_(send_requests([request],address)[0])
+
+#asks the daemon to fit an input file and returns the dictionary of the FitResult
+def request_file_fit(inputfilepath,address=None,**options) :
+	request = dict(options,command='fit',input=os.path.abspath(inputfilepath))
+	return _get_result_(send_requests([request],address)[0])
+
+#returns the result of an answer to a fit request, or raises a FitError with its message
+def _get_result_(answer) :
+	if not answer.get('ok',False) :
+		from diagnostics import FitError
+		raise FitError('fitter daemon: '+answer.get('error','unknown error'))
+	return answer['result']
+
+#Main script
+if __name__=='__main__' :
+	from optparse import OptionParser
+	from diagnostics import configure_console_logging
+	parser = OptionParser()
+	parser.add_option('-A','--address', type='string', action='store', dest='address', default=None,
+					  help='Unix socket path or host:port to listen at (%s by default)'%(get_default_address()))
+	parser.add_option('-j','--workers', type='int', action='store', dest='workers', default=1,
+					  help='Number of worker processes to fit in')
+	parser.add_option('--cacheDir', type='string', action='store', dest='cachedir', default=None,
+					  help='Directory to cache parsed input files and fit results in (no caching if not given)')
+	parser.add_option('--stop', action='store_true', dest='stop', default=False,
+					  help='Stop the daemon running at the address instead of starting one')
+	(options, args) = parser.parse_args()
+	configure_console_logging()
+	if options.stop :
+		try :
+			send_requests([{'command':'shutdown'}],options.address)
+			print('Stopped the fitter daemon')
+		except OSError :
+			print('No fitter daemon is running there')
+		sys.exit(0)
+	try :
+		serve(options.address,options.workers,options.cachedir)
+	except (FriendlyFitterError,OSError) as e :
+		print('ERROR: '+str(e))
+		sys.exit(1)
+	except KeyboardInterrupt :
+		pass
@@ -4,44 +4,74 @@
 ###################################################################################################
 
 #imports
+import logging
 import numpy as np
+from diagnostics import get_logger
+from profiling import NULL_PROFILER
+
+#constants
+#logger for the messages from this module
+logger = get_logger('datasets')
 
 #Data classes
 
 #LinearData class: x-y data that will be fit with a line
+#values, uncertainties, and weights are held as contiguous float64 columns, with an optional
+#boolean mask of the datapoints used in the fit (like the ones left after sigma clipping)
+#(the weight calculation is timed as its own stage by the profiler, if one is given)
 class LinearData(object) :
 
-	def __init__(self,x_name,x_unit,y_name,y_unit,n_points,x_values,y_values) :
+	def __init__(self,x_name,x_unit,y_name,y_unit,n_points,x_values,y_values,profiler=NULL_PROFILER) :
 		#copy info over
 		self._x_name = x_name
 		self._x_unit = x_unit
 		self._y_name = y_name
 		self._y_unit = y_unit
 		self._n_points = n_points
-		#start with a list of datapoints holding just the values
-		self._data_points = []
+		self._profiler = profiler
+		#start with columns holding just the values (no uncertainties, equal weights)
+		self._x,self._y = None,None
+		self._x_unc,self._y_unc = None,None
+		self._weights = None
+		self._mask = None
 		self._initialize_data_point_values_(x_values,y_values)
 
 	def firstpoint(self) :
-		return self._data_points[0]
+		return self.dataPoint(0)
 	def lastpoint(self) :
-		return self._data_points[self._n_points-1]
+		return self.dataPoint(self._n_points-1)
+	def dataPoint(self,i) :
+		#DataPoint objects are only built on demand
+		return DataPoint(i,float(self._x[i]),float(self._y[i]),float(self._x_unc[i]),
+						 float(self._y_unc[i]),float(self._weights[i]))
+	def dataPoints(self) :
+		return [self.dataPoint(i) for i in range(self._n_points)]
 	def n_points(self) :
 		return self._n_points
 	def xArray(self) :
-		return np.array([dp.x() for dp in self._data_points])
+		return self._x
 	def yArray(self) :
-		return np.array([dp.y() for dp in self._data_points])
+		return self._y
 	def xErrArray(self) :
-		return np.array([dp.xunc() for dp in self._data_points])
+		return self._x_unc
 	def yErrArray(self) :
-		return np.array([dp.yunc() for dp in self._data_points])
+		return self._y_unc
 	def weightArray(self) :
-		return np.array([dp.weight() for dp in self._data_points])
+		return self._weights
+	#mask of the datapoints used in the fit (None if they all are)
+	def mask(self) :
+		return self._mask
+	def setMask(self,mask) :
+		self._mask = None if mask is None or np.all(mask) else np.ascontiguousarray(mask,dtype=bool)
+	def nUsed(self) :
+		return self._n_points if self._mask is None else int(self._mask.sum())
+	#returns a column with only the datapoints used in the fit (the column itself if they all are)
+	def usedOnly(self,column) :
+		return column if self._mask is None else column[self._mask]
 	def xMin(self) :
-		return min([dp.x() for dp in self._data_points])
+		return self._x.min()
 	def xMax(self) :
-		return max([dp.x() for dp in self._data_points])
+		return self._x.max()
 	def xAxisLabel(self) :
 		return self._x_name+' ['+self._x_unit+']'
 	def yAxisLabel(self) :
@@ -49,42 +79,38 @@ class LinearData(object) :
 
 	#set the normalized weight for each datapoint
 	def _set_datapoint_weights_(self) :
-		unnormalized_weights = []
-		for i in range(self._n_points) :
-			#calculate total variance at each point by summing fractional x/y errors in quadrature
-			x_var = (self._data_points[i].xunc()/self._data_points[i].x())**2
-			y_var = (self._data_points[i].yunc()/self._data_points[i].y())**2
-			#unnormalized weight is 1/variance if there are errors, or 1. otherwise
-			if x_var!=0. or y_var!=0. :
-				unnormalized_weights.append(1./(x_var+y_var))
+		with self._profiler.stage('weights') :
+			self._calculate_datapoint_weights_()
+	def _calculate_datapoint_weights_(self) :
+		unnormalized_weights = get_unnormalized_weights(self._x,self._y,self._x_unc,self._y_unc)
+		#(checking the weights takes a pass over the data, so it's skipped if nobody's listening)
+		if logger.isEnabledFor(logging.INFO) :
+			if np.all(unnormalized_weights==1.) :
+				logger.info('		Setting all datapoint weights equal')
 			else :
-				unnormalized_weights.append(1.)
-		if unnormalized_weights.count(1.)==len(unnormalized_weights) :
-			print('		Setting all datapoint weights equal')
-		else :
-			print('		Setting unique datapoint weights')
-		#normalize by sum of weights and set datapoint weight
-		sumunnormalizedweights=sum(unnormalized_weights)
-		for i in range(self._n_points) :
-			self._data_points[i].setWeight(unnormalized_weights[i]/sumunnormalizedweights)
+				logger.info('		Setting unique datapoint weights')
+		#normalize by sum of weights and set datapoint weights
+		self._weights = _as_column_(unnormalized_weights/unnormalized_weights.sum())
 	def _add_datapoint_x_errors_(self,x_uncertainties) :
-		print('		Adding x uncertainties')
-		for i in range(self._n_points) :
-			self._data_points[i].setXUnc(x_uncertainties[i])
+		logger.info('		Adding x uncertainties')
+		self._x_unc = _as_column_(x_uncertainties,self._n_points)
 	def _add_datapoint_y_errors_(self,y_uncertainties) :
-		print('		Adding y uncertainties')
-		for i in range(self._n_points) :
-			self._data_points[i].setYUnc(y_uncertainties[i])
+		logger.info('		Adding y uncertainties')
+		self._y_unc = _as_column_(y_uncertainties,self._n_points)
 	def _initialize_data_point_values_(self,x_values,y_values) :
-		print('		Initializing a linear x-y dataset with '+str(self._n_points)+' values')
-		for i in range(self._n_points) :
-			self._data_points.append(DataPoint(i,x_values[i],y_values[i]))
+		logger.info('		Initializing a linear x-y dataset with %d values',self._n_points)
+		self._x = _as_column_(x_values,self._n_points)
+		self._y = _as_column_(y_values,self._n_points)
+		self._x_unc = np.zeros(self._n_points)
+		self._y_unc = np.zeros(self._n_points)
+		self._weights = np.ones(self._n_points)
 
 #LinearData with Y Error bars
 class LinearDataYErrors(LinearData) :
 
-	def __init__(self,x_name,x_unit,y_name,y_unit,n_points,x_values,y_values,y_uncertainties) :
-		LinearData.__init__(self,x_name,x_unit,y_name,y_unit,n_points,x_values,y_values)
+	def __init__(self,x_name,x_unit,y_name,y_unit,n_points,x_values,y_values,y_uncertainties,
+				 profiler=NULL_PROFILER) :
+		LinearData.__init__(self,x_name,x_unit,y_name,y_unit,n_points,x_values,y_values,profiler)
 		self._add_datapoint_y_errors_(y_uncertainties)
 		self._set_datapoint_weights_()
 
@@ -92,13 +118,13 @@ class LinearDataYErrors(LinearData) :
 class LinearDataXYErrors(LinearData) :
 
 	def __init__(self,x_name,x_unit,y_name,y_unit,n_points,x_values,y_values,
-				 x_uncertainties,y_uncertainties) :
-		LinearData.__init__(self,x_name,x_unit,y_name,y_unit,n_points,x_values,y_values)
+				 x_uncertainties,y_uncertainties,profiler=NULL_PROFILER) :
+		LinearData.__init__(self,x_name,x_unit,y_name,y_unit,n_points,x_values,y_values,profiler)
 		self._add_datapoint_x_errors_(x_uncertainties)
 		self._add_datapoint_y_errors_(y_uncertainties)
 		self._set_datapoint_weights_()
 
-#DataPoint class
+#DataPoint class (built on demand from the LinearData columns)
 class DataPoint(object) :
 
 	def __init__(self,n,x,y,x_unc=0.,y_unc=0.,weight=1.) :
@@ -124,3 +150,21 @@ class DataPoint(object) :
 		self._y_unc=yunc
 	def setWeight(self,weight) :
 		self._weight = weight
+
+# file-scope functions
+#returns the unnormalized weight of each datapoint given (arrays of) values and uncertainties
+def get_unnormalized_weights(x_values,y_values,x_uncertainties,y_uncertainties) :
+	with np.errstate(divide='ignore',invalid='ignore') :
+		#calculate total variance at each point by summing fractional x/y errors in quadrature
+		#(points without an uncertainty don't add to the variance, even if their value is zero)
+		tot_var = ( np.where(x_uncertainties!=0.,(x_uncertainties/x_values)**2,0.)+
+					np.where(y_uncertainties!=0.,(y_uncertainties/y_values)**2,0.) )
+		#unnormalized weight is 1/variance if there are errors, or 1. otherwise
+		return np.where(tot_var!=0.,1./tot_var,1.)
+
+#returns a contiguous float64 column for the given values (without copying if possible)
+def _as_column_(values,n_points=None) :
+	column = np.ascontiguousarray(values,dtype=np.float64)
+	if n_points!=None :
+		column = column[:n_points]
+	return column
@@ -0,0 +1,76 @@
+###################################################################################################
+### This file contains the exception classes and logging setup for the FriendlyFitter package. ###
+### copyright 2019/contact margaret.eminizer@gmail.com ############################################
+###################################################################################################
+
+#imports
+import sys
+import logging
+
+#constants
+#name of the logger all the package's diagnostics go through (each module logs to a child of it)
+LOGGER_NAME = 'friendlyfitter'
+
+#Exception classes (everything that goes wrong in the package raises one of these instead of
+#exiting, so a program using the package can catch them)
+
+#FriendlyFitterError: base class for all of the package's errors
+class FriendlyFitterError(Exception) :
+	pass
+
+#ConfigError: an input file or fit configuration/option that can't be used
+class ConfigError(FriendlyFitterError) :
+	pass
+
+#DataError: datapoints or arrays that can't be fit (mismatched lengths and such)
+class DataError(FriendlyFitterError) :
+	pass
+
+#ModelError: a fit model that doesn't exist or can't be registered
+class ModelError(FriendlyFitterError) :
+	pass
+
+#FitError: a fit that can't be set up or that failed to minimize
+class FitError(FriendlyFitterError) :
+	pass
+
+#ConsoleHandler class: logging handler writing to whatever sys.stdout is when each message comes
+#in (so redirecting stdout captures the messages too, like it would for print statements)
+class ConsoleHandler(logging.StreamHandler) :
+
+	@property
+	def stream(self) :
+		return sys.stdout
+	@stream.setter
+	def stream(self,value) :
+		pass
+
+#ConsoleFormatter class: messages are written as-is, with anything more serious than INFO
+#labeled by its level (like "WARNING: ...")
+class ConsoleFormatter(logging.Formatter) :
+
+	def format(self,record) :
+		message = record.getMessage()
+		if record.levelno>logging.INFO :
+			message = record.levelname+': '+message
+		return message
+
+# file-scope functions
+#returns the logger for a module of the package
+def get_logger(modulename) :
+	return logging.getLogger(LOGGER_NAME).getChild(modulename)
+
+#send the package's messages to the console (stdout) at the given level, like the command line
+#script does (calling it again just changes the level)
+def configure_console_logging(level=logging.INFO) :
+	logger = logging.getLogger(LOGGER_NAME)
+	logger.setLevel(level)
+	if not any([isinstance(h,ConsoleHandler) for h in logger.handlers]) :
+		handler = ConsoleHandler()
+		handler.setFormatter(ConsoleFormatter())
+		logger.addHandler(handler)
+	#(don't pass messages on to the root logger too)
+	logger.propagate = False
+
+#a program importing the package doesn't see any messages unless it sets up logging itself
+logging.getLogger(LOGGER_NAME).addHandler(logging.NullHandler())
@@ -4,86 +4,350 @@
 ###################################################################################################
 
 #imports
-from scipy import optimize
+#(scipy and matplotlib are slow to import, so they're only imported where they're needed)
+import os
 import numpy as np
-import matplotlib.pyplot as plt
 from datasets import LinearData, LinearDataYErrors, LinearDataXYErrors
 from parameter import ParameterList
+from models import get_model
+from result import FitResult
+from diagnostics import ConfigError, FitError, get_logger
+from profiling import NULL_PROFILER
+from scans import DEFAULT_SCAN_POINTS, DEFAULT_SCAN_REFINEMENTS, PROFILE_DELTA_CHI2
+
+#constants
+#logger for the messages from this module
+logger = get_logger('fit')
+#fit types that fit a model (a line by default) to x-y data
+LINEAR_FIT_TYPES = ['linear_least_squares','linear_least_squares_y_weighted',
+					'linear_least_squares_weighted','linear_errors_in_variables']
+#minimizer engines that can be selected for a fit, with the fit types each one can do
+#(None meaning any fit type)
+ENGINES = {'analytic':['linear_least_squares','linear_least_squares_y_weighted'],
+		   'york':['linear_errors_in_variables'],
+		   'leastsq':None,
+		   'least_squares':None}
+#fit types with an exact closed-form (weighted normal equations) solution
+ANALYTIC_FIT_TYPES = ENGINES['analytic']
+#engines that only work for fitting a line
+LINEAR_MODEL_ENGINES = ['analytic','york']
+#engine used for each fit type if none is chosen (and the model is linear)
+DEFAULT_ENGINES = {'linear_least_squares':'analytic',
+				   'linear_least_squares_y_weighted':'analytic',
+				   'linear_least_squares_weighted':'leastsq',
+				   'linear_errors_in_variables':'york'}
+#loss functions that can be minimized instead of the plain sum of squared residuals, as the
+#function rho(z) of each squared residual z (all of them go like z for small residuals, and the
+#robust ones grow more slowly for big ones, so a few bad points can't drag the fit around)
+LOSS_FUNCTIONS = {'linear':lambda z : z,
+				  'huber':lambda z : np.where(z<=1.,z,2.*np.sqrt(z)-1.),
+				  'soft_l1':lambda z : 2.*(np.sqrt(1.+z)-1.),
+				  'cauchy':lambda z : np.log1p(z)}
+#engine used for the robust losses and simultaneous fits of several datasets (the only one that
+#can do them)
+LEAST_SQUARES_ENGINE = 'least_squares'
+#if no scale is given, residuals bigger than this many robust standard deviations (from the
+#median absolute deviation of the residuals) are the ones that are down-weighted by the robust
+#losses (Huber's usual tuning constant); the scale starts from the plain least squares residuals
+#and is re-estimated from the robust fit's residuals until it changes by less than the tolerance
+ROBUST_LOSS_SIGMAS = 1.345
+ROBUST_SCALE_TOLERANCE = 0.01
+ROBUST_SCALE_MAX_ITERATIONS = 10
+#converts a median absolute deviation to a standard deviation for normally-distributed residuals
+MAD_TO_SIGMA = 1.4826
+#default number of robust standard deviations from the fit beyond which sigma clipping rejects
+#datapoints, and the most fit/reject passes it does before giving up on converging
+SIGMA_CLIP_NSIGMA = 3.
+SIGMA_CLIP_MAX_ITERATIONS = 10
+#relative step size and tolerance used to check analytic Jacobians against finite differences
+JACOBIAN_CHECK_STEP = 1e-6
+JACOBIAN_CHECK_TOLERANCE = 1e-4
+#convergence tolerance and maximum number of iterations for York regression
+YORK_TOLERANCE = 1e-12
+YORK_MAX_ITERATIONS = 100
 
 #Fit class
 class Fit(object) :
 
-	#initialize from configuration object
-	def __init__(self, config) :
+	#initialize from configuration object (and optionally the minimizer engine to use, a
+	#Profiler to record the time/memory of each stage and the numbers of function evaluations,
+	#a robust loss function from LOSS_FUNCTIONS with the size of the residuals where it
+	#starts down-weighting them (chosen from the data if not given), and a ResultCache to load
+	#the results of fits that were already done from, and warm-start changed ones with)
+	def __init__(self, config, engine=None, profiler=None, loss='linear', loss_scale=None,
+				 resultcache=None) :
 		#set everything to None or empty to begin
 		self._data=None
+		self._engine=engine
+		self._loss=loss
+		self._loss_scale=loss_scale
+		self._profiler=profiler if profiler!=None else NULL_PROFILER
+		self._resultcache=resultcache
 		self._parameters=ParameterList()
-		self._fit_function=None
+		self._model=None
+		self._fit_function, self._fit_jacobian=None,None
+		#parameter values the minimizer starts from (the initial values unless warm-started)
+		self._start_parameters_list=None
 		self._resid_function, self._resid_function_args=None,None
+		self._resid_jacobian=None
+		#for simultaneous fits of several datasets: the dataset number of every datapoint, and the
+		#position in the parameter list of each model parameter for each dataset (one row each)
+		self._dataset_index, self._parameter_index=None,None
+		self._result=None
+		#Chi2Scan of two of the parameters (None if no scan was run for the current result)
+		self._scan=None
 		#copy the configuration
 		self._config = config
 		#make the data objects from the config
-		self._populate_data_object_from_config_()
+		with self._profiler.stage('data') :
+			self._populate_data_object_from_config_()
+		#get the model to fit from the registry
+		self._model = get_model(self._config.fit_model())
+		#reduce the data to a compact summary of bins if the input asks for it
+		if self._config.aggregation()!=None :
+			with self._profiler.stage('aggregation') :
+				self._aggregate_data_()
 		#make the list of parameters from the config and the data object
 		self._make_parameterlist_from_config_and_data_()
 		#set the fit function
 		self._set_fit_function_and_params_()
 		#set the residuals function
 		self._set_resid_function_and_args_()
+		#choose the minimizer engine
+		self._set_engine_()
 
 	#public functions
 	#run the minimizer for the fit
 	def minimize(self) :
-		#run leastsq 
-		pfit, pcov, infodict, errmsg, success = optimize.leastsq(self._resid_function, 
-																 self._initial_parameters_list, 
-																 args=self._resid_function_args,
-																 full_output=True)
-		#crash if the fit failed
-		if success not in range(1,5) :	
-			print('		Fit failed. Message: '+errmsg)
-			exit()
-		print('		Fit success; returned with flag '+str(success))
-		print('		Fit function evaluated '+str(infodict['nfev'])+' times')
-		print('		Final total residual value: '+str(infodict['fvec'].sum()))
-		#calculate parameter uncertainties
-		s_sq = (infodict['fvec']**2).sum()/(self._data.n_points()-len(pfit))
-		pcov *= s_sq
-		perrors = [] 
-		for i in range(len(pfit)):
-			try:
-			  perrors.append(np.absolute(pcov[i][i])**0.5)
-			except:
-			  perrors.append( 0.00 )
-		#set postfit parameter values/uncertainties
-		self._parameters.setParametersPostfit(pfit,perrors)
+		#if this exact fit is in the result cache, just use its result
+		cachekey = self._get_result_cache_key_() if self._resultcache!=None else None
+		if cachekey!=None :
+			cached = self._resultcache.load(cachekey)
+			if cached!=None :
+				self._profiler.count('result_cache_hits')
+				self._set_result_(cached)
+				return
+		#otherwise start from the latest best fit values of the same kind of fit, if there are some
+		self._start_parameters_list = self._initial_parameters_list
+		if self._resultcache!=None :
+			warmvalues = self._resultcache.loadWarmStart(self._get_warm_start_key_(),
+														 self._parameters.shortnameList())
+			if warmvalues!=None :
+				logger.info('		Warm-starting the minimizer from the best fit values of a previous fit')
+				self._start_parameters_list = warmvalues
+		#get the best fit parameters, their covariance matrix, and the final residuals
+		with self._profiler.stage('minimization') :
+			if self._engine=='analytic' :
+				pfit, pcov, fvec = self._solve_analytically_()
+			elif self._engine=='york' :
+				pfit, pcov, fvec = self._run_york_regression_()
+			elif self._engine=='least_squares' :
+				pfit, pcov, fvec = self._run_least_squares_()
+			else :
+				pfit, pcov, fvec = self._run_leastsq_()
+		if self._profiler.isEnabled() :
+			minimization = self._profiler.stages()['minimization']
+			logger.info('		Minimization took %.6f s (%.6f s CPU)',minimization['wall_s'],minimization['cpu_s'])
+		#calculate parameter uncertainties (leastsq has no covariance matrix if it's singular)
+		#(aggregated datapoints count with the chi2 from inside their bins, and as themselves)
+		aggregation = self._data.summary(pfit) if self._config.aggregation()!=None else None
+		if aggregation!=None :
+			s_sq = ((fvec**2).sum()+aggregation['chi2_offset'])/(aggregation['n_points']-len(pfit))
+		else :
+			s_sq = (fvec**2).sum()/(len(fvec)-len(pfit))
+		if pcov is None :
+			logger.warning('covariance matrix could not be estimated; uncertainties set to 0')
+			pcov = np.zeros((len(pfit),len(pfit)))
+		pcov = pcov*s_sq
+		#keep everything that came out of the fit
+		self._set_result_(FitResult(self._parameters.shortnameList(),pfit,pcov,fvec,
+									self._data.usedOnly(self._data.yArray())-self._fit_at_datapoints_(pfit,True),
+									self._config.fit_type(),self._model.name(),self._engine,
+									self._loss,self._data.mask(),aggregation))
+		if cachekey!=None :
+			self._resultcache.store(cachekey,self._result,self._get_warm_start_key_())
+
+	#iteratively reject the datapoints further than nsigma robust standard deviations (from the
+	#median absolute deviation) of the residuals over their uncertainties (or of the plain
+	#residuals if there aren't any) from the fit and refit with the rest, until the
+	#rejected points stop changing (points can come back if the fit moves towards them) or
+	#maxiters passes are done; each pass is one vectorized pass over all the datapoints plus a
+	#refit, and the rejected datapoints are only masked off, never removed from the data.
+	#Returns the number of rejected datapoints (the FitResult has which ones they are).
+	def sigmaClip(self,nsigma=SIGMA_CLIP_NSIGMA,maxiters=SIGMA_CLIP_MAX_ITERATIONS) :
+		if self._config.aggregation()!=None :
+			raise FitError('aggregated datapoints cannot be sigma-clipped!')
+		if self._result==None :
+			self.minimize()
+		npars = len(self._result.values())
+		for niter in range(1,maxiters+1) :
+			resids = self._get_normalized_residuals_(self._result.values())
+			mask = get_sigma_clip_mask(resids,nsigma,self._data.mask())
+			if mask.sum()<=npars :
+				raise FitError('sigma clipping at %s sigma would leave too few datapoints to fit!'%(nsigma))
+			if np.array_equal(mask,self._data.mask() if self._data.mask() is not None else
+									np.ones(self._data.n_points(),dtype=bool)) :
+				break
+			self._data.setMask(mask)
+			self.minimize()
+		else :
+			logger.warning('sigma clipping did not converge in %d passes',maxiters)
+		nrejected = self._data.n_points()-self._data.nUsed()
+		logger.info('		Sigma clipping at %s sigma rejected %d of %d datapoints after %d pass(es)',
+					nsigma,nrejected,self._data.n_points(),niter)
+		return nrejected
+
+	#the FitResult from minimizing the fit (None if it hasn't been minimized)
+	def result(self) :
+		return self._result
+
+	#refit ntoys pseudo-datasets generated from the best fit (or resampled from the data if
+	#bootstrap is True) to get the distributions of the parameters, spread over the given number
+	#of worker processes; returns a ToyResults object (the same seed gives the same toys)
+	def runToys(self,ntoys,seed=0,bootstrap=False,workers=1) :
+		from toys import run_toys
+		if self._result==None :
+			raise FitError('the fit has to be minimized before running toys!')
+		if self._dataset_index is not None :
+			raise FitError('toys are not available for simultaneous fits of several datasets yet!')
+		if self._config.aggregation()!=None :
+			raise FitError('toys are not available for fits of aggregated datapoints!')
+		with self._profiler.stage('toys') :
+			return run_toys(self._config.fit_type(),self._model.name(),
+							*self._used_arrays_(self._data.xArray(),self._data.yArray(),
+												self._data.xErrArray(),self._data.yErrArray()),
+							self._parameters.bestFitValueList(),np.sqrt(self._result.chi2PerNdf()),
+							[p[1] for p in self._model.parameters()],
+							ntoys,seed,bootstrap,workers)
+
+	#scan the chi2 over a grid of npoints values of each of two parameters (the first two by
+	#default, given by short name) around the best fit, in broadcasted passes over the data,
+	#zooming in on the largest contour refinements times, with the chunks of the grid spread over
+	#the given number of worker processes for models other than a line; the contours are drawn
+	#next to the fit plot and the profile intervals are written to the output files. Returns the
+	#Chi2Scan (the other parameters are held at their best fit values).
+	def scanChi2(self,names=None,npoints=DEFAULT_SCAN_POINTS,refinements=DEFAULT_SCAN_REFINEMENTS,workers=1) :
+		from scans import run_chi2_scan
+		if self._result==None :
+			self.minimize()
+		if self._dataset_index is not None :
+			raise FitError('chi2 scans are not available for simultaneous fits of several datasets yet!')
+		if self._loss!='linear' :
+			raise FitError('chi2 scans are not available for fits with the %s loss!'%(self._loss))
+		shortnames = self._parameters.shortnameList()
+		if names==None :
+			names = shortnames[:2]
+		if len(names)!=2 or len(set(names))!=2 or any([n not in shortnames for n in names]) :
+			raise FitError('a chi2 scan needs two different parameters out of %s, not %s!'%(shortnames,names))
+		if npoints<3 :
+			raise FitError('a chi2 scan needs at least 3 grid points along each parameter, not %s!'%(npoints))
+		with self._profiler.stage('scan') :
+			self._scan = run_chi2_scan(self._config.fit_type(),self._model.name(),
+									   *self._used_arrays_(self._data.xArray(),self._data.yArray(),
+														   self._data.weightArray(),
+														   self._data.xErrArray(),self._data.yErrArray()),
+									   shortnames,self._result.values(),self._result.errors(),
+									   shortnames.index(names[0]),shortnames.index(names[1]),
+									   self._result.chi2PerNdf(),npoints,refinements,workers,
+									   self._data.withinBinChi2 if self._config.aggregation()!=None else None)
+		return self._scan
+
+	#compare the fit function's analytic Jacobian to finite differences at the given parameter
+	#values (the initial values by default), returning True if they agree
+	def checkJacobian(self,pvalues=None) :
+		if self._fit_jacobian==None :
+			logger.info('		Fit function has no analytic Jacobian to check')
+			return True
+		if pvalues is None :
+			pvalues = self._initial_parameters_list
+		#(for a simultaneous fit, check the model with the parameters of the first dataset)
+		if self._parameter_index is not None :
+			pvalues = np.asarray(pvalues)[self._parameter_index[0]]
+		maxreldiff = check_jacobian(self._fit_function,self._fit_jacobian,pvalues,
+									self._data.xArray())
+		agrees = maxreldiff<=JACOBIAN_CHECK_TOLERANCE
+		logger.info('		Analytic Jacobian %s finite differences (largest relative difference %e)',
+					'agrees with' if agrees else 'DOES NOT AGREE with',maxreldiff)
+		return agrees
 
 	#save a plot of the raw data with the fit
-	def savePlot(self,plotfilename) :
+	def savePlot(self,plotfilename,method='auto',executor=None) :
+		with self._profiler.stage('plotting') :
+			return self._save_plot_(plotfilename,method,executor)
+
+	#write results of fit to output file (and the full result to a JSON file if a name is given)
+	def writeOutput(self,outputfilename,resultfilename=None) :
+		with self._profiler.stage('output') :
+			self._write_output_(outputfilename,resultfilename)
+
+	#private functions
+	#keep the result of the fit and set the postfit parameter values/uncertainties from it
+	def _set_result_(self,result) :
+		self._result = result
+		self._scan = None
+		logger.info('		chi2/ndf = %s/%s',self._result.chi2(),self._result.ndf())
+		self._parameters.setParametersPostfit(self._result.values(),self._result.errors())
+
+	#returns the result cache key of the fit: a hash of the data, the datapoints that are used,
+	#and everything else that goes into the result (aggregated pseudo-points only have weights)
+	def _get_result_cache_key_(self) :
+		from cache import get_content_hash
+		arrays = [self._data.xArray(),self._data.yArray(),self._data.xErrArray(),
+				  self._data.yErrArray(),self._data.mask(),self._dataset_index]
+		if self._config.aggregation()!=None :
+			arrays+=[self._data.weightArray(),np.array([self._data.nOriginalPoints()])]
+			arrays+=list(self._data.binMoments())
+		return get_content_hash(arrays,self._get_fit_settings_())
+
+	#returns the warm start key of the fit: the same for every fit of the same kind to the same
+	#input file, however its data changes
+	def _get_warm_start_key_(self) :
+		from cache import get_content_hash
+		ifp = self._config.input_file_path()
+		return get_content_hash([],dict(self._get_fit_settings_(),
+										input_file_path=os.path.abspath(ifp) if ifp!=None else None))
+
+	#returns a dictionary of the settings that change the result of a fit given the same data
+	def _get_fit_settings_(self) :
+		return {'fit_type':self._config.fit_type(),'model':self._model.name(),'engine':self._engine,
+				'loss':self._loss,'loss_scale':self._loss_scale,
+				'parameters':self._parameters.shortnameList(),'aggregation':self._config.aggregation()}
+
+	#(only submitting the plot is timed if it's rendered in the background; the contours of a chi2
+	# scan are drawn in a second plot file ending in _contours right away)
+	def _save_plot_(self,plotfilename,method,executor) :
+		if self._scan!=None :
+			from plotting import render_contour_plot
+			root, ext = os.path.splitext(plotfilename)
+			render_contour_plot(root+'_contours'+ext,self._scan.xValues(),self._scan.yValues(),
+								self._scan.deltaChi2(),self._scan.contourLevels(),
+								self._scan.bestFitValues(),*self._scan.names())
 		#only generates plots for linear x-y fits at the moment
-		if self._config.fit_type().startswith('linear_least_squares') :
+		if self._config.fit_type() in LINEAR_FIT_TYPES :
+			from plotting import render_fit_plot
 			#make the x range space for the fit function line
+			#(with one fit line per dataset for a simultaneous fit)
 			fitxspace = np.linspace(self._data.xMin(),self._data.xMax(),100)
-			plt.figure()
-			#plot the data
-			plt.errorbar(self._data.xArray(),
-						 self._data.yArray(),
-						 xerr=self._data.xErrArray(),
-						 yerr=self._data.yErrArray(),
-						 fmt='o')
-			#plot the fit
-			plt.plot(fitxspace,
-					 self._fit_function(self._parameters.bestFitValueList(),fitxspace),
-					 'r-')
-			#label the axes
-			plt.xlabel(self._data.xAxisLabel())
-			plt.ylabel(self._data.yAxisLabel())
-			#nudge the left side and bottom into the frame a lil more
-			plt.gcf().subplots_adjust(left=0.15,bottom=0.15)
-			plt.savefig(plotfilename)
-
-	#write results of fit to output file
-	def writeOutput(self,outputfilename) :
+			pvalues = self._parameters.bestFitValueList()
+			linepvalues = ( pvalues if self._parameter_index is None else
+							np.asarray(pvalues)[self._parameter_index.T][:,:,np.newaxis] )
+			args = (plotfilename,self._data.xArray(),self._data.yArray(),
+					self._data.xErrArray(),self._data.yErrArray(),
+					fitxspace,self._fit_function(linepvalues,fitxspace),
+					self._fit_at_datapoints_(pvalues),
+					self._data.xAxisLabel(),self._data.yAxisLabel(),method)
+			#(sigma-clipped datapoints are drawn differently)
+			kwargs = {'rejected':~self._data.mask()} if self._data.mask() is not None else {}
+			#render in the background if given an executor (returning its Future)
+			if executor!=None :
+				return executor.submit(render_fit_plot,*args,**kwargs)
+			return render_fit_plot(*args,**kwargs)
+
+	def _write_output_(self,outputfilename,resultfilename) :
+		if resultfilename!=None :
+			if self._result==None :
+				raise FitError('the fit has to be minimized before writing its result!')
+			self._result.writeJSON(resultfilename,{'scan':self._scan.toDict()} if self._scan!=None else None)
 		#labels for table columns
 		fieldlabels = ['Parameter number','Full name','Short name',
 					  'Initial value','Best Fit Value','Uncertainty']
@@ -114,69 +378,442 @@ class Fit(object) :
 			lines_to_write.append(newline)
 			lines_to_write.append(dotline)
 		lines_to_write.append(dashesline) #last another dashes line to close out the table
+		#then the profile intervals if there was a chi2 scan
+		if self._scan!=None :
+			lines_to_write.append('PROFILE INTERVALS (from a chi2 scan of %s and %s):'%tuple(self._scan.names()))
+			for i,name in enumerate(self._scan.names()) :
+				intervals = ['%d sigma [%e, %e]'%((nsigma,)+self._scan.interval(i,nsigma))
+							 for nsigma in sorted(PROFILE_DELTA_CHI2)]
+				lines_to_write.append('	%s = %e, '%(name,self._scan.bestFitValues()[i])+', '.join(intervals))
 		#write all lines to the file
 		with open(outputfilename,'w') as fp :
 			for line in lines_to_write :
 				fp.write(line+'\n')
 
+	#run leastsq and return the best fit parameters, covariance matrix and final residuals
+	def _run_leastsq_(self) :
+		from scipy import optimize
+		#use the analytic Jacobian if the fit function has one (rows are parameters, so col_deriv)
+		dfun = self._resid_jacobian if self._fit_jacobian!=None else None
+		pfit, pcov, infodict, errmsg, success = optimize.leastsq(self._resid_function, 
+																 self._start_parameters_list, 
+																 args=self._used_arrays_(*self._resid_function_args),
+																 Dfun=dfun,
+																 col_deriv=True,
+																 full_output=True)
+		#stop if the fit failed
+		if success not in range(1,5) :	
+			raise FitError('Fit failed. Message: '+errmsg)
+		logger.info('		Fit success; returned with flag %s',success)
+		logger.info('		Fit function evaluated %s times',infodict['nfev'])
+		self._profiler.count('residual_evaluations',infodict['nfev'])
+		if 'njev' in infodict :
+			logger.info('		Analytic Jacobian evaluated %s times',infodict['njev'])
+			self._profiler.count('jacobian_evaluations',infodict['njev'])
+		logger.info('		Final total residual value: %s',infodict['fvec'].sum())
+		return pfit, pcov, infodict['fvec']
+
+	#run least_squares with the loss function and return the same things as leastsq, where the
+	#covariance matrix comes from the loss-weighted Jacobian and the residuals are scaled so that
+	#their squares add up to twice the minimized cost (that is, the robust chi2)
+	def _run_least_squares_(self) :
+		from scipy import optimize
+		args = self._used_arrays_(*self._resid_function_args)
+		#least_squares wants one row per residual
+		jac = ( (lambda p, *a : self._resid_jacobian(p,*a).T) if self._fit_jacobian!=None 
+				else '2-point' )
+		#(finite differences only need to vary the parameters of each dataset together)
+		sparsity = None
+		if self._dataset_index is not None and self._fit_jacobian==None :
+			sparsity = self._get_block_jacobian_(np.ones((self._model.n_parameters(),len(args[-1]))),
+												 args[-1]).T
+		options = {'jac':jac,'args':args,'jac_sparsity':sparsity}
+		#(a robust fit starts from the plain least squares one)
+		result = optimize.least_squares(self._resid_function,self._start_parameters_list,**options)
+		nfev = result.nfev
+		loss_scale = self._loss_scale
+		if self._loss!='linear' :
+			for niter in range(1,ROBUST_SCALE_MAX_ITERATIONS+1) :
+				previous = loss_scale
+				if self._loss_scale==None :
+					loss_scale = ROBUST_LOSS_SIGMAS*get_robust_sigma(result.fun)
+					if not loss_scale>0. :
+						loss_scale = 1.
+				result = optimize.least_squares(self._resid_function,result.x,loss=self._loss,
+												f_scale=loss_scale,**options)
+				nfev+=result.nfev
+				#stop once the scale settles down (or right away if it was given)
+				if self._loss_scale!=None or (previous!=None and 
+											  abs(loss_scale-previous)<=ROBUST_SCALE_TOLERANCE*previous) :
+					break
+			logger.info('		Robust loss scale is %e (after %d fit(s))',loss_scale,niter)
+		#stop if the fit failed
+		if not result.success :
+			raise FitError('Fit failed. Message: '+result.message)
+		logger.info('		Fit success; returned with status %s and %s loss',result.status,self._loss)
+		logger.info('		Fit function evaluated %s times',nfev)
+		self._profiler.count('residual_evaluations',nfev)
+		if result.njev!=None :
+			logger.info('		Analytic Jacobian evaluated %s times',result.njev)
+			self._profiler.count('jacobian_evaluations',result.njev)
+		try :
+			#(the Jacobian of a simultaneous fit is a sparse matrix)
+			jtj = result.jac.T.dot(result.jac)
+			pcov = np.linalg.inv(jtj.toarray() if hasattr(jtj,'toarray') else jtj)
+		except np.linalg.LinAlgError :
+			pcov = None
+		fvec = result.fun
+		if self._loss!='linear' :
+			fvec = np.sign(fvec)*loss_scale*np.sqrt(LOSS_FUNCTIONS[self._loss]((fvec/loss_scale)**2))
+		logger.info('		Final total residual value: %s',fvec.sum())
+		return result.x, pcov, fvec
+
+	#solve the weighted normal equations for a line exactly, returning the same things as leastsq
+	def _solve_analytically_(self) :
+		slope, intercept, pcov, fvec = solve_weighted_line(*self._used_arrays_(self._data.xArray(),
+																			   self._data.yArray(),
+																			   self._data.weightArray()))
+		if not (np.isfinite(slope) and np.isfinite(intercept)) :
+			raise FitError('Fit failed. Message: all datapoints have the same x value or zero weight')
+		logger.info('		Fit success; solved weighted normal equations analytically')
+		self._profiler.count('residual_evaluations')
+		logger.info('		Final total residual value: %s',fvec.sum())
+		return np.array([slope,intercept]), pcov, fvec
+
+	#iterate York regression to convergence, returning the same things as leastsq
+	def _run_york_regression_(self) :
+		slope, intercept, pcov, fvec, niter = solve_york_line(*self._used_arrays_(self._data.xArray(),
+																				  self._data.yArray(),
+																				  self._data.xErrArray(),
+																				  self._data.yErrArray()),
+															  self._start_parameters_list[0])
+		if not (np.isfinite(slope) and np.isfinite(intercept)) :
+			raise FitError('Fit failed. Message: all datapoints have the same x value')
+		if niter>YORK_MAX_ITERATIONS :
+			raise FitError('Fit failed. Message: York regression did not converge in '+
+						   str(YORK_MAX_ITERATIONS)+' iterations')
+		logger.info('		Fit success; York regression converged after %s iterations',niter)
+		self._profiler.count('york_iterations',niter)
+		self._profiler.count('residual_evaluations',niter)
+		logger.info('		Final total residual value: %s',fvec.sum())
+		return np.array([slope,intercept]), pcov, fvec
+
+	#returns the given data columns with only the datapoints used in the fit (not sigma-clipped)
+	def _used_arrays_(self,*columns) :
+		return tuple([self._data.usedOnly(c) for c in columns])
+
+	#returns the fit function at every datapoint (or just the ones used in the fit)
+	def _fit_at_datapoints_(self,pvalues,usedonly=False) :
+		x, dataset_index = self._data.xArray(), self._dataset_index
+		if usedonly :
+			x = self._data.usedOnly(x)
+			if dataset_index is not None :
+				dataset_index = self._data.usedOnly(dataset_index)
+		if dataset_index is not None :
+			pvalues = self._expand_parameters_(pvalues,dataset_index)
+		return self._fit_function(pvalues,x)
+
+	#returns the residuals (y(fit)-y(data)) of every datapoint divided by their uncertainties, with
+	#the x uncertainty times the slope of the fit function there added in quadrature (or the plain
+	#residuals if the datapoints don't have uncertainties)
+	def _get_normalized_residuals_(self,pvalues) :
+		x, xunc, yunc = self._data.xArray(), self._data.xErrArray(), self._data.yErrArray()
+		if self._dataset_index is not None :
+			pvalues = self._expand_parameters_(pvalues,self._dataset_index)
+		resids = self._fit_function(pvalues,x)-self._data.yArray()
+		if not np.any(yunc!=0.) :
+			return resids
+		variance = yunc**2
+		if np.any(xunc!=0.) :
+			step = JACOBIAN_CHECK_STEP*np.maximum(np.absolute(x),1.)
+			slope = (self._fit_function(pvalues,x+step)-self._fit_function(pvalues,x-step))/(2.*step)
+			variance = variance+(slope*xunc)**2
+		return resids/np.sqrt(variance)
+
+	#returns the model parameter values at every datapoint of a simultaneous fit (one row per
+	#model parameter) given the values in the whole parameter list and the datapoints' datasets
+	def _expand_parameters_(self,pvalues,dataset_index) :
+		return np.asarray(pvalues,dtype=np.float64)[self._parameter_index.T][:,dataset_index]
+
+	#returns the Jacobian of a simultaneous fit's residuals as a sparse matrix with one row per
+	#parameter in the list, given the model's Jacobian (one row per model parameter) at the
+	#datapoints: every residual only depends on the parameters of its own dataset
+	def _get_block_jacobian_(self,modeljac,dataset_index) :
+		from scipy import sparse
+		npars, npoints = modeljac.shape
+		rows = self._parameter_index[dataset_index].T.ravel()
+		columns = np.tile(np.arange(npoints),npars)
+		return sparse.csr_matrix((np.asarray(modeljac).ravel(),(rows,columns)),
+								 shape=(len(self._initial_parameters_list),npoints))
+
+	#make the residuals function and its Jacobian take the values of the whole parameter list,
+	#with the dataset number of each datapoint as the last argument
+	def _make_resid_function_simultaneous_(self) :
+		resid_function, resid_jacobian = self._resid_function, self._resid_jacobian
+		self._resid_function = lambda p, *args : resid_function(self._expand_parameters_(p,args[-1]),
+																 *args[:-1])
+		self._resid_jacobian = lambda p, *args : self._get_block_jacobian_(
+												 resid_jacobian(self._expand_parameters_(p,args[-1]),
+																*args[:-1]),args[-1])
+		self._resid_function_args = self._resid_function_args+(self._dataset_index,)
+
+	#choose the minimizer engine to use (the fastest one the fit type allows if not given, or
+	#the one that can do robust losses if one is used)
+	def _set_engine_(self) :
+		if self._loss not in LOSS_FUNCTIONS :
+			raise FitError('unknown loss function %s (options are %s)'%(self._loss,list(LOSS_FUNCTIONS)))
+		if self._engine==None :
+			if self._loss!='linear' or self._dataset_index is not None :
+				self._engine = LEAST_SQUARES_ENGINE
+			else :
+				self._engine = ( DEFAULT_ENGINES.get(self._config.fit_type(),'leastsq') 
+								 if self._model.name()=='linear' else 'leastsq' )
+		if self._engine not in ENGINES :
+			raise FitError('unknown minimizer engine %s (options are %s)'%(self._engine,list(ENGINES)))
+		if self._dataset_index is not None and self._engine!=LEAST_SQUARES_ENGINE :
+			raise FitError('simultaneous fits of several datasets can only be done with the %s engine, not %s!'%(
+						   LEAST_SQUARES_ENGINE,self._engine))
+		if self._loss!='linear' and self._engine!=LEAST_SQUARES_ENGINE :
+			raise FitError('the %s loss can only be used with the %s engine, not %s!'%(self._loss,
+																						 LEAST_SQUARES_ENGINE,
+																						 self._engine))
+		if self._engine in LINEAR_MODEL_ENGINES and self._model.name()!='linear' :
+			raise FitError('the %s engine can only fit a linear model, not %s!'%(self._engine,
+																				 self._model.name()))
+		if ENGINES[self._engine]!=None and self._config.fit_type() not in ENGINES[self._engine] :
+			raise FitError('fit type %s cannot be done with the %s engine!'%(self._config.fit_type(),
+																			 self._engine))
+		logger.info('		Minimizer engine is %s',self._engine)
+
 	#set the lamdba residuals function and its arguments
 	def _set_resid_function_and_args_(self) :
-		if self._config.fit_type()=='linear_least_squares' :
-			print('		Function to minimize is unweighted y-distance')
+		#(aggregated pseudo-points are always weighted)
+		if self._config.fit_type()=='linear_least_squares' and self._config.aggregation()==None :
+			logger.info('		Function to minimize is unweighted y-distance')
 			self._resid_function = lambda p, x, y : self._fit_function(p,x)-y
+			self._resid_jacobian = lambda p, x, y : self._fit_jacobian(p,x)
 			self._resid_function_args = ( self._data.xArray(),
 										  self._data.yArray() ) 
-		elif self._config.fit_type() in ['linear_least_squares_y_weighted',
+		elif self._config.fit_type() in ['linear_least_squares','linear_least_squares_y_weighted',
 										 'linear_least_squares_weighted'] :
-			print('		Function to minimize is weighted y-distance')
+			logger.info('		Function to minimize is weighted y-distance')
 			self._resid_function = lambda p, x, y, w : w*(self._fit_function(p,x)-y)
+			self._resid_jacobian = lambda p, x, y, w : w*self._fit_jacobian(p,x)
 			self._resid_function_args = ( self._data.xArray(),
 										  self._data.yArray(),
 										  self._data.weightArray() ) 
+		elif self._config.fit_type()=='linear_errors_in_variables' :
+			if self._model.name()!='linear' :
+				raise FitError('fit type %s can only fit a linear model, not %s!'%(self._config.fit_type(),
+																				   self._model.name()))
+			#for a line this is exactly the orthogonal-distance (errors-in-variables) problem
+			logger.info('		Function to minimize is y-distance over effective x-y uncertainty')
+			self._resid_function = lambda p, x, y, xunc, yunc : ( (self._fit_function(p,x)-y)/
+																	np.sqrt(yunc**2+(p[0]*xunc)**2) )
+			self._resid_jacobian = self._get_effective_variance_jacobian_
+			self._resid_function_args = ( self._data.xArray(),
+										  self._data.yArray(),
+										  self._data.xErrArray(),
+										  self._data.yErrArray() )
+		if self._dataset_index is not None :
+			self._make_resid_function_simultaneous_()
+
+	#Jacobian of the y-distance over effective x-y uncertainty residuals (one row per parameter)
+	def _get_effective_variance_jacobian_(self,p,x,y,xunc,yunc) :
+		eff_unc = np.sqrt(yunc**2+(p[0]*xunc)**2)
+		jac = self._fit_jacobian(p,x)/eff_unc
+		#the effective uncertainty also depends on the slope
+		jac[0] -= (self._fit_function(p,x)-y)*p[0]*xunc**2/eff_unc**3
+		return jac
 
-	#set the lambda fit function and its arguments
+	#set the lambda fit function (and its Jacobian, if known) and its arguments
 	def _set_fit_function_and_params_(self) :
-		if self._config.fit_type().startswith('linear_least_squares') :
-			print('		Fit function is linear (y=mx+b)')
-			self._fit_function = lambda p, x : p[0]*x+p[1]
+		if self._config.fit_type() in LINEAR_FIT_TYPES :
+			logger.info('		Fit function is %s',self._model.description())
+			self._fit_function = self._model.evaluate
+			self._fit_jacobian = self._model.jacobian if self._model.hasJacobian() else None
 			self._initial_parameters_list = self._parameters.prefitValueList()
 
 	#populate the list of parameters from the config
 	def _make_parameterlist_from_config_and_data_(self) :
-		#all the linear least squares fits just have m and b (slope/intercept)
-		if self._config.fit_type().startswith('linear_least_squares') :
-			#find the initial guesses for the slope/intercept
-			firstpoint = self._data.firstpoint()
-			lastpoint  = self._data.lastpoint()
-			rise = lastpoint.y()-firstpoint.y()
-			run  = lastpoint.x()-firstpoint.x()
-			init_slope=1
-			if run!=0. :
-				init_slope = rise/run
-			self._parameters.addFitParameter('slope','m',init_slope)
-			init_intercept=0.
-			self._parameters.addFitParameter('intercept','b',init_intercept)
+		#the x-y fits have the parameters of the model, with initial guesses from the data
+		#(a line just has m and b (slope/intercept))
+		if self._config.fit_type() in LINEAR_FIT_TYPES and self._config.dataset_labels()!=None :
+			self._make_simultaneous_parameterlist_()
+		elif self._config.fit_type() in LINEAR_FIT_TYPES :
+			init_values = self._model.initialGuess(self._data.xArray(),self._data.yArray())
+			for (fullname,shortname),init_value in zip(self._model.parameters(),init_values) :
+				self._parameters.addFitParameter(fullname,shortname,init_value)
+
+	#populate the list of parameters for a simultaneous fit of several datasets: the shared model
+	#parameters once (starting from the average of the datasets' initial guesses) and the rest
+	#once per dataset (labeled with the dataset's label)
+	def _make_simultaneous_parameterlist_(self) :
+		labels, sizes = self._config.dataset_labels(), self._config.dataset_sizes()
+		shared = self._config.shared_parameters()
+		shortnames = [sn for fn,sn in self._model.parameters()]
+		for sn in shared :
+			if sn not in shortnames :
+				raise ConfigError('shared parameter %s is not a parameter of the %s model (options are %s)'%(
+								  sn,self._model.name(),shortnames))
+		logger.info('		Fitting %d datasets simultaneously with shared parameter(s) %s',len(labels),shared)
+		self._dataset_index = np.repeat(np.arange(len(labels)),sizes)
+		starts = np.concatenate(([0],np.cumsum(sizes)))
+		x, y = self._data.xArray(), self._data.yArray()
+		init_values = np.array([self._model.initialGuess(x[starts[i]:starts[i+1]],y[starts[i]:starts[i+1]])
+								for i in range(len(labels))])
+		self._parameter_index = np.empty((len(labels),len(shortnames)),dtype=np.int64)
+		for k,(fullname,shortname) in enumerate(self._model.parameters()) :
+			if shortname in shared :
+				self._parameter_index[:,k] = self._parameters.addFitParameter(fullname,shortname,
+																			  float(init_values[:,k].mean()))
+				continue
+			for i,label in enumerate(labels) :
+				self._parameter_index[i,k] = self._parameters.addFitParameter(fullname+' ('+label+')',
+																			  shortname+'_'+label,
+																			  float(init_values[i,k]),label)
+
+	#replace the data object with its aggregated summary; the summary of a line fit with fixed
+	#weights is exact, so the other fits can't be aggregated
+	def _aggregate_data_(self) :
+		from aggregation import aggregate_linear_data
+		mode, nbins = self._config.aggregation()
+		if self._model.name()!='linear' :
+			raise ConfigError('only fits of the linear model can be aggregated, not %s!'%(self._model.name()))
+		if self._config.fit_type()=='linear_errors_in_variables' :
+			raise ConfigError('fit type %s cannot be aggregated (its weights depend on the slope)!'%(
+							  self._config.fit_type()))
+		if self._config.dataset_labels()!=None :
+			raise ConfigError('simultaneous fits of several datasets cannot be aggregated!')
+		if self._loss!='linear' :
+			raise ConfigError('fits with the %s loss cannot be aggregated!'%(self._loss))
+		self._data = aggregate_linear_data(self._data,mode,nbins)
 
 	#populate the data object for the fit depending on the config/data
 	def _populate_data_object_from_config_(self) :
 		if self._config.fit_type()=='linear_least_squares' :
-			print('		Found x-y data for a linear fit')
+			logger.info('		Found x-y data for a linear fit')
 			self._data = LinearData(self._config.x_name(),self._config.x_unit(),
 									self._config.y_name(),self._config.y_unit(),
 									self._config.n_points(),
-									self._config.x_values(),self._config.y_values())
+									self._config.x_values(),self._config.y_values(),
+									self._profiler)
 		elif self._config.fit_type()=='linear_least_squares_y_weighted' :
-			print('		Found x-y data for a linear fit with weighted y errors')
+			logger.info('		Found x-y data for a linear fit with weighted y errors')
 			self._data = LinearDataYErrors(self._config.x_name(),self._config.x_unit(),
 										   self._config.y_name(),self._config.y_unit(),
 										   self._config.n_points(),
 										   self._config.x_values(),self._config.y_values(),
-										   self._config.y_uncertainties())
-		elif self._config.fit_type()=='linear_least_squares_weighted' :
-			print('		Found x-y data for a linear fit with weighted x-y errors')
+										   self._config.y_uncertainties(),self._profiler)
+		elif self._config.fit_type() in ['linear_least_squares_weighted',
+										 'linear_errors_in_variables'] :
+			if self._config.x_uncertainties() is None or self._config.y_uncertainties() is None :
+				raise FitError('fit type %s needs x and y uncertainties for every datapoint!'%(self._config.fit_type()))
+			logger.info('		Found x-y data for a linear fit with weighted x-y errors')
 			self._data = LinearDataXYErrors(self._config.x_name(),self._config.x_unit(),
 											self._config.y_name(),self._config.y_unit(),
 											self._config.n_points(),
 											self._config.x_values(),self._config.y_values(),
 											self._config.x_uncertainties(),
-											self._config.y_uncertainties())
+											self._config.y_uncertainties(),self._profiler)
+
+# file-scope functions
+#solves the weighted normal equations for a line y=mx+b exactly along the last axis of the inputs
+#(residuals are w*(mx+b-y) like in the Fit class, so each point enters the sums with weight w^2)
+#returns the slope, intercept, unscaled covariance matrix (shape (...,2,2)) and residuals;
+#degenerate datasets (all x equal or all weights zero) give nan slopes/intercepts
+def solve_weighted_line(x,y,w) :
+	x, y, w = np.asarray(x,dtype=np.float64), np.asarray(y,dtype=np.float64), np.asarray(w,dtype=np.float64)
+	wsq = w**2
+	with np.errstate(divide='ignore',invalid='ignore') :
+		#center x on its weighted mean to keep the sums well-conditioned
+		sumw = wsq.sum(axis=-1)
+		xbar = (wsq*x).sum(axis=-1)/sumw
+		ybar = (wsq*y).sum(axis=-1)/sumw
+		dx = x-xbar[...,np.newaxis]
+		sxx = (wsq*dx**2).sum(axis=-1)
+		slope = (wsq*dx*y).sum(axis=-1)/sxx
+		intercept = ybar-slope*xbar
+		#covariance matrix of (slope, intercept) before rescaling
+		pcov = np.empty(slope.shape+(2,2))
+		pcov[...,0,0] = 1./sxx
+		pcov[...,0,1] = pcov[...,1,0] = -xbar/sxx
+		pcov[...,1,1] = 1./sumw+xbar**2/sxx
+	fvec = w*(slope[...,np.newaxis]*x+intercept[...,np.newaxis]-y)
+	return slope, intercept, pcov, fvec
+
+#returns the standard deviation of (residual) values estimated from their median absolute
+#deviation, which a few outliers can't blow up
+def get_robust_sigma(values) :
+	return MAD_TO_SIGMA*np.median(np.absolute(values-np.median(values)))
+
+#returns the boolean mask of the datapoints to keep when sigma clipping at nsigma, given the
+#residuals of every datapoint and the mask of the ones that were used to get them (None for all)
+#(the center and spread are the median and robust sigma of the residuals that were used; if those
+# are all the same the standard deviation is used instead, and nothing is rejected if it's zero)
+def get_sigma_clip_mask(residuals,nsigma,usedmask=None) :
+	used = residuals if usedmask is None else residuals[usedmask]
+	center = np.median(used)
+	sigma = MAD_TO_SIGMA*np.median(np.absolute(used-center))
+	if not sigma>0. :
+		sigma = used.std()
+	if not sigma>0. :
+		return np.ones(len(residuals),dtype=bool)
+	return np.absolute(residuals-center)<=nsigma*sigma
+
+#returns the largest relative difference between an analytic Jacobian of a fit function
+#(one row per parameter) and central finite differences at parameter values p and points x
+def check_jacobian(fit_function,fit_jacobian,p,x) :
+	p = np.asarray(p,dtype=np.float64)
+	analytic = np.asarray(fit_jacobian(p,x),dtype=np.float64)
+	numeric = np.empty_like(analytic)
+	for i in range(len(p)) :
+		step = JACOBIAN_CHECK_STEP*max(abs(p[i]),1.)
+		pup, pdown = p.copy(), p.copy()
+		pup[i]+=step; pdown[i]-=step
+		numeric[i] = (fit_function(pup,x)-fit_function(pdown,x))/(2.*step)
+	scale = np.maximum(np.absolute(numeric),np.absolute(analytic)).max(axis=1)
+	scale[scale==0.] = 1.
+	return (np.absolute(analytic-numeric).max(axis=1)/scale).max()
+
+#fits a line y=mx+b to data with both x and y uncertainties by York regression
+#(York et al., Am. J. Phys. 72, 367 (2004), with uncorrelated x and y errors)
+#works along the last axis of the inputs like solve_weighted_line, with each iteration one
+#vectorized pass over the data; returns the slope, intercept, unscaled covariance matrix,
+#residuals (normalized so that their squares sum to the chi2) and the number of iterations
+#used (more than YORK_MAX_ITERATIONS if it didn't converge)
+def solve_york_line(x,y,x_unc,y_unc,init_slope) :
+	x, y = np.asarray(x,dtype=np.float64), np.asarray(y,dtype=np.float64)
+	wx, wy = 1./np.asarray(x_unc,dtype=np.float64)**2, 1./np.asarray(y_unc,dtype=np.float64)**2
+	slope = np.broadcast_to(np.asarray(init_slope,dtype=np.float64),x.shape[:-1]).copy()
+	#weighted means along the last axis, and the point weights given the slope(s)
+	wmean = lambda w, a : (w*a).sum(axis=-1)/w.sum(axis=-1)
+	pointweights = lambda m : wx*wy/(wx+m[...,np.newaxis]**2*wy)
+	for niter in range(1,YORK_MAX_ITERATIONS+2) :
+		w = pointweights(slope)
+		u = x-wmean(w,x)[...,np.newaxis]
+		v = y-wmean(w,y)[...,np.newaxis]
+		beta = w*(u/wy+slope[...,np.newaxis]*v/wx)
+		with np.errstate(divide='ignore',invalid='ignore') :
+			newslope = (w*beta*v).sum(axis=-1)/(w*beta*u).sum(axis=-1)
+			converged = ( (np.absolute(newslope-slope)<=YORK_TOLERANCE*np.absolute(newslope)) |
+						  ~np.isfinite(newslope) )
+		slope = newslope
+		if np.all(converged) :
+			break
+	#final weights, intercept and adjusted x values for the uncertainties
+	w = pointweights(slope)
+	sumw = w.sum(axis=-1)
+	xbar, ybar = wmean(w,x), wmean(w,y)
+	intercept = ybar-slope*xbar
+	beta = w*((x-xbar[...,np.newaxis])/wy+slope[...,np.newaxis]*(y-ybar[...,np.newaxis])/wx)
+	xadj = xbar[...,np.newaxis]+beta
+	xadjbar = wmean(w,xadj)
+	with np.errstate(divide='ignore',invalid='ignore') :
+		slope_var = 1./(w*(xadj-xadjbar[...,np.newaxis])**2).sum(axis=-1)
+		pcov = np.empty(slope.shape+(2,2))
+		pcov[...,0,0] = slope_var
+		pcov[...,0,1] = pcov[...,1,0] = -xadjbar*slope_var
+		pcov[...,1,1] = 1./sumw+xadjbar**2*slope_var
+	fvec = np.sqrt(w)*(slope[...,np.newaxis]*x+intercept[...,np.newaxis]-y)
+	return slope, intercept, pcov, fvec, niter
@@ -0,0 +1,184 @@
+###################################################################################################
+### This file contains the Model classes and model registry for the FriendlyFitter package. #######
+### copyright 2019/contact margaret.eminizer@gmail.com ############################################
+###################################################################################################
+
+#imports
+import re
+import numpy as np
+from diagnostics import ModelError
+
+#Model classes
+
+#Model class: a function y=f(p,x) to fit, with everything the Fit class needs to know about it
+class Model(object) :
+
+	#parameters is a list of (fullname,shortname) pairs in the order the function takes them,
+	#function(p,x) and jacobian(p,x) are vectorized over x (the jacobian has one row per
+	#parameter, and both also work if each p[k] is an array with one value per x value, which is
+	#how simultaneous fits of several datasets use them), and initial_guess(x,y) returns a list of
+	#initial parameter values from the data; linear=True means the function is linear in its
+	#parameters (so the jacobian doesn't depend on them)
+	def __init__(self,name,description,parameters,function,initial_guess,jacobian=None,linear=False) :
+		self._name = name
+		self._description = description
+		self._parameters = parameters
+		self._function = function
+		self._initial_guess = initial_guess
+		self._jacobian = jacobian
+		self._linear = linear
+
+	def name(self) :
+		return self._name
+	def description(self) :
+		return self._description
+	def parameters(self) :
+		return self._parameters
+	def n_parameters(self) :
+		return len(self._parameters)
+	def hasJacobian(self) :
+		return self._jacobian!=None
+	def isLinear(self) :
+		return self._linear
+	def evaluate(self,p,x) :
+		return self._function(p,x)
+	def jacobian(self,p,x) :
+		return self._jacobian(p,x)
+	def initialGuess(self,x,y) :
+		return [float(v) for v in self._initial_guess(x,y)]
+
+#SumModel class: the sum of several component models, with the parameters of each one in turn
+class SumModel(Model) :
+
+	def __init__(self,components) :
+		self._components = components
+		#slices of the full parameter list belonging to each component
+		self._slices = []; start = 0
+		for c in components :
+			self._slices.append(slice(start,start+c.n_parameters()))
+			start+=c.n_parameters()
+		#label every parameter with the number of its component to keep the names unique
+		parameters = []
+		for i,c in enumerate(components) :
+			parameters+=[(fn+' (component '+str(i+1)+')',sn+'_'+str(i+1)) for fn,sn in c.parameters()]
+		jacobian = self._sum_jacobian_ if all([c.hasJacobian() for c in components]) else None
+		Model.__init__(self,'+'.join([c.name() for c in components]),
+					   'sum of '+', '.join([c.description() for c in components]),
+					   parameters,self._sum_function_,self._sum_initial_guess_,jacobian,
+					   all([c.isLinear() for c in components]))
+
+	def _sum_function_(self,p,x) :
+		return sum([c.evaluate(p[s],x) for c,s in zip(self._components,self._slices)])
+	def _sum_jacobian_(self,p,x) :
+		return np.vstack([c.jacobian(p[s],x) for c,s in zip(self._components,self._slices)])
+	#guess each component in turn from what the previous components leave unexplained
+	def _sum_initial_guess_(self,x,y) :
+		guess = []; remainder = np.array(y,dtype=np.float64)
+		for c in self._components :
+			cguess = c.initialGuess(x,remainder)
+			remainder = remainder-c.evaluate(np.array(cguess),x)
+			guess+=cguess
+		return guess
+
+#Model-making functions (one per kind of model in the registry)
+
+#linear model y=mx+b (initial slope from the first and last points, like always)
+def make_linear_model() :
+	def initial_guess(x,y) :
+		run = x[-1]-x[0]
+		return [(y[-1]-y[0])/run if run!=0. else 1., 0.]
+	return Model('linear','linear (y=mx+b)',[('slope','m'),('intercept','b')],
+				 lambda p, x : p[0]*x+p[1],initial_guess,
+				 lambda p, x : np.vstack((x,np.ones_like(x))),linear=True)
+
+#polynomial y=c0+c1*x+...+cn*x^n of the given degree
+#(evaluated by Horner's method like numpy's polyval, but with coefficients that can be arrays
+# broadcasting against x, like the other models)
+def make_polynomial_model(degree) :
+	def function(p,x) :
+		y = p[degree]+0.*x
+		for k in range(degree-1,-1,-1) :
+			y = p[k]+y*x
+		return y
+	return Model('polynomial'+str(degree),
+				 'polynomial of degree '+str(degree)+' (y=c0+c1*x+...+c'+str(degree)+'*x^'+str(degree)+')',
+				 [('coefficient of x^'+str(k),'c'+str(k)) for k in range(degree+1)],
+				 function,
+				 lambda x, y : np.polynomial.polynomial.polyfit(x,y,degree),
+				 lambda p, x : np.vander(x,degree+1,increasing=True).T,linear=True)
+
+#exponential y=A*exp(k*x) (initial guess from a straight line fit to log|y|)
+def make_exponential_model() :
+	def initial_guess(x,y) :
+		sign = 1. if np.median(y)>=0. else -1.
+		usable = sign*y>0.
+		if usable.sum()<2 :
+			return [np.mean(y), 0.]
+		k, logA = np.polyfit(x[usable],np.log(sign*y[usable]),1)
+		return [sign*np.exp(logA), k]
+	def jacobian(p,x) :
+		e = np.exp(p[1]*x)
+		return np.vstack((e,p[0]*x*e))
+	return Model('exponential','exponential (y=A*exp(k*x))',[('amplitude','A'),('rate','k')],
+				 lambda p, x : p[0]*np.exp(p[1]*x),initial_guess,jacobian)
+
+#Gaussian y=A*exp(-(x-mu)^2/(2*sigma^2)) (initial guess from the peak and second moment)
+def make_gaussian_model() :
+	def initial_guess(x,y) :
+		ipeak = np.argmax(np.absolute(y))
+		absy = np.absolute(y)
+		sigma = np.sqrt(np.dot(absy,(x-x[ipeak])**2)/absy.sum()) if absy.sum()>0. else 0.
+		if not sigma>0. :
+			sigma = (x.max()-x.min())/4. if x.max()>x.min() else 1.
+		return [y[ipeak], x[ipeak], sigma]
+	def jacobian(p,x) :
+		g = np.exp(-(x-p[1])**2/(2.*p[2]**2))
+		return np.vstack((g,p[0]*g*(x-p[1])/p[2]**2,p[0]*g*(x-p[1])**2/p[2]**3))
+	return Model('gaussian','Gaussian (y=A*exp(-(x-mu)^2/(2*sigma^2)))',
+				 [('amplitude','A'),('mean','mu'),('width','sigma')],
+				 lambda p, x : p[0]*np.exp(-(x-p[1])**2/(2.*p[2]**2)),initial_guess,jacobian)
+
+#power law y=A*x^k (initial guess from a straight line fit in log-log space)
+def make_power_law_model() :
+	def initial_guess(x,y) :
+		sign = 1. if np.median(y)>=0. else -1.
+		usable = (x>0.) & (sign*y>0.)
+		if usable.sum()<2 :
+			return [np.mean(y), 1.]
+		k, logA = np.polyfit(np.log(x[usable]),np.log(sign*y[usable]),1)
+		return [sign*np.exp(logA), k]
+	def jacobian(p,x) :
+		xk = x**p[1]
+		return np.vstack((xk,p[0]*xk*np.log(x)))
+	return Model('power_law','power law (y=A*x^k)',[('amplitude','A'),('index','k')],
+				 lambda p, x : p[0]*x**p[1],initial_guess,jacobian)
+
+#constants
+#the model registry: model name -> function making the model
+MODEL_FACTORIES = {'linear':make_linear_model,
+				   'exponential':make_exponential_model,
+				   'gaussian':make_gaussian_model,
+				   'power_law':make_power_law_model}
+#polynomials are named by degree, like 'polynomial2'
+POLYNOMIAL_NAME_PATTERN = re.compile(r'^polynomial(\d+)$')
+
+# file-scope functions
+#add a new kind of model to the registry (factory is a function with no arguments returning a Model)
+def register_model(name,factory) :
+	if name in MODEL_FACTORIES or POLYNOMIAL_NAME_PATTERN.match(name) :
+		raise ModelError('a model named '+name+' has already been registered!!')
+	MODEL_FACTORIES[name] = factory
+
+#returns the model for a model name from the registry, where names joined by '+' make a sum
+def get_model(spec) :
+	components = []
+	for name in [n.strip().lower() for n in spec.split('+')] :
+		polymatch = POLYNOMIAL_NAME_PATTERN.match(name)
+		if polymatch :
+			components.append(make_polynomial_model(int(polymatch.group(1))))
+		elif name in MODEL_FACTORIES :
+			components.append(MODEL_FACTORIES[name]())
+		else :
+			raise ModelError('unknown fit model %s (options are %s, or polynomialN for degree N)'%(
+							 name,sorted(MODEL_FACTORIES)))
+	return components[0] if len(components)==1 else SumModel(components)
@@ -0,0 +1,208 @@
+###################################################################################################
+### This file contains the OnlineLinearFit class for the FriendlyFitter package. ##################
+### copyright 2019/contact margaret.eminizer@gmail.com ############################################
+###################################################################################################
+
+#imports
+from collections import deque
+import numpy as np
+from datasets import get_unnormalized_weights
+from parameter import ParameterList
+from models import get_model
+from diagnostics import DataError, FitError
+
+#constants
+#fit types that can be updated incrementally (the ones that are weighted least squares problems)
+ONLINE_FIT_TYPES = ['linear_least_squares','linear_least_squares_y_weighted',
+					'linear_least_squares_weighted']
+
+#OnlineLinearFit class: a weighted linear least squares fit to data that arrives a bit at a time
+#Datapoints are weighted the same way as in the LinearData classes for the fit type, and only
+#running weighted sums are kept (the total weight and weighted means of x and y, and the weighted
+#sums of squares/cross products about those means, which are the sums of w, wx, wy, wx^2, wxy, and
+#wy^2 kept in a form that doesn't lose precision), so adding or removing points is O(1) per point
+#and the best fit is available at any time. With window=N only the N most recent points are fit,
+#and with forgetting<1 the weight of every point is multiplied by that factor each time a new
+#point comes in. Points can't be retracted by hand from a fit with a window or forgetting.
+class OnlineLinearFit(object) :
+
+	def __init__(self,fit_type='linear_least_squares',window=None,forgetting=1.) :
+		if fit_type not in ONLINE_FIT_TYPES :
+			raise FitError('fit type %s cannot be fit incrementally (options are %s)'%(fit_type,ONLINE_FIT_TYPES))
+		if window!=None and window<3 :
+			raise FitError('the sliding window needs at least 3 points, not %s!'%(window))
+		if not 0.<forgetting<=1. :
+			raise FitError('the forgetting factor has to be in (0,1], not %s!'%(forgetting))
+		if window!=None and forgetting!=1. :
+			raise FitError('a fit can have a sliding window or forgetting, but not both!')
+		self._fit_type = fit_type
+		self._window = window
+		self._forgetting = forgetting
+		self._model = get_model('linear')
+		#points in the sliding window (chunks of x, y, x/y uncertainty arrays, oldest first)
+		self._window_chunks = deque()
+		self._nretracted = 0
+		#the first and last points still in the fit (for the initial parameter values)
+		self._firstpoint = None; self._lastpoint = None
+		self._reset_()
+
+	#public functions
+	#add one or more datapoints to the fit
+	def append(self,x,y,x_unc=0.,y_unc=0.) :
+		x, y, x_unc, y_unc = self._get_point_arrays_(x,y,x_unc,y_unc)
+		if len(x)==0 :
+			return
+		W, U = self._get_point_weights_(x,y,x_unc,y_unc)
+		if self._forgetting!=1. :
+			#older points in this chunk are already forgotten a bit by the time the last one comes in
+			decay = self._forgetting**np.arange(len(x)-1,-1,-1,dtype=np.float64)
+			self._scale_(self._forgetting**len(x))
+			W, U, n = W*decay, U*np.sqrt(decay), decay.sum()
+		else :
+			n = float(len(x))
+		self._combine_(self._get_chunk_stats_(x,y,W,U,n),1.)
+		if self._firstpoint==None :
+			self._firstpoint = (x[0],y[0])
+		self._lastpoint = (x[-1],y[-1])
+		if self._window!=None :
+			self._window_chunks.append((x,y,x_unc,y_unc))
+			self._trim_window_()
+	#remove one or more datapoints that were added before
+	def retract(self,x,y,x_unc=0.,y_unc=0.) :
+		if self._forgetting!=1. :
+			raise FitError('datapoints cannot be retracted from a fit with forgetting!')
+		if self._window!=None :
+			raise FitError('datapoints cannot be retracted by hand from a fit with a sliding window!')
+		x, y, x_unc, y_unc = self._get_point_arrays_(x,y,x_unc,y_unc)
+		if len(x)>self._n :
+			raise DataError('cannot retract %d points from a fit with only %d!'%(len(x),self._n))
+		W, U = self._get_point_weights_(x,y,x_unc,y_unc)
+		self._combine_(self._get_chunk_stats_(x,y,W,U,float(len(x))),-1.)
+	def fit_type(self) :
+		return self._fit_type
+	#number of points in the fit (the effective number with forgetting)
+	def nPoints(self) :
+		return self._n
+	def slope(self) :
+		return self._Cxy/self._Cxx if self._Cxx>0. else float('nan')
+	def intercept(self) :
+		return self._my-self.slope()*self._mx
+	def values(self) :
+		return np.array([self.slope(),self.intercept()])
+	#covariance matrix of (slope, intercept), rescaled by chi2/ndf like a Fit's
+	def covariance(self) :
+		if self._Cxx<=0. or self.ndf()<=0. :
+			return np.full((2,2),np.nan)
+		s_sq = self._get_weighted_chi2_()/self.ndf()
+		return s_sq*np.array([[1./self._Cxx,-self._mx/self._Cxx],
+							  [-self._mx/self._Cxx,1./self._W+self._mx**2/self._Cxx]])
+	def errors(self) :
+		return np.sqrt(np.absolute(np.diagonal(self.covariance())))
+	#chi2 with the datapoint weights normalized like in the LinearData classes (as in a FitResult;
+	#unweighted fits aren't normalized)
+	def chi2(self) :
+		if self._fit_type=='linear_least_squares' :
+			return self._get_weighted_chi2_()
+		return self._get_weighted_chi2_()/self._U**2 if self._U>0. else float('nan')
+	def ndf(self) :
+		return self._n-2
+	#returns a ParameterList with the current best fit, just like a Fit on the same points makes
+	#(the initial values come from the first and last points added, or the first and last in the
+	# sliding window)
+	def parameterList(self) :
+		parameters = ParameterList()
+		if self._firstpoint==None :
+			raise DataError('no datapoints have been added to the online fit yet!')
+		init_values = self._model.initialGuess(np.array([self._firstpoint[0],self._lastpoint[0]]),
+											   np.array([self._firstpoint[1],self._lastpoint[1]]))
+		for (fullname,shortname),init_value in zip(self._model.parameters(),init_values) :
+			parameters.addFitParameter(fullname,shortname,init_value)
+		parameters.setParametersPostfit(self.values().tolist(),self.errors().tolist())
+		return parameters
+
+	#private functions
+	#set all the running statistics back to zero
+	def _reset_(self) :
+		#number of points, total weight, total unnormalized (square root) weight
+		self._n = 0.; self._W = 0.; self._U = 0.
+		#weighted means of x and y
+		self._mx = 0.; self._my = 0.
+		#weighted sums of squares and cross products about the means
+		self._Cxx = 0.; self._Cxy = 0.; self._Cyy = 0.
+	#returns x, y, x_unc, y_unc as 1D float64 arrays of the same length
+	def _get_point_arrays_(self,x,y,x_unc,y_unc) :
+		x = np.atleast_1d(np.asarray(x,dtype=np.float64))
+		y = np.atleast_1d(np.asarray(y,dtype=np.float64))
+		x_unc = np.broadcast_to(np.asarray(x_unc,dtype=np.float64),x.shape)
+		y_unc = np.broadcast_to(np.asarray(y_unc,dtype=np.float64),x.shape)
+		if x.shape!=y.shape :
+			raise DataError("numbers of x and y values to add to the online fit don't match!")
+		return x, y, x_unc, y_unc
+	#returns the least squares weights (squares of the unnormalized datapoint weights, since the
+	#residuals are multiplied by the weights) and the unnormalized weights for the fit type
+	def _get_point_weights_(self,x,y,x_unc,y_unc) :
+		if self._fit_type=='linear_least_squares' :
+			U = np.ones(len(x))
+		elif self._fit_type=='linear_least_squares_y_weighted' :
+			U = get_unnormalized_weights(x,y,np.zeros(len(x)),y_unc)
+		else :
+			U = get_unnormalized_weights(x,y,x_unc,y_unc)
+		return U**2, U
+	#returns the running statistics of one chunk of points
+	def _get_chunk_stats_(self,x,y,W,U,n) :
+		Wsum = W.sum()
+		mx, my = np.dot(W,x)/Wsum, np.dot(W,y)/Wsum
+		dx, dy = x-mx, y-my
+		return (n,Wsum,U.sum(),mx,my,np.dot(W*dx,dx),np.dot(W*dx,dy),np.dot(W*dy,dy))
+	#add (sign=1) or remove (sign=-1) the statistics of a chunk of points
+	def _combine_(self,chunkstats,sign) :
+		n, Wb, Ub, mxb, myb, Cxxb, Cxyb, Cyyb = chunkstats
+		Wtot = self._W+sign*Wb
+		if self._n+sign*n<=0. or Wtot<=0. :
+			self._reset_()
+			return
+		if sign>0. :
+			#merge the chunk in (pairwise update of the means and sums about them)
+			dx, dy = mxb-self._mx, myb-self._my
+			f = self._W*Wb/Wtot
+			self._mx+=Wb*dx/Wtot; self._my+=Wb*dy/Wtot
+			self._Cxx+=Cxxb+f*dx*dx; self._Cxy+=Cxyb+f*dx*dy; self._Cyy+=Cyyb+f*dy*dy
+		else :
+			#undo the merge of the chunk
+			mx, my = (self._W*self._mx-Wb*mxb)/Wtot, (self._W*self._my-Wb*myb)/Wtot
+			dx, dy = mxb-mx, myb-my
+			f = Wtot*Wb/self._W
+			self._Cxx-=Cxxb+f*dx*dx; self._Cxy-=Cxyb+f*dx*dy; self._Cyy-=Cyyb+f*dy*dy
+			self._mx, self._my = mx, my
+		self._n+=sign*n; self._W = Wtot; self._U+=sign*Ub
+	#forget a bit of every point in the fit
+	def _scale_(self,factor) :
+		self._n*=factor; self._W*=factor; self._U*=np.sqrt(factor)
+		self._Cxx*=factor; self._Cxy*=factor; self._Cyy*=factor
+	#remove the oldest points until the sliding window has the right number in it
+	def _trim_window_(self) :
+		while self._n>self._window :
+			x, y, x_unc, y_unc = self._window_chunks[0]
+			nremove = min(len(x),int(self._n-self._window))
+			W, U = self._get_point_weights_(x[:nremove],y[:nremove],x_unc[:nremove],y_unc[:nremove])
+			self._combine_(self._get_chunk_stats_(x[:nremove],y[:nremove],W,U,float(nremove)),-1.)
+			if nremove==len(x) :
+				self._window_chunks.popleft()
+			else :
+				self._window_chunks[0] = (x[nremove:],y[nremove:],x_unc[nremove:],y_unc[nremove:])
+			self._nretracted+=nremove
+		self._firstpoint = (self._window_chunks[0][0][0],self._window_chunks[0][1][0])
+		#once a whole window's worth of points has been removed, start over from the points in the
+		#window so rounding errors from adding and removing points can't build up (still O(1) per
+		#point on average)
+		if self._nretracted>=self._window :
+			self._nretracted = 0
+			self._reset_()
+			for x, y, x_unc, y_unc in self._window_chunks :
+				W, U = self._get_point_weights_(x,y,x_unc,y_unc)
+				self._combine_(self._get_chunk_stats_(x,y,W,U,float(len(x))),1.)
+	#weighted sum of the squared residuals (with the unnormalized least squares weights)
+	def _get_weighted_chi2_(self) :
+		if self._Cxx<=0. :
+			return float('nan')
+		return max(self._Cyy-self._Cxy**2/self._Cxx,0.)
@@ -5,6 +5,11 @@
 
 #imports
 import numpy as np
+from diagnostics import FitError, get_logger
+
+#constants
+#logger for the messages from this module
+logger = get_logger('parameter')
 
 #Parameter classes 
 class Parameter(object) :
@@ -16,14 +21,16 @@ class Parameter(object) :
 		return self._shortname
 		
 #FitParameters are minimized in the fit
+#(in a simultaneous fit of several datasets, each one is either shared by all of them or belongs
+# to the one with the given dataset label)
 class FitParameter(Parameter) :
 
-	def __init__(self,fullname,shortname,init_value) :
-		print('		Adding fit parameter "'+fullname+'" ("'+shortname+
-			  '") with initial value '+str(init_value))
+	def __init__(self,fullname,shortname,init_value,dataset=None) :
+		logger.info('		Adding fit parameter "%s" ("%s") with initial value %s',fullname,shortname,init_value)
 		Parameter.__init__(self,shortname)
 		self._fullname = fullname
 		self._init_value = init_value
+		self._dataset = dataset
 		self._best_fit_value = 0.
 		self._postfit_error = 0.
 
@@ -33,6 +40,10 @@ class FitParameter(Parameter) :
 		return self._init_value
 	def best_fit_value(self) :
 		return self._best_fit_value
+	def dataset(self) :
+		return self._dataset
+	def isShared(self) :
+		return self._dataset==None
 	def getPrintFields(self) :
 		returnlist = []
 		returnlist.append(self._fullname)
@@ -42,8 +53,8 @@ class FitParameter(Parameter) :
 		returnlist.append('{0:e}'.format(self._postfit_error))
 		return returnlist
 	def setPostfitValueAndError(self,val,err) :
-		print('		Fit parameter "'+self._fullname+'" ("'+self._shortname+
-			  '") postfit value = '+str(val)+' +/- '+str(err))
+		logger.info('		Fit parameter "%s" ("%s") postfit value = %s +/- %s',
+					self._fullname,self._shortname,val,err)
 		self._best_fit_value = val
 		self._postfit_error = err
 
@@ -54,20 +65,25 @@ class ParameterList(object) :
 		self._dict = {}
 		self._list = []
 
-	def addFitParameter(self,fullname,shortname,init_value) :
+	def addFitParameter(self,fullname,shortname,init_value,dataset=None) :
 		if shortname in self._dict :
-			print('ERROR: a parameter with shortname '+shortname+' has already been defined!!')
-			exit()
-		self._dict[shortname] = FitParameter(fullname,shortname,init_value)
+			raise FitError('a parameter with shortname '+shortname+' has already been defined!!')
+		self._dict[shortname] = FitParameter(fullname,shortname,init_value,dataset)
 		self._list.append(self._dict[shortname])
+		#returns the position of the new parameter in the list
+		return len(self._list)-1
+	def shortnameList(self) :
+		return [p.shortname() for p in self._list if isinstance(p,FitParameter)]
+	#dataset label of each parameter (None for the shared ones)
+	def datasetList(self) :
+		return [p.dataset() for p in self._list if isinstance(p,FitParameter)]
 	def prefitValueList(self) :
 		return [p.init_value() for p in self._list if isinstance(p,FitParameter)]
 	def bestFitValueList(self) :
 		return [p.best_fit_value() for p in self._list if isinstance(p,FitParameter)]
 	def setParametersPostfit(self,pvalues,perrors) :
 		if len(pvalues)!=len(perrors) or len(pvalues)!=len(self._list) :
-			print('ERROR: mismatched numbers of parameters pre to post fit!!')
-			exit()
+			raise FitError('mismatched numbers of parameters pre to post fit!!')
 		for i in range(len(self._list)) :
 			self._list[i].setPostfitValueAndError(pvalues[i],perrors[i])
 	def getFitParamPrintFieldsList(self) :
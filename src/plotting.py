@@ -0,0 +1,133 @@
+###################################################################################################
+### This file contains the plot rendering functions for the FriendlyFitter package. ###############
+### copyright 2019/contact margaret.eminizer@gmail.com ############################################
+###################################################################################################
+
+#imports
+import numpy as np
+from diagnostics import ConfigError
+
+#constants
+#ways to draw the data: every point, a decimated set of points, or a density map
+PLOT_METHODS = ['auto','points','lttb','hexbin']
+#largest number of datapoints drawn one-by-one with the 'auto' method
+PLOT_MAX_POINTS = 10000
+#datapoints further than this many uncertainties from the fit are outliers and are always drawn
+OUTLIER_SIGMA = 3.
+#number of hexagons across the x range of a density plot
+HEXBIN_GRIDSIZE = 100
+
+# file-scope functions
+#draw the data and the fit line with the matplotlib Agg object-oriented API (never pyplot, so no
+#global figure state is kept around) and save the plot to a file. Can be run in another process.
+#x/y_unc are the uncertainty arrays, fit_x/fit_y the fit line (or lines, one per row of a 2D
+#fit_y), fit_y_at_x the fit at each datapoint,
+#and rejected an optional boolean mask of datapoints left out of the fit (drawn as grey crosses)
+def render_fit_plot(plotfilename,x,y,x_unc,y_unc,fit_x,fit_y,fit_y_at_x,xlabel,ylabel,
+					method='auto',max_points=PLOT_MAX_POINTS,rejected=None) :
+	from matplotlib.figure import Figure
+	from matplotlib.backends.backend_agg import FigureCanvasAgg
+	if method not in PLOT_METHODS :
+		raise ConfigError('unknown plot method %s (options are %s)'%(method,PLOT_METHODS))
+	n = len(x)
+	if method=='auto' :
+		method = 'points' if n<=max_points else 'lttb'
+	#the rejected datapoints are drawn on their own at the end
+	if rejected is not None and np.any(rejected) :
+		rx, ry = x[rejected], y[rejected]
+		x, y, x_unc, y_unc, fit_y_at_x = [a[~rejected] for a in (x,y,x_unc,y_unc,fit_y_at_x)]
+		n = len(x)
+	else :
+		rx, ry = None, None
+	fig = Figure()
+	FigureCanvasAgg(fig)
+	ax = fig.add_subplot(1,1,1)
+	#plot the data
+	if method=='points' :
+		_draw_points_(ax,x,y,x_unc,y_unc)
+	else :
+		outliers = get_outlier_mask(y,y_unc,fit_y_at_x)
+		if method=='hexbin' :
+			ax.hexbin(x,y,gridsize=HEXBIN_GRIDSIZE,bins='log',mincnt=1,cmap='Blues')
+			keep = outliers
+		else :
+			keep = np.zeros(n,dtype=bool)
+			keep[get_lttb_indices(x,y,max_points)] = True
+			keep|=outliers
+		_draw_points_(ax,x[keep],y[keep],x_unc[keep],y_unc[keep])
+		ax.set_title('%d of %d datapoints shown (%s)'%(keep.sum(),n,method),fontsize='small')
+	if rx is not None :
+		ax.plot(rx,ry,'x',color='0.6',label='%d rejected'%(len(rx)))
+		ax.legend(fontsize='small')
+	#plot the fit
+	ax.plot(fit_x,np.transpose(fit_y),'r-')
+	#label the axes
+	ax.set_xlabel(xlabel)
+	ax.set_ylabel(ylabel)
+	#nudge the left side and bottom into the frame a lil more
+	fig.subplots_adjust(left=0.15,bottom=0.15)
+	fig.savefig(plotfilename)
+	#free the figure right away
+	fig.clear()
+	return plotfilename
+
+#draw the contours of a chi2 scan (delta chi2 on a grid with one row per x value) at the given
+#{nsigma:delta chi2} levels around the best fit point and save the plot to a file, the same way
+#as render_fit_plot
+def render_contour_plot(plotfilename,xvalues,yvalues,deltachi2,levels,best_fit_values,xlabel,ylabel) :
+	from matplotlib.figure import Figure
+	from matplotlib.backends.backend_agg import FigureCanvasAgg
+	fig = Figure()
+	FigureCanvasAgg(fig)
+	ax = fig.add_subplot(1,1,1)
+	nsigmas = sorted(levels)
+	contours = ax.contour(xvalues,yvalues,np.transpose(deltachi2),levels=[levels[n] for n in nsigmas],
+						  colors=['r','b','g','m'][:len(nsigmas)])
+	ax.clabel(contours,fmt=dict([(levels[n],'%d sigma'%(n)) for n in nsigmas]),fontsize='small')
+	ax.plot(best_fit_values[0],best_fit_values[1],'k+',label='best fit')
+	ax.legend(fontsize='small')
+	ax.set_xlabel(xlabel)
+	ax.set_ylabel(ylabel)
+	fig.subplots_adjust(left=0.15,bottom=0.15)
+	fig.savefig(plotfilename)
+	fig.clear()
+	return plotfilename
+
+#returns a boolean mask of the datapoints further than OUTLIER_SIGMA uncertainties from the fit
+#(or standard deviations of the residuals if there are no y uncertainties)
+def get_outlier_mask(y,y_unc,fit_y_at_x) :
+	residuals = np.absolute(y-fit_y_at_x)
+	if np.any(y_unc!=0.) :
+		with np.errstate(divide='ignore',invalid='ignore') :
+			return (y_unc>0.) & (residuals>OUTLIER_SIGMA*y_unc)
+	return residuals>OUTLIER_SIGMA*residuals.std()
+
+#returns the indices of (at most) npoints datapoints chosen by Largest-Triangle-Three-Buckets
+#decimation, which keeps the visual shape of the data (peaks, dips, edges) when sorted by x
+def get_lttb_indices(x,y,npoints) :
+	n = len(x)
+	order = np.argsort(x,kind='stable')
+	if n<=npoints or npoints<3 :
+		return order[:max(npoints,0)] if n>npoints else order
+	xs, ys = x[order], y[order]
+	#the first and last points are always kept and the rest are split into npoints-2 buckets
+	edges = np.linspace(1,n-1,npoints-1).astype(np.int64)
+	chosen = np.empty(npoints,dtype=np.int64)
+	chosen[0] = 0; chosen[-1] = n-1
+	for i in range(npoints-2) :
+		start, stop = edges[i], max(edges[i+1],edges[i]+1)
+		#the next bucket's average point (or the last point for the last bucket)
+		nstart, nstop = stop, (max(edges[i+2],stop+1) if i+2<len(edges) else n)
+		nextx, nexty = xs[nstart:nstop].mean(), ys[nstart:nstop].mean()
+		prevx, prevy = xs[chosen[i]], ys[chosen[i]]
+		#keep the point making the biggest triangle with the previous kept point and the next bucket
+		areas = np.absolute((prevx-nextx)*(ys[start:stop]-prevy)-(prevx-xs[start:stop])*(nexty-prevy))
+		chosen[i+1] = start+np.argmax(areas)
+	return order[chosen]
+
+#draw datapoints with error bars (leaving off the bars in a direction with no uncertainties at all)
+def _draw_points_(ax,x,y,x_unc,y_unc) :
+	ax.errorbar(x,y,
+				xerr=x_unc if np.any(x_unc!=0.) else None,
+				yerr=y_unc if np.any(y_unc!=0.) else None,
+				fmt='o')
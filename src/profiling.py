@@ -0,0 +1,147 @@
+###################################################################################################
+### This file contains the Profiler classes for the FriendlyFitter package. #######################
+### copyright 2019/contact margaret.eminizer@gmail.com ############################################
+###################################################################################################
+
+#imports
+import sys
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+from diagnostics import get_logger
+
+#constants
+#logger for the messages from this module
+logger = get_logger('profiling')
+
+#Profiler class: records the wall time, CPU time, and memory use of each stage of a fit, and
+#counters like the number of residual function evaluations. The memory recorded for each stage is
+#the high-water mark of the whole process at the end of it (a stage that makes it go up used that
+#much), and with trace_memory=True also the peak memory allocated by python (including numpy)
+#during the stage, which is exact but makes everything run a few times slower.
+#Stages can be nested (like the weight calculation inside building the data objects), and the
+#same stage can be entered more than once (its times add up, and its peak memory is the largest).
+class Profiler(object) :
+
+	def __init__(self,trace_memory=False) :
+		self._trace_memory = trace_memory
+		self._started_tracing = False
+		if self._trace_memory and not tracemalloc.is_tracing() :
+			tracemalloc.start()
+			self._started_tracing = True
+		#stage name -> {'calls','wall_s','cpu_s','max_rss_bytes'(,'peak_bytes')}, in the order they
+		#first happened
+		self._stages = {}
+		self._counters = {}
+		#largest peak memory seen so far in each of the stages that are running
+		self._open_peaks = []
+
+	#public functions
+	#time everything in a with block as the given stage
+	@contextmanager
+	def stage(self,name) :
+		self._begin_memory_()
+		wall, cpu = time.perf_counter(), time.process_time()
+		try :
+			yield
+		finally :
+			wall, cpu = time.perf_counter()-wall, time.process_time()-cpu
+			peak = self._end_memory_()
+			entry = self._stages.setdefault(name,{'calls':0,'wall_s':0.,'cpu_s':0.})
+			entry['calls']+=1; entry['wall_s']+=wall; entry['cpu_s']+=cpu
+			entry['max_rss_bytes'] = get_max_rss_bytes()
+			if self._trace_memory :
+				entry['peak_bytes'] = max(entry.get('peak_bytes',0),peak)
+	#add to a counter
+	def count(self,name,n=1) :
+		self._counters[name] = self._counters.get(name,0)+int(n)
+	def stages(self) :
+		return self._stages
+	def counters(self) :
+		return self._counters
+	def isEnabled(self) :
+		return True
+	#stop tracing memory (if this profiler started it)
+	def stop(self) :
+		if self._started_tracing :
+			tracemalloc.stop()
+			self._started_tracing = False
+	#returns a dictionary of everything that was recorded, that can be written as JSON
+	def toDict(self) :
+		profile = {'stages':dict([(k,dict(v)) for k,v in self._stages.items()]),
+				   'counters':dict(self._counters),
+				   'memory_traced':self._trace_memory}
+		#derived numbers that are handy for spotting hot spots
+		if 'minimization' in self._stages and self._counters.get('residual_evaluations',0)>0 :
+			profile['seconds_per_residual_evaluation'] = ( self._stages['minimization']['wall_s']/
+														   self._counters['residual_evaluations'] )
+		profile['max_rss_bytes'] = get_max_rss_bytes()
+		return profile
+	def toJSON(self) :
+		return json.dumps(self.toDict(),indent=1)
+	def writeJSON(self,filename) :
+		with open(filename,'w') as fp :
+			fp.write(self.toJSON()+'\n')
+	#log a table of the stages and counters
+	def printSummary(self) :
+		#(the traced peak memory column is only there if memory was traced)
+		ncolumns = 6 if self._trace_memory else 5
+		headerformat = '	%-16s %6s %10s %10s %12s %12s'.rsplit(' ',6-ncolumns)[0]
+		rowformat = '	%-16s %6d %10.4f %10.4f %12s %12s'.rsplit(' ',6-ncolumns)[0]
+		logger.info('Profile:')
+		logger.info(headerformat,*['stage','calls','wall [s]','CPU [s]','max RSS [MB]','peak [MB]'][:ncolumns])
+		for name,entry in self._stages.items() :
+			logger.info(rowformat,*[name,entry['calls'],entry['wall_s'],entry['cpu_s'],
+									_format_megabytes_(entry['max_rss_bytes']),
+									_format_megabytes_(entry.get('peak_bytes'))][:ncolumns])
+		for name,value in self._counters.items() :
+			logger.info('	%s: %d',name,value)
+
+	#private functions
+	#start keeping track of the peak memory of a new stage
+	def _begin_memory_(self) :
+		if not self._trace_memory :
+			return
+		#pass the peak so far on to the stage that's already running before starting over
+		if len(self._open_peaks)>0 :
+			self._open_peaks[-1] = max(self._open_peaks[-1],tracemalloc.get_traced_memory()[1])
+		tracemalloc.reset_peak()
+		self._open_peaks.append(0)
+	#returns the peak memory of the stage that's ending
+	def _end_memory_(self) :
+		if not self._trace_memory :
+			return 0
+		peak = max(self._open_peaks.pop(),tracemalloc.get_traced_memory()[1])
+		if len(self._open_peaks)>0 :
+			self._open_peaks[-1] = max(self._open_peaks[-1],peak)
+		return peak
+
+#NullProfiler class: a profiler that records nothing, used when profiling isn't turned on
+class NullProfiler(object) :
+
+	@contextmanager
+	def stage(self,name) :
+		yield
+	def count(self,name,n=1) :
+		pass
+	def isEnabled(self) :
+		return False
+
+#the profiler used when none is given
+NULL_PROFILER = NullProfiler()
+
+# file-scope functions
+#returns the largest amount of memory the process has used so far in bytes (None if unknown)
+def get_max_rss_bytes() :
+	try :
+		import resource
+	except ImportError :
+		return None
+	maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	#(it's in kilobytes everywhere except macOS)
+	return maxrss if sys.platform=='darwin' else maxrss*1024
+
+#formats a number of bytes in megabytes for the summary table (blank if unknown)
+def _format_megabytes_(nbytes) :
+	return '%.3f'%(nbytes/1024.**2) if nbytes is not None else ''
@@ -0,0 +1,182 @@
+###################################################################################################
+### This file contains the binary input file readers for the FriendlyFitter package. ##############
+### copyright 2019/contact margaret.eminizer@gmail.com ############################################
+###################################################################################################
+
+#Binary input files hold the x/y values and uncertainties as raw numbers, so they're memory-mapped
+#instead of being converted from text. Each reader returns the same kind of keyword dictionary
+#get_keyword_dict_from_fitter_lines does for a csv input file, except that the datapoints come as
+#'x_y_columns': a list of the x values, x uncertainties, y values, and y uncertainties columns
+#(None for missing uncertainties). There are three kinds:
+#	.npy: a 2D array with one [x, x uncertainty, y, y uncertainty] or [x, y] row per datapoint
+#		  (the columns are contiguous if it's saved in Fortran order), or a structured array
+#		  with x, y, x_uncertainties, and y_uncertainties fields
+#	.npz: x, y, x_uncertainties, and y_uncertainties arrays, with optional x_name, x_unit,
+#		  y_name, y_unit, fit_model, and aggregation ("mode,number of bins") strings
+#		  (the arrays are memory-mapped if the file isn't compressed)
+#	.ffc: "friendly fit columns" files, with an indicator line, then a line of JSON with the
+#		  number of points, the dtype and order of the columns, and the same optional strings
+#		  as a .npz file, padded so the columns that come right after start at a multiple of
+#		  64 bytes (write_columnar_input writes them)
+
+#imports
+import os
+import json
+import struct
+import zipfile
+import numpy as np
+from diagnostics import DataError, get_logger
+
+#constants
+#logger for the messages from this module
+logger = get_logger('readers')
+#the column names of the datapoints, in the order of the x/y data block
+COLUMN_NAMES = ['x','x_uncertainties','y','y_uncertainties']
+#the optional strings describing the datapoints, with their defaults
+METADATA_DEFAULTS = {'x_name':'x','x_unit':'','y_name':'y','y_unit':'','fit_model':None,
+					 'aggregation':None}
+#first line of a columnar input file
+COLUMNAR_INDICATOR_LINE = b'#####,friendly fit columns,#####\n'
+#the columns of a columnar input file start at a multiple of this many bytes
+COLUMNAR_ALIGNMENT = 64
+#size of a zip file's local file header before the file name and extra field
+ZIP_LOCAL_HEADER_BYTES = 30
+
+# file-scope functions
+#returns True if the input file is one of the binary kinds (from its extension)
+def is_binary_input(ifp) :
+	return ifp is not None and os.path.splitext(ifp)[1].lower() in BINARY_INPUT_READERS
+
+#returns the keyword dictionary of a binary input file
+def get_keyword_dict_from_binary_file(ifp) :
+	logger.info('		Memory-mapping binary input file %s',ifp)
+	return _read_binary_input_(ifp)
+
+#returns None if the binary input file can be fit, or what's wrong with it if it can't (other
+#.npy/.npz files, like the results and toys the fitter writes itself, can't)
+def get_binary_input_problem(ifp) :
+	try :
+		_read_binary_input_(ifp)
+	except DataError as e :
+		return str(e)
+	return None
+
+#reads a .npy input file
+def read_npy_input(ifp) :
+	array = np.load(ifp,mmap_mode='r',allow_pickle=False)
+	if array.dtype.names is not None :
+		columns = [array[name] if name in array.dtype.names else None for name in COLUMN_NAMES]
+	elif array.ndim==2 and array.shape[1] in (2,4) :
+		columns = [array[:,k] for k in range(4)] if array.shape[1]==4 else [array[:,0],None,array[:,1],None]
+	else :
+		raise DataError('.npy input %s has to be a structured array or have 2 or 4 columns, not shape %s!'%(
+						ifp,array.shape))
+	return _make_keyword_dict_(ifp,columns,{})
+
+#reads a .npz input file
+def read_npz_input(ifp) :
+	with np.load(ifp,allow_pickle=False) as npz, zipfile.ZipFile(ifp) as zf :
+		columns = [_load_npz_member_(ifp,zf,npz,name) if name in npz.files else None for name in COLUMN_NAMES]
+		metadata = dict([(key,str(npz[key])) for key in METADATA_DEFAULTS if key in npz.files])
+	return _make_keyword_dict_(ifp,columns,metadata)
+
+#reads a .ffc columnar input file
+def read_columnar_input(ifp) :
+	with open(ifp,'rb') as fp :
+		if fp.readline()!=COLUMNAR_INDICATOR_LINE :
+			raise DataError('%s is not a friendly fit columns file (its first line is wrong)!'%(ifp))
+		header = json.loads(fp.readline().decode('utf-8'))
+		offset = fp.tell()
+	names, n = header['columns'], int(header['n_points'])
+	unknown = [name for name in names if name not in COLUMN_NAMES]
+	if len(unknown)>0 :
+		raise DataError('columnar input %s has unknown column(s) %s (options are %s)!'%(ifp,unknown,COLUMN_NAMES))
+	if os.path.getsize(ifp)<offset+len(names)*n*np.dtype(header['dtype']).itemsize :
+		raise DataError('columnar input %s is shorter than its header says!'%(ifp))
+	block = np.memmap(ifp,dtype=header['dtype'],mode='r',offset=offset,shape=(len(names),n))
+	columns = [block[names.index(name)] if name in names else None for name in COLUMN_NAMES]
+	return _make_keyword_dict_(ifp,columns,dict([(k,header[k]) for k in METADATA_DEFAULTS if k in header]))
+
+#writes a .ffc columnar input file with the given x/y values and uncertainties (None for none)
+#and names, units, fit model, and aggregation ("mode,number of bins", or None)
+def write_columnar_input(filepath,x_values,y_values,x_uncertainties=None,y_uncertainties=None,
+						 x_name='x',x_unit='',y_name='y',y_unit='',fit_model=None,aggregation=None) :
+	columns = dict([(name,np.asarray(values,dtype='<f8').ravel())
+					for name,values in zip(COLUMN_NAMES,[x_values,x_uncertainties,y_values,y_uncertainties])
+					if values is not None])
+	if len(set([len(c) for c in columns.values()]))!=1 :
+		raise DataError("numbers of x,y points/uncertainties don't match!")
+	header = {'n_points':len(columns['x']),'dtype':'<f8','columns':list(columns),
+			  'x_name':x_name,'x_unit':x_unit,'y_name':y_name,'y_unit':y_unit}
+	if fit_model is not None :
+		header['fit_model'] = fit_model
+	if aggregation is not None :
+		header['aggregation'] = aggregation
+	headerline = json.dumps(header).encode('utf-8')
+	#pad the header line with spaces so the columns start on an aligned offset
+	used = len(COLUMNAR_INDICATOR_LINE)+len(headerline)+1
+	headerline+=b' '*((-used)%COLUMNAR_ALIGNMENT)
+	with open(filepath,'wb') as fp :
+		fp.write(COLUMNAR_INDICATOR_LINE+headerline+b'\n')
+		for column in columns.values() :
+			column.tofile(fp)
+	return filepath
+
+#returns a member array of a .npz file, memory-mapped from inside the zip file if it's stored
+#without compression (and read normally if it isn't, or if its .npy header is the utf-8 kind
+#numpy has no public reader for)
+def _load_npz_member_(ifp,zf,npz,name) :
+	info = zf.getinfo(name+'.npy')
+	if info.compress_type!=zipfile.ZIP_STORED :
+		return npz[name]
+	with open(ifp,'rb') as fp :
+		#skip the member's local header to get to the .npy data
+		fp.seek(info.header_offset)
+		local = fp.read(ZIP_LOCAL_HEADER_BYTES)
+		namelength, extralength = struct.unpack('<HH',local[26:30])
+		fp.seek(info.header_offset+ZIP_LOCAL_HEADER_BYTES+namelength+extralength)
+		version = np.lib.format.read_magic(fp)
+		if version==(1,0) :
+			shape, fortran, dtype = np.lib.format.read_array_header_1_0(fp)
+		elif version==(2,0) :
+			shape, fortran, dtype = np.lib.format.read_array_header_2_0(fp)
+		elif version==(3,0) :
+			return npz[name]
+		else :
+			raise DataError('.npz input %s has a %s array in unknown .npy format version %d.%d!'%(
+							ifp,name,version[0],version[1]))
+		offset = fp.tell()
+	if dtype.hasobject :
+		raise DataError('.npz input %s has a %s array of python objects!'%(ifp,name))
+	return np.memmap(ifp,dtype=dtype,mode='r',offset=offset,shape=shape,order='F' if fortran else 'C')
+
+#reads a binary input file with the reader for its extension, raising a DataError if it can't
+def _read_binary_input_(ifp) :
+	reader = BINARY_INPUT_READERS[os.path.splitext(ifp)[1].lower()]
+	try :
+		return reader(ifp)
+	except (OSError,ValueError,KeyError,zipfile.BadZipFile) as e :
+		raise DataError('binary input file %s could not be read (%s)!'%(ifp,e))
+
+#returns the keyword dictionary of a binary input file given its columns and metadata strings
+def _make_keyword_dict_(ifp,columns,metadata) :
+	if columns[0] is None or columns[2] is None :
+		raise DataError('binary input %s needs both x and y values!'%(ifp))
+	for name,column in zip(COLUMN_NAMES,columns) :
+		if column is not None and (column.ndim!=1 or column.dtype.kind not in 'iuf') :
+			raise DataError('%s in binary input %s has to be a 1D array of numbers, not %s %s!'%(
+							name,ifp,column.shape,column.dtype))
+	metadata = dict(METADATA_DEFAULTS,**metadata)
+	kwlinesdict = {'x_y_defs':[metadata['x_name'],metadata['x_unit'],metadata['y_name'],metadata['y_unit']],
+				   'x_y_columns':columns}
+	if metadata['fit_model'] is not None :
+		kwlinesdict['fit_model'] = metadata['fit_model']
+	if metadata['aggregation'] is not None :
+		from config import get_aggregation_from_line
+		kwlinesdict['aggregation'] = get_aggregation_from_line(metadata['aggregation'])
+	return kwlinesdict
+
+#the reader for each binary input file extension
+BINARY_INPUT_READERS = {'.npy':read_npy_input,'.npz':read_npz_input,'.ffc':read_columnar_input}
+#extensions of every kind of input file (text and binary)
+INPUT_FILE_EXTENSIONS = ['.csv']+list(BINARY_INPUT_READERS)
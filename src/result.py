@@ -0,0 +1,125 @@
+###################################################################################################
+### This file contains the FitResult class for the FriendlyFitter package. ########################
+### copyright 2019/contact margaret.eminizer@gmail.com ############################################
+###################################################################################################
+
+#imports
+import json
+import math
+import numpy as np
+
+#FitResult class: everything that comes out of minimizing a fit, so it never has to be redone
+#(the covariance matrix is already rescaled by chi2/ndf like the parameter uncertainties, and
+# the residuals are only those of the datapoints used in the fit if some were sigma-clipped, or
+# those of the pseudo-points if the datapoints were aggregated into bins before fitting)
+class FitResult(object) :
+
+	def __init__(self,names,values,covariance,weighted_residuals,residuals,fit_type,model_name,engine,
+				 loss='linear',mask=None,aggregation=None) :
+		self._names = names
+		self._values = np.asarray(values,dtype=np.float64)
+		self._covariance = np.asarray(covariance,dtype=np.float64)
+		self._weighted_residuals = weighted_residuals
+		self._residuals = residuals
+		self._fit_type = fit_type
+		self._model_name = model_name
+		self._engine = engine
+		self._loss = loss
+		self._mask = mask
+		#dictionary describing how the datapoints were aggregated (None if they weren't)
+		self._aggregation = aggregation
+
+	def names(self) :
+		return self._names
+	def values(self) :
+		return self._values
+	def errors(self) :
+		return np.sqrt(np.absolute(np.diagonal(self._covariance)))
+	def covariance(self) :
+		return self._covariance
+	def correlation(self) :
+		errors = self.errors()
+		with np.errstate(divide='ignore',invalid='ignore') :
+			return self._covariance/np.outer(errors,errors)
+	#chi2 is the sum of the squares of the (weighted) residuals that were minimized
+	#(for a robust loss, twice the minimized loss; for aggregated datapoints, including the part
+	# from the spread of the datapoints inside the bins, so it's the chi2 of every datapoint)
+	def chi2(self) :
+		chi2 = float((self._weighted_residuals**2).sum())
+		return chi2 if self._aggregation is None else chi2+self._aggregation['chi2_offset']
+	def ndf(self) :
+		return self.nPoints()-len(self._values)
+	#number of datapoints that went into the fit (not the number of pseudo-points)
+	def nPoints(self) :
+		return len(self._weighted_residuals) if self._aggregation is None else self._aggregation['n_points']
+	def chi2PerNdf(self) :
+		return self.chi2()/self.ndf() if self.ndf()>0 else float('nan')
+	#residuals as minimized (including weights) and plain y(data)-y(fit) residuals
+	def weightedResiduals(self) :
+		return self._weighted_residuals
+	def residuals(self) :
+		return self._residuals
+	def fit_type(self) :
+		return self._fit_type
+	def model_name(self) :
+		return self._model_name
+	def engine(self) :
+		return self._engine
+	def loss(self) :
+		return self._loss
+	#mask of the datapoints used in the fit (None if none were rejected)
+	def mask(self) :
+		return self._mask
+	def nRejected(self) :
+		return 0 if self._mask is None else int((~self._mask).sum())
+	def rejectedIndices(self) :
+		return np.empty(0,dtype=np.int64) if self._mask is None else np.flatnonzero(~self._mask)
+	def aggregation(self) :
+		return self._aggregation
+	#returns a dictionary of the result that can be written as JSON (without the residuals, and
+	#with the loss, rejected datapoints, and aggregation only if there's a robust loss, sigma
+	#clipping, or aggregation)
+	def toDict(self) :
+		resultdict = {'fit_type':self._fit_type,
+					  'model':self._model_name,
+					  'engine':self._engine,
+					  'parameters':list(self._names),
+					  'values':self._values.tolist(),
+					  'errors':self.errors().tolist(),
+					  'covariance':self._covariance.tolist(),
+					  'correlation':self.correlation().tolist(),
+					  'chi2':self.chi2(),
+					  'ndf':self.ndf(),
+					  'chi2_per_ndf':self.chi2PerNdf(),
+					  'n_points':self.nPoints()}
+		if self._loss!='linear' :
+			resultdict['loss'] = self._loss
+		if self._mask is not None :
+			resultdict['n_rejected'] = self.nRejected()
+			resultdict['rejected_indices'] = self.rejectedIndices().tolist()
+		if self._aggregation is not None :
+			resultdict['aggregation'] = dict(self._aggregation)
+		return resultdict
+	#(with the entries of an optional dictionary of extras, like a chi2 scan, added; undefined
+	# numbers like the errors of a fit with no degrees of freedom are written as null)
+	def writeJSON(self,filename,extras=None) :
+		resultdict = self.toDict()
+		if extras is not None :
+			resultdict.update(extras)
+		with open(filename,'w') as fp :
+			json.dump(get_json_safe(resultdict),fp,indent=1,allow_nan=False)
+			fp.write('\n')
+
+# file-scope functions
+#returns a copy of a (nested) dictionary or list with every nan or infinite number replaced by
+#None, since JSON has no way to write them
+def get_json_safe(obj) :
+	if isinstance(obj,dict) :
+		return dict([(k,get_json_safe(v)) for k,v in obj.items()])
+	if isinstance(obj,np.ndarray) :
+		obj = obj.tolist()
+	if isinstance(obj,(list,tuple)) :
+		return [get_json_safe(v) for v in obj]
+	if isinstance(obj,float) and not math.isfinite(obj) :
+		return None
+	return obj
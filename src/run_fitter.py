@@ -6,62 +6,431 @@
 
 #imports
 from optparse import OptionParser
-from os import path, system
-from config import Config
-from fit import Fit
+from os import path, getcwd
+from glob import glob
+from io import StringIO
+from contextlib import redirect_stdout
+from traceback import format_exc
+from config import Config, FIT_TYPES
+from cache import ConfigCache, ResultCache
+from fit import Fit, ENGINES, LOSS_FUNCTIONS, SIGMA_CLIP_MAX_ITERATIONS
+from scans import DEFAULT_SCAN_POINTS, DEFAULT_SCAN_REFINEMENTS
+from writers import WRITERS, get_output_writer, get_output_format
+from readers import INPUT_FILE_EXTENSIONS, is_binary_input, get_binary_input_problem
+from diagnostics import FriendlyFitterError, ConfigError, configure_console_logging
+from plotting import PLOT_METHODS
+from profiling import Profiler
 from datetime import date
+from collections import Counter
 
-#User Options
-parser = OptionParser()
-#Run with what input file?
-parser.add_option('-I','--input', type='string', action='store', dest='inputfilepath',
-				  default='speed_of_light_example_input.csv', 
-				  help='Path to input csv file')
-#Run with what output file name?
-parser.add_option('-O','--output', type='string', action='store', dest='outputfilename',
-				  default='', 
-				  help='Name of file to store output')
-#parser.add_option('--saveToys',  action='store_true', dest='savetoys')
-(options, args) = parser.parse_args()
+#Pipeline functions
+#run the whole fit for one input file, returning the name of the output file and the fit result
+#(as a dictionary)
+#(outputfilename is the name for the output/plot files, or '' for the default names, which
+# include the tag so that different input files don't overwrite each other's output;
+# the plot is rendered in the background if a plotexecutor is given, and with profile=True the
+# time/memory of every stage is printed at the end and written to a _profile.json file, with
+# memory tracing if profilememory=True; the fit minimizes the given loss function, and if
+# sigmaclip is given the datapoints further than that many sigma from the fit are rejected
+# iteratively, in at most clipiterations passes; with scan=True the chi2 is scanned over a grid of
+# scanpoints values of the two parameters in scanparameters (the first two if None) for the
+# contour plot and profile intervals; the files with default names go in outputdir, or the
+# current directory if it's '')
+def run_fit(inputfilepath,outputfilename='',tag='',engine=None,cachedir=None,plot=True,
+			fit_type=None,ntoys=0,bootstrap=False,seed=0,savetoys=False,workers=1,
+			plotmethod='auto',plotexecutor=None,profile=False,profilememory=False,
+			loss='linear',lossscale=None,sigmaclip=None,clipiterations=SIGMA_CLIP_MAX_ITERATIONS,
+			scan=False,scanparameters=None,scanpoints=DEFAULT_SCAN_POINTS,
+			scanrefinements=DEFAULT_SCAN_REFINEMENTS,outputdir='') :
+	print('Running FriendlyFitter with input file '+inputfilepath+'...')
+
+	#Get the fit configuration from the config file parser
+	print('	Building fit configuration...')
+	if not path.isfile(inputfilepath) :
+		raise ConfigError('file '+inputfilepath+' does not exist!')
+	thisfitprofiler = Profiler(trace_memory=profilememory) if profile else None
+	thisfitcache = ConfigCache(cachedir) if cachedir!=None else None
+	#(fit results are cached in their own subdirectory)
+	thisfitresultcache = ResultCache(path.join(cachedir,'results')) if cachedir!=None else None
+	thisfitconfig = Config(inputfilepath,fit_type_override=fit_type,cache=thisfitcache,
+						   profiler=thisfitprofiler)
+	print('	Done.')
+
+	#Initialize the fit with the configuration
+	print('	Initializing fit object...')
+	thisfit = Fit(thisfitconfig,engine=engine,profiler=thisfitprofiler,loss=loss,loss_scale=lossscale,
+				  resultcache=thisfitresultcache)
+	print('	Done.')
+
+	#perform the fit
+	print('	Minimizing...')
+	thisfit.minimize()
+	print('	Done.')
+
+	#reject outliers
+	if sigmaclip!=None :
+		print('	Sigma clipping...')
+		thisfit.sigmaClip(sigmaclip,clipiterations)
+		print('	Done.')
+
+	#run toys/bootstrap fits
+	if ntoys>0 :
+		print('	Fitting toys...')
+		toyresults = thisfit.runToys(ntoys,seed=seed,bootstrap=bootstrap,workers=workers)
+		if savetoys :
+			toyfilename = ( path.join(outputdir,'FriendlyFitter_toys_'+tag+str(date.today())+'.npz')
+							if outputfilename=='' else outputfilename+'_toys.npz' )
+			print('	Saving toy results to file '+toyfilename+'...')
+			toyresults.save(toyfilename)
+		print('	Done.')
+
+	#scan the chi2 around the minimum
+	if scan :
+		print('	Scanning chi2...')
+		thisfit.scanChi2(scanparameters,scanpoints,scanrefinements,workers=workers)
+		print('	Done.')
+
+	#write the output file
+	outfilename = ( path.join(outputdir,'FriendlyFitter_output_'+tag+str(date.today())+'.txt')
+					if outputfilename=='' else outputfilename )
+	if not outfilename.endswith('.txt') : outfilename+='.txt'
+	resultfilename = outfilename[:-len('.txt')]+'.json'
+	print('	Writing output of fit to files '+outfilename+' and '+resultfilename+'...')
+	thisfit.writeOutput(outfilename,resultfilename)
+	print('	Done.')
+
+	#save a plot of the fit
+	if plot :
+		plotfilename = ( path.join(outputdir,'FriendlyFitter_plot_'+tag+str(date.today())+'.png')
+						 if outputfilename=='' else outputfilename )
+		if not plotfilename.endswith('.png') : plotfilename+='.png'
+		if plotexecutor!=None :
+			print('	Rendering fit plot to file '+plotfilename+' in the background...')
+			future = thisfit.savePlot(plotfilename,method=plotmethod,executor=plotexecutor)
+			future.add_done_callback(report_plot_failure)
+		else :
+			print('	Saving fit plot to file '+plotfilename+'...')
+			thisfit.savePlot(plotfilename,method=plotmethod)
+		print('	Done.')
+
+	#write out the profile of the fit
+	if thisfitprofiler!=None :
+		profilefilename = outfilename[:-len('.txt')]+'_profile.json'
+		thisfitprofiler.printSummary()
+		print('	Writing profile of fit to file '+profilefilename+'...')
+		thisfitprofiler.writeJSON(profilefilename)
+		thisfitprofiler.stop()
+		print('	Done.')
+
+	print('All done!')
+	return outfilename, thisfit.result().toDict()
+
+#run the fit for one input file without letting an error stop anything else (runoptions is a
+#dictionary of the rest of run_fit's arguments; the package's messages are captured too),
+#returning the input file path, whether it succeeded, the output file name, the fit result
+#dictionary and the printout
+def run_fit_safely(inputfilepath,outputfilename,tag,runoptions) :
+	printout = StringIO(); success = False; outfilename = None; resultdict = None
+	configure_console_logging()
+	with redirect_stdout(printout) :
+		try :
+			outfilename, resultdict = run_fit(inputfilepath,outputfilename,tag,**runoptions)
+			success = True
+		except FriendlyFitterError as e :
+			print('ERROR: '+str(e))
+		except SystemExit :
+			pass
+		except Exception :
+			print(format_exc())
+	return inputfilepath, success, outfilename, resultdict, printout.getvalue()
+
+#run the fits (a list of run_fit_safely arguments) in the fitter daemon at the given address
+#(the default one if None), returning their results like run_fit_safely does, or None if no
+#daemon is running there (the output files are written in the current directory all the same,
+#since every path the daemon gets is made absolute here)
+def run_fits_in_daemon(address,jobs) :
+	from daemon import send_requests, get_default_address, parse_address
+	#("run" requests write files, so the daemon only takes them over its Unix socket)
+	try :
+		host, port = parse_address(address if address!=None else get_default_address())
+	except ConfigError as e :
+		print('WARNING: '+str(e)+' Fitting here instead.')
+		return None
+	if host!=None :
+		if address!=None :
+			print('WARNING: the daemon only runs fits over its Unix socket, not at %s. Fitting here instead.'%(address))
+		return None
+	requests = []
+	for ifp,ofn,tag,runoptions in jobs :
+		runoptions = dict(runoptions,outputdir=getcwd())
+		if runoptions.get('cachedir')!=None :
+			runoptions['cachedir'] = path.abspath(runoptions['cachedir'])
+		requests.append({'command':'run','input':path.abspath(ifp),
+						 'output':path.abspath(ofn) if ofn!='' else '','tag':tag,'options':runoptions})
+	try :
+		answers = send_requests(requests,address)
+	except (OSError,ValueError) :
+		return None
+	except ConfigError as e :
+		print('WARNING: '+str(e)+' Fitting here instead.')
+		return None
+	results = []
+	for (ifp,ofn,tag,runoptions),answer in zip(jobs,answers) :
+		if answer.get('ok',False) :
+			results.append((ifp,answer['success'],answer['output_file'],answer['result'],answer['printout']))
+		else :
+			results.append((ifp,False,None,None,'ERROR: '+answer.get('error','unknown error')+'\n'))
+	return results
+
+#print a warning if a plot rendered in the background didn't work
+def report_plot_failure(future) :
+	if future.exception()!=None :
+		print('WARNING: background plot rendering failed: '+repr(future.exception()))
+
+#returns the list of input files given a list of file paths, glob patterns, and/or directories
+#(every csv and binary input file in a directory is used, except for binary files that can't be
+#fit, like the .npz results and toys the fitter writes itself)
+def get_input_file_paths(inputs) :
+	inputfilepaths = []
+	for inp in inputs :
+		if path.isdir(inp) :
+			for ifp in sorted(sum([glob(path.join(inp,'*'+ext)) for ext in INPUT_FILE_EXTENSIONS],[])) :
+				problem = get_binary_input_problem(ifp) if is_binary_input(ifp) else None
+				if problem!=None :
+					print('WARNING: skipping '+ifp+', which is not a fitter input file ('+problem+')')
+					continue
+				inputfilepaths.append(ifp)
+		elif any([c in inp for c in '*?[']) :
+			inputfilepaths+=sorted(glob(inp))
+		else :
+			inputfilepaths.append(inp)
+	return inputfilepaths
+
+#returns a different name stem for the output files of each input file: its name without the
+#extension, plus the extension if another input file has the same stem, plus the name of its
+#directory if that's still the same, plus a counter if even that's still the same
+def get_output_stems(inputfilepaths) :
+	stems = [path.splitext(path.basename(ifp))[0] for ifp in inputfilepaths]
+	additions = [lambda ifp, stem : stem+'_'+path.splitext(ifp)[1].lstrip('.'),
+				 lambda ifp, stem : path.basename(path.dirname(path.abspath(ifp)))+'_'+stem]
+	for addition in additions :
+		counts = Counter(stems)
+		stems = [addition(ifp,stem) if counts[stem]>1 else stem for ifp,stem in zip(inputfilepaths,stems)]
+	counts = Counter(stems); seen = Counter()
+	for i,stem in enumerate(stems) :
+		if counts[stem]>1 :
+			seen[stem]+=1
+			stems[i] = stem+'_'+str(seen[stem])
+	return stems
 
 #Main script
-print('Running FriendlyFitter with input file '+options.inputfilepath+'...')
-
-#Get the fit configuration from the config file parser
-print('	Building fit configuration...')
-if not path.isfile(options.inputfilepath) :
-	print('ERROR: file '+options.inputfilepath+' does not exist!')
-	exit()
-thisfitconfig = Config(options.inputfilepath)
-print('	Done.')
-
-#Initialize the fit with the configuration
-print('	Initializing fit object...')
-thisfit = Fit(thisfitconfig)
-print('	Done.')
-
-#perform the fit
-print('	Minimizing...')
-thisfit.minimize()
-print('	Done.')
-
-#write the output file
-outfilename = ( 'FriendlyFitter_output_'+str(date.today())+'.txt' if options.outputfilename=='' 
-				else options.outputfilename )
-if not outfilename.endswith('.txt') : outfilename+='.txt'
-print('	Writing output of fit to file '+outfilename+'...')
-thisfit.writeOutput(outfilename)
-print('	Done.')
-
-#save a plot of the fit
-plotfilename = ( 'FriendlyFitter_plot_'+str(date.today())+'.png' if options.outputfilename=='' 
-				else options.outputfilename )
-if not plotfilename.endswith('.png') : plotfilename+='.png'
-print('	Saving fit plot to file '+plotfilename+'...')
-thisfit.savePlot(plotfilename)
-print('	Done.')
-
-print('All done!')
-
-print('Output file:')
-system('cat '+outfilename)
+if __name__=='__main__' :
+
+	#User Options
+	parser = OptionParser(usage='%prog [options] [more input files, globs, or directories]')
+	#Run with what input file?
+	parser.add_option('-I','--input', type='string', action='store', dest='inputfilepath',
+					  default=None,
+					  help='Path to input csv (or binary .npy/.npz/.ffc) file (a glob pattern or directory of them also works; speed_of_light_example_input.csv if no input files are given at all)')
+	#Run with what output file name?
+	parser.add_option('-O','--output', type='string', action='store', dest='outputfilename',
+					  default='',
+					  help='Name of file to store output (prefix of the names for multiple input files)')
+	#Use which minimizer engine?
+	parser.add_option('-E','--engine', type='choice', action='store', dest='engine',
+					  choices=list(ENGINES), default=None,
+					  help='Minimizer engine to use (by default "analytic" for plain/y-weighted linear fits, "york" for errors-in-variables fits, "least_squares" for robust losses, "leastsq" otherwise)')
+	#Force which type of fit?
+	parser.add_option('-F','--fitType', type='choice', action='store', dest='fittype',
+					  choices=FIT_TYPES, default=None,
+					  help='Type of fit to do (chosen from the uncertainties in the input file if not given)')
+	#Minimize which loss function?
+	parser.add_option('--loss', type='choice', action='store', dest='loss',
+					  choices=list(LOSS_FUNCTIONS), default='linear',
+					  help='Loss function to minimize: "linear" for plain least squares, or a robust loss ("huber", "soft_l1", "cauchy") that down-weights outliers')
+	parser.add_option('--lossScale', type='float', action='store', dest='lossscale', default=None,
+					  help='Size of the (weighted) residuals where the robust loss starts down-weighting them (from the spread of the residuals if not given)')
+	#Reject outliers?
+	parser.add_option('--sigmaClip', type='float', action='store', dest='sigmaclip', default=None,
+					  help='Iteratively reject datapoints more than this many sigma from the fit and refit without them')
+	parser.add_option('--clipIterations', type='int', action='store', dest='clipiterations',
+					  default=SIGMA_CLIP_MAX_ITERATIONS,
+					  help='Largest number of sigma clipping passes')
+	#Cache parsed input files where?
+	parser.add_option('--cacheDir', type='string', action='store', dest='cachedir',
+					  default=None,
+					  help='Directory to cache parsed input files and fit results in (no caching if not given)')
+	#Fit multiple input files (or toys) with how many processes?
+	parser.add_option('-j','--workers', type='int', action='store', dest='workers',
+					  default=1,
+					  help='Number of worker processes to fit multiple input files (or the toys or chi2 scan for a single input file) with')
+	#Skip making the plot?
+	parser.add_option('--noPlot', action='store_true', dest='noplot', default=False,
+					  help='Skip making the plot of the fit')
+	#Skip printing the output file at the end?
+	parser.add_option('-q','--quiet', action='store_true', dest='quiet', default=False,
+					  help="Don't print the output file to the console at the end")
+	#Draw the data how?
+	parser.add_option('--plotMethod', type='choice', action='store', dest='plotmethod',
+					  choices=PLOT_METHODS, default='auto',
+					  help='How to draw the data: every point, "lttb" decimation, or a "hexbin" density map with the outliers ("auto" decimates large datasets)')
+	#Render the plots in the background?
+	parser.add_option('--asyncPlot', action='store_true', dest='asyncplot', default=False,
+					  help='Render plots in a background process so the next fit can start right away')
+	#Record the time/memory of each stage?
+	parser.add_option('--profile', action='store_true', dest='profile', default=False,
+					  help='Print the time and memory used by each stage of the fit and save them to a _profile.json file')
+	#Trace the memory of each stage too?
+	parser.add_option('--profileMemory', action='store_true', dest='profilememory', default=False,
+					  help='With --profile, also trace the peak memory allocated during each stage (slow)')
+	#Collect the results of every fit in which file?
+	parser.add_option('--resultsFile', type='string', action='store', dest='resultsfilename',
+					  default=None,
+					  help='File to append the results of every fit to (.jsonl, .csv, or .npz)')
+	parser.add_option('--resultsFormat', type='choice', action='store', dest='resultsformat',
+					  choices=sorted(WRITERS), default=None,
+					  help='Format of the results file (from its extension if not given)')
+	#Run how many toys?
+	parser.add_option('--toys', type='int', action='store', dest='ntoys', default=0,
+					  help='Number of toy pseudo-datasets to generate and fit after the fit')
+	#Resample the data for the toys instead?
+	parser.add_option('--bootstrap', action='store_true', dest='bootstrap', default=False,
+					  help='Make the toys by resampling the datapoints (bootstrap) instead of from the best fit')
+	#Random seed for the toys?
+	parser.add_option('--seed', type='int', action='store', dest='seed', default=0,
+					  help='Random seed for the toys')
+	#Save the toy results?
+	parser.add_option('--saveToys', action='store_true', dest='savetoys', default=False,
+					  help='Save the fitted parameters of every toy to a .npz file')
+	#Scan the chi2 for contours and profile intervals?
+	parser.add_option('--scan', action='store_true', dest='scan', default=False,
+					  help='Scan the chi2 over a grid of two parameters to plot their 1 and 2 sigma contours and find their profile intervals')
+	parser.add_option('--scanParameters', type='string', action='store', dest='scanparameters',
+					  default=None,
+					  help='Comma-separated short names of the two parameters to scan (the first two by default)')
+	parser.add_option('--scanPoints', type='int', action='store', dest='scanpoints',
+					  default=DEFAULT_SCAN_POINTS,
+					  help='Number of grid points along each scanned parameter')
+	parser.add_option('--scanRefinements', type='int', action='store', dest='scanrefinements',
+					  default=DEFAULT_SCAN_REFINEMENTS,
+					  help='Number of times the scan grid zooms in on the 2 sigma contour')
+	#Forward the fits to a running fitter daemon?
+	parser.add_option('--daemon', type='string', action='store', dest='daemonaddress', default=None,
+					  help='Address (Unix socket path or host:port) of the fitter daemon to send the fits to if it is running (the default address of daemon.py if not given)')
+	parser.add_option('--noDaemon', action='store_true', dest='nodaemon', default=False,
+					  help='Always run the fits here, even if a fitter daemon is running')
+	(options, args) = parser.parse_args()
+
+	#print the package's messages to the console
+	configure_console_logging()
+	if options.resultsfilename!=None :
+		try :
+			get_output_format(options.resultsfilename,options.resultsformat)
+		except ConfigError as e :
+			print('ERROR: '+str(e))
+			exit()
+	#(the example input file is only fit if there are no other input files)
+	inputs = ([options.inputfilepath] if options.inputfilepath!=None else [])+args
+	if len(inputs)==0 :
+		inputs = ['speed_of_light_example_input.csv']
+	inputfilepaths = get_input_file_paths(inputs)
+	#(a results file in the same directory as the input files isn't an input file itself)
+	if options.resultsfilename!=None :
+		inputfilepaths = [ifp for ifp in inputfilepaths
+						  if path.abspath(ifp)!=path.abspath(options.resultsfilename)]
+	runoptions = {'engine':options.engine,'cachedir':options.cachedir,'plot':not options.noplot,
+				  'fit_type':options.fittype,'ntoys':options.ntoys,'bootstrap':options.bootstrap,
+				  'seed':options.seed,'savetoys':options.savetoys,'plotmethod':options.plotmethod,
+				  'profile':options.profile,'profilememory':options.profilememory,
+				  'loss':options.loss,'lossscale':options.lossscale,'sigmaclip':options.sigmaclip,
+				  'clipiterations':options.clipiterations,'scan':options.scan,
+				  'scanparameters':( options.scanparameters.split(',') if options.scanparameters!=None
+									 else None ),
+				  'scanpoints':options.scanpoints,'scanrefinements':options.scanrefinements}
+	#plots rendered in the background go to their own process (unless the fits already run in
+	#parallel worker processes)
+	plotexecutor = None
+	if options.asyncplot and not options.noplot :
+		if len(inputfilepaths)>1 and options.workers>1 :
+			print('INFO: plots are already rendered in parallel with -j; ignoring --asyncPlot')
+		else :
+			from concurrent.futures import ProcessPoolExecutor
+			plotexecutor = ProcessPoolExecutor(max_workers=1)
+
+	#a single input file runs right here like always (or in the fitter daemon if one is running)
+	if len(inputs)==1 and inputfilepaths==inputs :
+		daemonresults = None
+		if not options.nodaemon :
+			daemonresults = run_fits_in_daemon(options.daemonaddress,
+											   [(inputfilepaths[0],options.outputfilename,'',
+												 dict(runoptions,workers=options.workers))])
+		if daemonresults!=None :
+			ifp, success, outfilename, resultdict, printout = daemonresults[0]
+			print(printout,end='')
+			if not success :
+				exit()
+		else :
+			try :
+				outfilename, resultdict = run_fit(inputfilepaths[0],options.outputfilename,
+												  workers=options.workers,plotexecutor=plotexecutor,
+												  **runoptions)
+			except FriendlyFitterError as e :
+				print('ERROR: '+str(e))
+				exit()
+		if options.resultsfilename!=None :
+			with get_output_writer(options.resultsfilename,options.resultsformat) as writer :
+				writer.write(resultdict,inputfilepaths[0])
+		if not options.quiet :
+			print('Output file:')
+			with open(outfilename,'r') as fp :
+				print(fp.read(),end='')
+		if plotexecutor!=None :
+			plotexecutor.shutdown(wait=True)
+		exit()
+
+	#otherwise fit every input file, each with its own output files, and collect the results
+	print('Running FriendlyFitter on '+str(len(inputfilepaths))+' input files with '+
+		  str(options.workers)+' worker(s)...')
+	jobs = []
+	for ifp,stem in zip(inputfilepaths,get_output_stems(inputfilepaths)) :
+		ofn = options.outputfilename+'_'+stem if options.outputfilename!='' else ''
+		jobs.append((ifp,ofn,stem+'_',runoptions))
+	results = None if options.nodaemon else run_fits_in_daemon(options.daemonaddress,jobs)
+	if results!=None :
+		for result in results :
+			print(result[4],end='')
+	elif options.workers>1 :
+		results = []
+		from concurrent.futures import ProcessPoolExecutor, as_completed
+		with ProcessPoolExecutor(max_workers=options.workers) as executor :
+			futures = [executor.submit(run_fit_safely,*job) for job in jobs]
+			for future in as_completed(futures) :
+				results.append(future.result())
+				print(results[-1][4],end='')
+	else :
+		results = []
+		if plotexecutor!=None :
+			runoptions['plotexecutor'] = plotexecutor
+		for job in jobs :
+			results.append(run_fit_safely(*job))
+			print(results[-1][4],end='')
+	#wait for any plots still being rendered
+	if plotexecutor!=None :
+		plotexecutor.shutdown(wait=True)
+	results.sort(key=lambda r : r[0])
+	#collect the results of all the fits that worked in one file
+	if options.resultsfilename!=None :
+		with get_output_writer(options.resultsfilename,options.resultsformat) as writer :
+			for ifp, success, outfilename, resultdict, printout in results :
+				if success :
+					writer.write(resultdict,ifp)
+		print('Wrote results of '+str(writer.nWritten())+' fits to '+options.resultsfilename)
+	#summarize how every file went
+	print('Summary:')
+	for ifp, success, outfilename, resultdict, printout in results :
+		if success :
+			print('	SUCCEEDED: '+ifp+' (output in '+outfilename+')')
+		else :
+			print('	FAILED:    '+ifp)
+	nfailed = [r[1] for r in results].count(False)
+	print(str(len(results)-nfailed)+' of '+str(len(results))+' fits succeeded.')
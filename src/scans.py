@@ -0,0 +1,228 @@
+###################################################################################################
+### This file contains the chi2 scan functions and Chi2Scan class for the FriendlyFitter package. #
+### copyright 2019/contact margaret.eminizer@gmail.com ############################################
+###################################################################################################
+
+#imports
+import numpy as np
+from models import get_model
+from diagnostics import FitError, get_logger
+
+#constants
+#logger for the messages from this module
+logger = get_logger('scans')
+#number of grid points x datapoints evaluated at once in one chunk
+SCAN_CHUNK_ELEMENTS = 2**22
+#default number of grid points along each of the two scanned parameters
+DEFAULT_SCAN_POINTS = 101
+#the first grid goes this many parameter uncertainties out from the best fit in each direction
+SCAN_RANGE_SIGMAS = 4.
+#default number of times the grid is zoomed in on the largest contour
+DEFAULT_SCAN_REFINEMENTS = 1
+#most times the grid is made twice as wide if the largest contour doesn't fit on it
+SCAN_MAX_WIDENINGS = 5
+#delta chi2 of the 1 and 2 sigma contours of two parameters (68.27% and 95.45% coverage), and of
+#the 1 and 2 sigma profile intervals of one
+CONTOUR_DELTA_CHI2 = {1:2.2957,2:6.1801}
+PROFILE_DELTA_CHI2 = {1:1.,2:4.}
+
+#Chi2Scan class: delta chi2 on a grid of values of two parameters (minimized over any others),
+#its contours, and the profile intervals of the two parameters (from the smallest delta chi2 over
+#the other parameter at each value). The chi2 is divided by the best fit's chi2/ndf, like the
+#parameter uncertainties are scaled.
+class Chi2Scan(object) :
+
+	def __init__(self,names,best_fit_values,xvalues,yvalues,deltachi2) :
+		self._names = names
+		self._best_fit_values = np.asarray(best_fit_values,dtype=np.float64)
+		self._xvalues = xvalues
+		self._yvalues = yvalues
+		#one row per x value, one column per y value
+		self._deltachi2 = deltachi2
+
+	def names(self) :
+		return self._names
+	def bestFitValues(self) :
+		return self._best_fit_values
+	def xValues(self) :
+		return self._xvalues
+	def yValues(self) :
+		return self._yvalues
+	def deltaChi2(self) :
+		return self._deltachi2
+	def contourLevels(self) :
+		return CONTOUR_DELTA_CHI2
+	#returns the grid values of parameter i (0 or 1) and the profile delta chi2 at each of them
+	def profile(self,i) :
+		if i==0 :
+			return self._xvalues, self._deltachi2.min(axis=1)
+		return self._yvalues, self._deltachi2.min(axis=0)
+	#returns the (low,high) nsigma profile interval of parameter i, interpolated between the grid
+	#points (an end is nan if the interval runs off the grid there)
+	def interval(self,i,nsigma=1) :
+		values, profile = self.profile(i)
+		return get_interval_from_profile(values,profile,PROFILE_DELTA_CHI2[nsigma])
+	def printSummary(self) :
+		logger.info('		Scanned chi2 on a %dx%d grid of %s and %s',len(self._xvalues),len(self._yvalues),
+					self._names[0],self._names[1])
+		for i,name in enumerate(self._names) :
+			for nsigma in sorted(PROFILE_DELTA_CHI2) :
+				logger.info('		Profile %d sigma interval of "%s": [%e, %e]',nsigma,name,*self.interval(i,nsigma))
+	#returns a dictionary of the best fit values and profile intervals that can be written as JSON
+	def toDict(self) :
+		return {'parameters':list(self._names),
+				'best_fit_values':self._best_fit_values.tolist(),
+				'grid_points':[len(self._xvalues),len(self._yvalues)],
+				'intervals':dict([(name,dict([(str(nsigma),list(self.interval(i,nsigma)))
+											  for nsigma in sorted(PROFILE_DELTA_CHI2)]))
+								  for i,name in enumerate(self._names)])}
+	#save the whole grid to a .npz file
+	def save(self,filename) :
+		np.savez(filename,names=np.array(self._names),best_fit_values=self._best_fit_values,
+				 x_values=self._xvalues,y_values=self._yvalues,delta_chi2=self._deltachi2)
+
+# file-scope functions
+#scans the chi2 of a fit over a grid of the parameters with indices i and j around their best fit
+#values (the others are set to the values minimizing the chi2 at each grid point, which only
+#works for models linear in their parameters), zooming in on the largest contour refinements
+#times, and returns a Chi2Scan. x/y/w/x_unc/y_unc are the data columns (w the weights), sigma_sq the
+#best fit's chi2/ndf, and chi2_offset an optional function adding to the chi2 of an array of
+#parameter values (one row per parameter).
+def run_chi2_scan(fit_type,model_name,x,y,w,x_unc,y_unc,names,best_fit_values,errors,i,j,sigma_sq,
+				  npoints=DEFAULT_SCAN_POINTS,refinements=DEFAULT_SCAN_REFINEMENTS,workers=1,
+				  chi2_offset=None) :
+	best = np.asarray(best_fit_values,dtype=np.float64)
+	#the other parameters are profiled out in closed form
+	others = [k for k in range(len(best)) if k not in (i,j)]
+	if len(others)>0 :
+		model = get_model(model_name)
+		if not model.isLinear() :
+			raise FitError('chi2 scans of models with more than two parameters need a model linear in '+
+						   'its parameters (like a polynomial), not %s!'%(model_name))
+		profile_others = get_linear_profiler(model,best,x,y,w,i,j,others)
+	def get_chi2(pvalues) :
+		chi2 = get_chi2_values(fit_type,model_name,pvalues,x,y,w,x_unc,y_unc,workers)
+		return chi2 if chi2_offset is None else chi2+chi2_offset(pvalues)
+	chi2min = get_chi2(best[:,np.newaxis])[0]
+	maxlevel = max(CONTOUR_DELTA_CHI2.values())
+	#start a few uncertainties out from the best fit
+	center = best[[i,j]]
+	halfwidth = SCAN_RANGE_SIGMAS*np.asarray(errors,dtype=np.float64)[[i,j]]
+	halfwidth = np.where(halfwidth>0.,halfwidth,np.maximum(1e-3*np.absolute(center),1e-3))
+	lo, hi = center-halfwidth, center+halfwidth
+	nrefined, nwidened = 0, 0
+	while True :
+		xvalues, yvalues = np.linspace(lo[0],hi[0],npoints), np.linspace(lo[1],hi[1],npoints)
+		grid = np.repeat(best[:,np.newaxis],npoints*npoints,axis=1)
+		grid[i], grid[j] = [a.ravel() for a in np.meshgrid(xvalues,yvalues,indexing='ij')]
+		if len(others)>0 :
+			grid[others] = profile_others(grid[[i,j]])
+		deltachi2 = ((get_chi2(grid)-chi2min)/sigma_sq).reshape(npoints,npoints)
+		inside = deltachi2<=maxlevel
+		if not np.any(inside) :
+			break
+		#widen the grid if the largest contour runs off of it
+		if ( np.any(inside[0]) or np.any(inside[-1]) or np.any(inside[:,0]) or np.any(inside[:,-1]) ) :
+			if nwidened<SCAN_MAX_WIDENINGS :
+				lo, hi = center-2.*(center-lo), center+2.*(hi-center)
+				nwidened+=1
+				continue
+			logger.warning('the %s sigma contour still runs off the scan grid after widening it %d times',
+						   max(CONTOUR_DELTA_CHI2),nwidened)
+			break
+		if nrefined>=refinements :
+			break
+		#zoom in on the largest contour (with one more grid point around it)
+		rows, columns = np.flatnonzero(inside.any(axis=1)), np.flatnonzero(inside.any(axis=0))
+		lo = np.array([xvalues[max(rows[0]-1,0)],yvalues[max(columns[0]-1,0)]])
+		hi = np.array([xvalues[min(rows[-1]+1,npoints-1)],yvalues[min(columns[-1]+1,npoints-1)]])
+		nrefined+=1
+	scan = Chi2Scan([names[i],names[j]],center,xvalues,yvalues,deltachi2)
+	scan.printSummary()
+	return scan
+
+#returns a function giving the values of the parameters with indices in others that minimize the
+#chi2 for each column of values of the parameters i and j, for a model linear in its parameters
+#(whose weighted residuals w*(A^T p-y) have the constant design matrix A, its jacobian): they're
+#the least squares solution for the data minus the scanned parameters' part, which is linear in
+#the scanned values, so it's solved once up front
+def get_linear_profiler(model,best,x,y,w,i,j,others) :
+	design = model.jacobian(best,x)*w
+	solution = np.linalg.lstsq(design[others].T,np.column_stack((w*y,design[[i,j]].T)),rcond=None)[0]
+	offset, coefficients = solution[:,0], solution[:,1:]
+	return lambda scanned : offset[:,np.newaxis]-np.dot(coefficients,scanned)
+
+#returns the chi2 of the fit for every column of pvalues (one row per parameter) in broadcasted
+#chunks (spread over worker processes if workers>1); a line just needs the weighted sums of the
+#data, so it takes one pass over the data however big the grid is (or one per slope value for
+#errors-in-variables fits, whose weights depend on the slope)
+def get_chi2_values(fit_type,model_name,pvalues,x,y,w,x_unc,y_unc,workers=1) :
+	pvalues = np.asarray(pvalues,dtype=np.float64)
+	if model_name=='linear' :
+		if fit_type=='linear_errors_in_variables' :
+			return get_line_chi2_values(pvalues,x,y,None,x_unc,y_unc)
+		return get_line_chi2_values(pvalues,x,y,w)
+	chunksize = max(1,SCAN_CHUNK_ELEMENTS//len(x))
+	jobs = [(fit_type,model_name,pvalues[:,start:start+chunksize],x,y,w,x_unc,y_unc)
+			for start in range(0,pvalues.shape[1],chunksize)]
+	if workers>1 and len(jobs)>1 :
+		from concurrent.futures import ProcessPoolExecutor
+		with ProcessPoolExecutor(max_workers=workers) as executor :
+			chunkresults = list(executor.map(get_chi2_chunk,*zip(*jobs)))
+	else :
+		chunkresults = [get_chi2_chunk(*job) for job in jobs]
+	return np.concatenate(chunkresults)
+
+#returns the chi2 for every column of a chunk of pvalues with the same residuals the Fit class
+#minimizes, evaluated for all of them at once as a 2D (grid point x datapoint) array
+def get_chi2_chunk(fit_type,model_name,pvalues,x,y,w,x_unc,y_unc) :
+	p = pvalues[:,:,np.newaxis]
+	fdiff = get_model(model_name).evaluate(p,x)-y
+	if fit_type=='linear_errors_in_variables' :
+		resids = fdiff/np.sqrt(y_unc**2+(p[0]*x_unc)**2)
+	else :
+		resids = w*fdiff
+	return (resids**2).sum(axis=-1)
+
+#returns the chi2 of the residuals w*(mx+b-y) for every column of pvalues ([slope,intercept] rows)
+#from the weighted means and centered second moments of the data; without weights, they're the
+#errors-in-variables ones 1/sqrt(y_unc^2+(m*x_unc)^2), and the sums are done for each slope
+def get_line_chi2_values(pvalues,x,y,w,x_unc=None,y_unc=None) :
+	slope, intercept = pvalues[0], pvalues[1]
+	if w is not None :
+		sumw, xbar, ybar, sxx, sxy, syy = get_weighted_moments((w**2)[np.newaxis,:],x,y)
+		slopeindex = np.zeros(len(slope),dtype=np.int64)
+	else :
+		slopes, slopeindex = np.unique(slope,return_inverse=True)
+		chunksize = max(1,SCAN_CHUNK_ELEMENTS//len(x))
+		moments = [get_weighted_moments(1./(y_unc**2+(slopes[start:start+chunksize,np.newaxis]*x_unc)**2),x,y)
+				   for start in range(0,len(slopes),chunksize)]
+		sumw, xbar, ybar, sxx, sxy, syy = [np.concatenate(m) for m in zip(*moments)]
+	sumw, xbar, ybar, sxx, sxy, syy = [m[slopeindex] for m in (sumw,xbar,ybar,sxx,sxy,syy)]
+	return sumw*(slope*xbar+intercept-ybar)**2+slope**2*sxx-2.*slope*sxy+syy
+
+#returns the sums of the weights, weighted means of x and y, and weighted centered x-x, x-y, and
+#y-y second moments for each row of a 2D array of (squared) weights
+def get_weighted_moments(wsq,x,y) :
+	sumw = wsq.sum(axis=-1)
+	xbar, ybar = np.dot(wsq,x)/sumw, np.dot(wsq,y)/sumw
+	dx, dy = x-xbar[:,np.newaxis], y-ybar[:,np.newaxis]
+	return sumw, xbar, ybar, (wsq*dx*dx).sum(axis=-1), (wsq*dx*dy).sum(axis=-1), (wsq*dy*dy).sum(axis=-1)
+
+#returns the (low,high) ends of the interval around the minimum of a profile where it's below
+#the given level, interpolated linearly between the values (nan if it runs off either end)
+def get_interval_from_profile(values,profile,level) :
+	imin = int(np.argmin(profile))
+	below = profile<=level
+	ends = []
+	for step in [-1,1] :
+		k = imin
+		while 0<=k+step<len(values) and below[k+step] :
+			k+=step
+		if not 0<=k+step<len(values) :
+			ends.append(float('nan'))
+			continue
+		#interpolate between the last value inside and the first one outside
+		frac = (level-profile[k])/(profile[k+step]-profile[k])
+		ends.append(float(values[k]+frac*(values[k+step]-values[k])))
+	return ends[0], ends[1]
@@ -0,0 +1,156 @@
+###################################################################################################
+### This file contains the toy/bootstrap functions and ToyResults class for the FriendlyFitter ####
+### package. ######################################################################################
+### copyright 2019/contact margaret.eminizer@gmail.com ############################################
+###################################################################################################
+
+#imports
+import numpy as np
+from datasets import get_unnormalized_weights
+from fit import solve_weighted_line, solve_york_line
+from models import get_model
+from diagnostics import get_logger
+
+#constants
+#logger for the messages from this module
+logger = get_logger('toys')
+#number of toy datapoints (toys x points per toy) generated and fit at once in one chunk
+TOY_CHUNK_ELEMENTS = 2**21
+
+#ToyResults class: the fitted parameters of every toy, and their summary statistics
+class ToyResults(object) :
+
+	def __init__(self,names,true_values,values,errors,success) :
+		self._names = names
+		self._true_values = np.asarray(true_values,dtype=np.float64)
+		self._values = values
+		self._errors = errors
+		self._success = success
+
+	def names(self) :
+		return self._names
+	def ntoys(self) :
+		return len(self._success)
+	def nSucceeded(self) :
+		return int(self._success.sum())
+	#parameter values/uncertainties of the toy fits that succeeded (one row per toy)
+	def values(self) :
+		return self._values[self._success]
+	def errors(self) :
+		return self._errors[self._success]
+	def means(self) :
+		return self.values().mean(axis=0)
+	def widths(self) :
+		return self.values().std(axis=0,ddof=1)
+	#pulls are (toy value - best fit value)/(toy uncertainty)
+	def pulls(self) :
+		with np.errstate(divide='ignore',invalid='ignore') :
+			return (self.values()-self._true_values)/self.errors()
+	def pullMeans(self) :
+		return self.pulls().mean(axis=0)
+	def pullWidths(self) :
+		return self.pulls().std(axis=0,ddof=1)
+	def correlationMatrix(self) :
+		return np.atleast_2d(np.corrcoef(self.values(),rowvar=False))
+	def printSummary(self) :
+		logger.info('		%d of %d toy fits succeeded',self.nSucceeded(),self.ntoys())
+		means, widths = self.means(), self.widths()
+		pullmeans, pullwidths = self.pullMeans(), self.pullWidths()
+		for i,name in enumerate(self._names) :
+			logger.info('		Toy parameter "%s": mean = %e, width = %e, pull mean = %.3f, pull width = %.3f',
+						name,means[i],widths[i],pullmeans[i],pullwidths[i])
+		logger.info('		Toy parameter correlation matrix (order %s):',', '.join(self._names))
+		for row in self.correlationMatrix() :
+			logger.info('			%s',' '.join(['%+.4f'%(c) for c in row]))
+	#save all the toy results to a .npz file
+	def save(self,filename) :
+		np.savez(filename,names=np.array(self._names),true_values=self._true_values,
+				 values=self._values,errors=self._errors,success=self._success)
+
+# file-scope functions
+#generates and fits toys in chunks (in parallel if workers>1) and returns a ToyResults object
+#chunks are seeded from the seed with numpy SeedSequences, so the result doesn't depend on workers
+def run_toys(fit_type,model_name,x,y,x_unc,y_unc,best_fit_values,sigma,names,ntoys,seed=0,
+			 bootstrap=False,workers=1) :
+	logger.info('		Running %d %s fits with seed %s on %d worker(s)',ntoys,
+				'bootstrap' if bootstrap else 'toy',seed,workers)
+	x, y = np.asarray(x,dtype=np.float64), np.asarray(y,dtype=np.float64)
+	x_unc, y_unc = np.asarray(x_unc,dtype=np.float64), np.asarray(y_unc,dtype=np.float64)
+	#split up the toys into chunks with their own random number streams
+	chunksize = max(1,TOY_CHUNK_ELEMENTS//len(x))
+	chunksizes = [min(chunksize,ntoys-start) for start in range(0,ntoys,chunksize)]
+	seedseqs = np.random.SeedSequence(seed).spawn(len(chunksizes))
+	jobs = [(fit_type,model_name,x,y,x_unc,y_unc,best_fit_values,sigma,bootstrap,ss,n)
+			for ss,n in zip(seedseqs,chunksizes)]
+	if workers>1 :
+		from concurrent.futures import ProcessPoolExecutor
+		with ProcessPoolExecutor(max_workers=workers) as executor :
+			chunkresults = list(executor.map(fit_toy_chunk,*zip(*jobs)))
+	else :
+		chunkresults = [fit_toy_chunk(*job) for job in jobs]
+	toyresults = ToyResults(names,best_fit_values,
+							np.concatenate([cr[0] for cr in chunkresults]),
+							np.concatenate([cr[1] for cr in chunkresults]),
+							np.concatenate([cr[2] for cr in chunkresults]))
+	toyresults.printSummary()
+	return toyresults
+
+#generates ntoys pseudo-datasets as 2D arrays and fits them all
+#returns 2D arrays of the fitted parameter values and uncertainties and whether each fit succeeded
+def fit_toy_chunk(fit_type,model_name,x,y,x_unc,y_unc,best_fit_values,sigma,bootstrap,seedseq,ntoys) :
+	rng = np.random.default_rng(seedseq)
+	shape = (ntoys,len(x))
+	if bootstrap :
+		#resample the datapoints with replacement
+		idx = rng.integers(0,len(x),size=shape)
+		X, Y, XU, YU = x[idx], y[idx], x_unc[idx], y_unc[idx]
+	else :
+		#smear the best fit function by the uncertainties (or the spread of the residuals)
+		yfit = get_model(model_name).evaluate(np.asarray(best_fit_values,dtype=np.float64),x)
+		ysigma = y_unc if np.any(y_unc!=0.) else np.full(len(x),sigma)
+		Y = yfit+rng.standard_normal(shape)*ysigma
+		X = x+rng.standard_normal(shape)*x_unc if np.any(x_unc!=0.) else np.broadcast_to(x,shape)
+		XU, YU = np.broadcast_to(x_unc,shape), np.broadcast_to(y_unc,shape)
+	return fit_toy_arrays(fit_type,model_name,X,Y,XU,YU,best_fit_values)
+
+#fits every row of the 2D toy arrays the same way the Fit class would fit the original data
+def fit_toy_arrays(fit_type,model_name,X,Y,XU,YU,init_values) :
+	npars = len(init_values)
+	if model_name=='linear' :
+		#lines are solved for all of the toys at once
+		if fit_type=='linear_errors_in_variables' :
+			slope, intercept, pcov, fvec, niter = solve_york_line(X,Y,XU,YU,init_values[0])
+		else :
+			slope, intercept, pcov, fvec = solve_weighted_line(X,Y,get_toy_weights(fit_type,X,Y,XU,YU))
+		values = np.stack((slope,intercept),axis=-1)
+		with np.errstate(divide='ignore',invalid='ignore') :
+			s_sq = (fvec**2).sum(axis=-1)/(X.shape[-1]-npars)
+			errors = np.sqrt(np.absolute(np.diagonal(pcov,axis1=-2,axis2=-1))*s_sq[:,np.newaxis])
+		return values, errors, np.all(np.isfinite(values),axis=-1)
+	#other models need one minimization per toy
+	from scipy import optimize
+	model = get_model(model_name)
+	W = get_toy_weights(fit_type,X,Y,XU,YU)
+	resid = lambda p, x, y, w : w*(model.evaluate(p,x)-y)
+	dfun = (lambda p, x, y, w : w*model.jacobian(p,x)) if model.hasJacobian() else None
+	values = np.full((len(X),npars),np.nan); errors = np.full((len(X),npars),np.nan)
+	for i in range(len(X)) :
+		pfit, pcov, infodict, errmsg, success = optimize.leastsq(resid,init_values,
+																 args=(X[i],Y[i],W[i]),
+																 Dfun=dfun,col_deriv=True,
+																 full_output=True)
+		if success not in range(1,5) or pcov is None :
+			continue
+		s_sq = (infodict['fvec']**2).sum()/(X.shape[-1]-npars)
+		values[i] = pfit
+		errors[i] = np.sqrt(np.absolute(np.diagonal(pcov))*s_sq)
+	return values, errors, np.all(np.isfinite(values),axis=-1)
+
+#returns the 2D array of (normalized) datapoint weights for each toy given the fit type
+def get_toy_weights(fit_type,X,Y,XU,YU) :
+	if fit_type=='linear_least_squares' :
+		return np.ones(X.shape)
+	if fit_type=='linear_least_squares_y_weighted' :
+		XU = np.zeros(X.shape)
+	unnormalized_weights = get_unnormalized_weights(X,Y,XU,YU)
+	return unnormalized_weights/unnormalized_weights.sum(axis=-1)[:,np.newaxis]
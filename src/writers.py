@@ -0,0 +1,143 @@
+###################################################################################################
+### This file contains the output writer classes for the FriendlyFitter package. ##################
+### copyright 2019/contact margaret.eminizer@gmail.com ############################################
+###################################################################################################
+
+#imports
+import os
+import csv
+import json
+import numpy as np
+from diagnostics import ConfigError
+from result import get_json_safe
+
+#constants
+#size of the write buffer for the text writers (in bytes)
+WRITE_BUFFER_BYTES = 2**20
+#columns of the CSV writer (one row per fit parameter)
+CSV_COLUMNS = ['label','fit_type','model','engine','n_points','chi2','ndf','chi2_per_ndf',
+			   'parameter','value','error']
+
+#Output writer classes: each one appends the results of many fits to a single file
+#(results are given as FitResult.toDict() dictionaries, with a label like the input file name)
+
+#OutputWriter base class
+class OutputWriter(object) :
+
+	def __init__(self,filename) :
+		self._filename = filename
+		self._nwritten = 0
+
+	def filename(self) :
+		return self._filename
+	def nWritten(self) :
+		return self._nwritten
+	def write(self,resultdict,label='') :
+		self._write_(resultdict,label)
+		self._nwritten+=1
+	def close(self) :
+		pass
+	def __enter__(self) :
+		return self
+	def __exit__(self,exc_type,exc_value,traceback) :
+		self.close()
+
+#JSONLinesWriter: one JSON object per line per fit
+class JSONLinesWriter(OutputWriter) :
+
+	def __init__(self,filename) :
+		OutputWriter.__init__(self,filename)
+		self._fp = open(filename,'a',buffering=WRITE_BUFFER_BYTES)
+
+	def _write_(self,resultdict,label) :
+		self._fp.write(json.dumps(get_json_safe(dict(resultdict,label=label)),allow_nan=False)+'\n')
+	def close(self) :
+		self._fp.close()
+
+#CSVWriter: one row per parameter per fit, with a header line at the top of a new file
+class CSVWriter(OutputWriter) :
+
+	def __init__(self,filename) :
+		OutputWriter.__init__(self,filename)
+		newfile = not os.path.isfile(filename) or os.path.getsize(filename)==0
+		self._fp = open(filename,'a',buffering=WRITE_BUFFER_BYTES,newline='')
+		self._writer = csv.writer(self._fp)
+		if newfile :
+			self._writer.writerow(CSV_COLUMNS)
+
+	def _write_(self,resultdict,label) :
+		fitfields = [label]+[resultdict[c] for c in CSV_COLUMNS[1:-3]]
+		self._writer.writerows([fitfields+[name,value,error] for name,value,error in
+								zip(resultdict['parameters'],resultdict['values'],resultdict['errors'])])
+	def close(self) :
+		self._fp.close()
+
+#NPZWriter: columnar arrays (one entry per fit) written to a .npz file when closed
+#parameter arrays are padded with nan up to the largest number of parameters, and results
+#already in the file are kept in front of the new ones
+class NPZWriter(OutputWriter) :
+
+	def __init__(self,filename) :
+		OutputWriter.__init__(self,filename)
+		self._resultdicts = []; self._labels = []
+
+	def _write_(self,resultdict,label) :
+		self._resultdicts.append(resultdict); self._labels.append(label)
+	def close(self) :
+		if len(self._resultdicts)==0 :
+			return
+		npars = max([len(rd['parameters']) for rd in self._resultdicts])
+		padded = lambda a, shape : np.pad(np.asarray(a,dtype=np.float64),
+										  [(0,n-s) for n,s in zip(shape,np.shape(a))],
+										  constant_values=np.nan)
+		columns = {'label':np.array(self._labels,dtype=str),
+				   'parameters':np.array([rd['parameters']+['']*(npars-len(rd['parameters']))
+										  for rd in self._resultdicts],dtype=str),
+				   'values':np.array([padded(rd['values'],(npars,)) for rd in self._resultdicts]),
+				   'errors':np.array([padded(rd['errors'],(npars,)) for rd in self._resultdicts]),
+				   'covariance':np.array([padded(rd['covariance'],(npars,npars))
+										  for rd in self._resultdicts])}
+		for c in ['fit_type','model','engine'] :
+			columns[c] = np.array([rd[c] for rd in self._resultdicts],dtype=str)
+		for c in ['n_points','chi2','ndf','chi2_per_ndf'] :
+			columns[c] = np.array([rd[c] for rd in self._resultdicts])
+		if os.path.isfile(self._filename) :
+			with np.load(self._filename) as old :
+				columns = _concatenate_npz_columns_(old,columns)
+		with open(self._filename,'wb') as fp :
+			np.savez(fp,**columns)
+		self._resultdicts = []; self._labels = []
+
+#Output writer registry
+#output formats and their writers, and the file extensions that pick each format by default
+WRITERS = {'jsonl':JSONLinesWriter,'csv':CSVWriter,'npz':NPZWriter}
+FORMAT_EXTENSIONS = {'.jsonl':'jsonl','.json':'jsonl','.csv':'csv','.npz':'npz'}
+
+# file-scope functions
+#returns an output writer for the given file, in the given format (or the one its extension implies)
+def get_output_writer(filename,outputformat=None) :
+	return WRITERS[get_output_format(filename,outputformat)](filename)
+
+#returns the output format for the given file (the given one, or the one its extension implies)
+def get_output_format(filename,outputformat=None) :
+	if outputformat==None :
+		outputformat = FORMAT_EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+	if outputformat not in WRITERS :
+		raise ConfigError('unknown output format for file %s (options are %s)'%(filename,sorted(WRITERS)))
+	return outputformat
+
+#joins two dictionaries of npz columns, padding the parameter arrays to the same widths
+def _concatenate_npz_columns_(old,new) :
+	joined = {}
+	npars = max(old['values'].shape[1],new['values'].shape[1])
+	for c in new :
+		o, n = old[c], new[c]
+		if c in ['parameters','values','errors','covariance'] :
+			fill = '' if c=='parameters' else np.nan
+			pad = lambda a : np.pad(a,[(0,0)]+[(0,npars-s) for s in a.shape[1:]],constant_values=fill)
+			o, n = pad(o), pad(n)
+		if o.dtype.kind=='U' :
+			width = max(o.dtype.itemsize,n.dtype.itemsize)//4
+			o, n = o.astype('U%d'%(width)), n.astype('U%d'%(width))
+		joined[c] = np.concatenate((o,n))
+	return joined